@@ -49,7 +49,8 @@ class OrasNameConverter(BaseConverter):
   part_isolating = False
 
 
-def create_app():
+def create_app(transfer: bool=False):
+  """transfer: only image file and blob up-/downloads (see routes.transfer)"""
   app = Flask(__name__)
   app.config.from_file(os.environ.get('HINKSKALLE_SETTINGS', '../../conf/config.json'), load=json.load)
   secrets_conf = os.environ.get('HINKSKALLE_SECRETS', '../../conf/secrets.json')
@@ -63,6 +64,8 @@ def create_app():
   if app.config.get('SECRET_KEY') is None:
     raise Exception('please configure SECRET_KEY in config.json or HINKSKALLE_SECRET_KEY as environment variable')
   app.secret_key = app.config['SECRET_KEY']
+  if 'HINKSKALLE_TOKEN_PEPPER' in os.environ:
+    app.config['TOKEN_PEPPER'] = os.getenv('HINKSKALLE_TOKEN_PEPPER')
   if 'DB_PASSWORD' in os.environ:
     app.config['DB_PASSWORD'] = os.getenv('DB_PASSWORD')
   if 'SQLALCHEMY_DATABASE_URI' in os.environ:
@@ -104,10 +107,48 @@ def create_app():
       app.config['AUTH']['LDAP'][k]=v
   
   app.config['DOWNLOAD_TOKEN_EXPIRATION'] = app.config.get('DOWNLOAD_TOKEN_EXPIRATION', 86400)
+  app.config['DOWNLOAD_OFFLOAD'] = os.environ.get('HINKSKALLE_DOWNLOAD_OFFLOAD', app.config.get('DOWNLOAD_OFFLOAD')) or None
+  if app.config['DOWNLOAD_OFFLOAD'] not in (None, 'nginx', 'x-sendfile'):
+    raise Exception(f"DOWNLOAD_OFFLOAD should be nginx or x-sendfile, not {app.config['DOWNLOAD_OFFLOAD']}")
+  app.config['DOWNLOAD_OFFLOAD_LOCATION'] = app.config.get('DOWNLOAD_OFFLOAD_LOCATION', '/_imgs/')
+  app.config['TOKEN_CACHE_TTL'] = int(os.environ.get('HINKSKALLE_TOKEN_CACHE_TTL', app.config.get('TOKEN_CACHE_TTL', 300)))
+  app.config['TOKEN_CACHE_SIZE'] = int(app.config.get('TOKEN_CACHE_SIZE', 10000))
+  app.config['TOKEN_REFRESH_THRESHOLD'] = int(app.config.get('TOKEN_REFRESH_THRESHOLD', 43200))
+  app.config['TOKEN_REFRESH_BATCH'] = int(app.config.get('TOKEN_REFRESH_BATCH', 100))
+  app.config['TOKEN_REFRESH_FLUSH_INTERVAL'] = int(app.config.get('TOKEN_REFRESH_FLUSH_INTERVAL', 60))
+  app.config['BLOB_CACHE_TTL'] = int(app.config.get('BLOB_CACHE_TTL', 300))
+  app.config['MANIFEST_CACHE_TTL'] = int(app.config.get('MANIFEST_CACHE_TTL', 300))
+  app.config['DOWNLOAD_COUNT_BATCH'] = int(app.config.get('DOWNLOAD_COUNT_BATCH', 100))
+  app.config['DOWNLOAD_COUNT_FLUSH_INTERVAL'] = int(app.config.get('DOWNLOAD_COUNT_FLUSH_INTERVAL', 60))
+  app.config['PROXY_UPSTREAM'] = os.environ.get('HINKSKALLE_PROXY_UPSTREAM', app.config.get('PROXY_UPSTREAM')) or None
+  app.config['PROXY_ENTITY'] = app.config.get('PROXY_ENTITY', 'proxy')
+  app.config['PROXY_USERNAME'] = app.config.get('PROXY_USERNAME')
+  if 'HINKSKALLE_PROXY_PASSWORD' in os.environ:
+    app.config['PROXY_PASSWORD'] = os.getenv('HINKSKALLE_PROXY_PASSWORD')
+  app.config['PROXY_TIMEOUT'] = int(app.config.get('PROXY_TIMEOUT', 60))
+  app.config['PROXY_FETCH_TIMEOUT'] = int(app.config.get('PROXY_FETCH_TIMEOUT', 3600))
+  app.config['TOKEN_REUSE_WINDOW'] = int(app.config.get('TOKEN_REUSE_WINDOW', 3600))
+  app.config['OCI_ACCESS_TOKEN_JWT'] = app.config.get('OCI_ACCESS_TOKEN_JWT', False)
+  app.config['OCI_ACCESS_TOKEN_EXPIRATION'] = int(app.config.get('OCI_ACCESS_TOKEN_EXPIRATION', 300))
+  app.config['TOKEN_PURGE_BATCH'] = int(app.config.get('TOKEN_PURGE_BATCH', 1000))
+  app.config['AUTH_FAILURE_CACHE_TTL'] = int(app.config.get('AUTH_FAILURE_CACHE_TTL', 300))
+  app.config['AUTH_THROTTLE_BURST'] = int(app.config.get('AUTH_THROTTLE_BURST', 10))
+  app.config['AUTH_THROTTLE_RATE'] = float(app.config.get('AUTH_THROTTLE_RATE', 6))
+  app.config['TRUSTED_PROXY_COUNT'] = int(os.environ.get('HINKSKALLE_TRUSTED_PROXY_COUNT', app.config.get('TRUSTED_PROXY_COUNT', 0)))
+  app.config['OFFLOAD_THREADS'] = int(app.config.get('OFFLOAD_THREADS', 4))
+  app.config['DB_COOPERATIVE'] = app.config.get('DB_COOPERATIVE', 'auto')
+  app.config['DB_POOL_SIZE'] = int(app.config.get('DB_POOL_SIZE', 5))
+  app.config['DB_MAX_OVERFLOW'] = int(app.config.get('DB_MAX_OVERFLOW', 10))
+  app.config['DB_POOL_PRE_PING'] = app.config.get('DB_POOL_PRE_PING', False)
+  app.config['DB_POOL_RECYCLE'] = int(app.config.get('DB_POOL_RECYCLE', -1))
 
   app.config['BACKEND_URL'] = os.environ.get('HINKSKALLE_BACKEND_URL', app.config.get('BACKEND_URL', None))
   app.config['FRONTEND_URL'] = os.environ.get('HINKSKALLE_FRONTEND_URL', app.config.get('FRONTEND_URL', app.config['BACKEND_URL']))
 
+  from Hinkskalle.util.cooperative import engine_options, setup_cooperative_db
+  app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app)
+  if setup_cooperative_db(app):
+    app.logger.info("using cooperative (gevent) postgresql driver")
   db.init_app(app)
 
   from Hinkskalle.util.jobs import rq, setup_cron
@@ -127,10 +168,14 @@ def create_app():
 
 
   with app.app_context():
-    import Hinkskalle.routes
-    import Hinkskalle.commands
-    # make sure init_app is called after importing routes??
-    rebar.init_app(app)
+    if transfer:
+      from Hinkskalle.routes.transfer import transfer_rebar
+      transfer_rebar.init_app(app)
+    else:
+      import Hinkskalle.routes.api
+      import Hinkskalle.commands
+      # make sure init_app is called after importing routes??
+      rebar.init_app(app)
 
     # see https://github.com/miguelgrinberg/Flask-Migrate/issues/61#issuecomment-208131722
     migrate.init_app(app, db, render_as_batch=db.engine.url.drivername == 'sqlite')
@@ -175,7 +220,9 @@ def create_app():
   })
 
   password_checkers.init_app(app)
-  setup_cron(app)
+  # scheduled by the api workers
+  if not transfer:
+    setup_cron(app)
 
   return app
 
@@ -38,6 +38,14 @@ def expire():
   job = expire_images.queue()
   click.echo(f"started expire job with id {job.id}")
 
+token_cli = AppGroup('tokens', short_help='manage tokens')
+@token_cli.command('expire', short_help='delete expired auto tokens')
+def expire_tokens():
+  from Hinkskalle.util.jobs import expire_tokens
+  click.echo("starting token expire...")
+  job = expire_tokens.queue()
+  click.echo(f"started token expire job with id {job.id}")
+
 
 
 db_cli = AppGroup('localdb', short_help='hinkskalle specific db commands')
@@ -74,6 +82,7 @@ current_app.cli.add_command(db_cli)
 current_app.cli.add_command(ldap_cli)
 current_app.cli.add_command(quota_cli)
 current_app.cli.add_command(image_cli)
+current_app.cli.add_command(token_cli)
 
 @current_app.cli.command("cron")
 def cron():
@@ -8,6 +8,7 @@ class AdmKeys(enum.Enum):
   ldap_sync_results = 'ldap_sync_results'
   check_quotas = 'check_quotas'
   expire_images = 'expire_images'
+  expire_tokens = 'expire_tokens'
 
 class AdmSchema(Schema):
   key = fields.String(required=True, dump_only=True, validate=validate.OneOf([k.name for k in AdmKeys ]))
@@ -1,6 +1,7 @@
 from Hinkskalle import db
 from marshmallow import Schema, fields, validates_schema, ValidationError
 from ..util.schema import BaseSchema, LocalDateTime
+from ..util.auth.access import memoize_access, group_role
 from datetime import datetime
 from sqlalchemy.orm import validates
 from Hinkskalle.util.name_check import validate_name
@@ -71,6 +72,7 @@ class Collection(db.Model): # type: ignore
   def entityName(self) -> str:
     return self.entity_ref.name
   
+  @memoize_access('read')
   def check_access(self, user: User) -> bool:
     if user.is_admin:
       return True
@@ -83,14 +85,15 @@ class Collection(db.Model): # type: ignore
   def canEdit(self) -> bool:
     return self.check_update_access(g.authenticated_user)
 
+  @memoize_access('update')
   def check_update_access(self, user: User) -> bool:
     if user.is_admin:
       return True
     elif self.owner == user:
       return True
     elif self.entity_ref.group is not None:
-      ug = self.entity_ref.group.get_member(user)
-      if ug is None or ug.role == GroupRoles.readonly:
+      role = group_role(self.entity_ref.group, user)
+      if role is None or role == GroupRoles.readonly:
         return False
       else:
         return True
@@ -14,6 +14,7 @@ from Hinkskalle.models.User import GroupRoles, User
 from marshmallow import fields, Schema, validates_schema, ValidationError
 from ..util.name_check import validate_name
 from ..util.schema import BaseSchema, LocalDateTime
+from ..util.auth.access import memoize_access, group_role
 
 class ContainerTypes(enum.Enum):
   singularity = 'singularity'
@@ -188,6 +189,7 @@ class Container(db.Model): # type: ignore
       tags[arch][tag.name]=str(tag.image_id)
     return tags
   
+  @memoize_access('read')
   def check_access(self, user: User) -> bool:
     if user.is_admin:
       return True
@@ -200,14 +202,15 @@ class Container(db.Model): # type: ignore
   def canEdit(self) -> bool:
     return self.check_update_access(g.authenticated_user)
 
+  @memoize_access('update')
   def check_update_access(self, user: User) -> bool:
     if user.is_admin:
       return True
     elif self.owner == user:
       return True
     elif self.collection_ref.entity_ref.group:
-      ug = self.collection_ref.entity_ref.group.get_member(user)
-      if ug is None or ug.role == GroupRoles.readonly:
+      role = group_role(self.collection_ref.entity_ref.group, user)
+      if role is None or role == GroupRoles.readonly:
         return False
       else:
         return True
@@ -8,6 +8,7 @@ from Hinkskalle.models.Image import UploadStates
 from Hinkskalle.util.name_check import validate_name
 from Hinkskalle.models.User import GroupRoles, User
 from ..util.schema import LocalDateTime, BaseSchema
+from ..util.auth.access import memoize_access, group_role
 
 class EntitySchema(BaseSchema):
   id = fields.String(required=True, dump_only=True)
@@ -113,6 +114,7 @@ class Entity(db.Model): # type: ignore
     self.used_quota=entity_size
     return entity_size
 
+  @memoize_access('read')
   def check_access(self, user: User) -> bool:
     if user.is_admin:
       return True
@@ -121,8 +123,7 @@ class Entity(db.Model): # type: ignore
     elif self.name == 'default':
       return True
     elif self.group is not None:
-      ug = self.group.get_member(user)
-      return ug is not None
+      return group_role(self.group, user) is not None
     else:
       return False
   
@@ -130,14 +131,15 @@ class Entity(db.Model): # type: ignore
   def canEdit(self) -> bool:
     return self.check_update_access(g.authenticated_user)
 
+  @memoize_access('update')
   def check_update_access(self, user: User) -> bool:
     if user.is_admin:
       return True
     elif self.owner == user:
       return True
     elif self.group is not None:
-      ug = self.group.get_member(user)
-      if ug is None or ug.role == GroupRoles.readonly:
+      role = group_role(self.group, user)
+      if role is None or role == GroupRoles.readonly:
         return False
       else:
         return True
@@ -16,6 +16,7 @@ import os.path
 import subprocess
 
 from ..util.schema import BaseSchema, LocalDateTime
+from ..util.auth.access import memoize_access
 
 
 class ImageSchema(BaseSchema):
@@ -286,6 +287,8 @@ class Image(db.Model): # type: ignore
     self._check_file()
     if self.media_type != self.singularity_media_type:
       raise Exception(f"not a singularity image: {self.media_type}")
+    # no offload: gevent's subprocess yields while waiting, and it can't
+    # run in the native pool threads anyways
     inspect = subprocess.run(["singularity", "sif", "dump", "1", self.location], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if not inspect.returncode == 0:
       raise Exception(f"{inspect.args} failed: {inspect.stderr}")
@@ -323,6 +326,7 @@ class Image(db.Model): # type: ignore
     return sigdata
   
     
+  @memoize_access('read')
   def check_access(self, user) -> bool:
     if not self.container_ref.private:
       return True
@@ -336,6 +340,7 @@ class Image(db.Model): # type: ignore
   def canEdit(self) -> bool:
     return self.check_update_access(g.authenticated_user)
 
+  @memoize_access('update')
   def check_update_access(self, user) -> bool:
     return self.container_ref.check_update_access(user)
    
@@ -7,14 +7,20 @@ from marshmallow import fields, Schema, validates_schema, ValidationError
 from datetime import datetime, timedelta
 from flask import current_app, g
 from sqlalchemy.orm import validates
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.hybrid import hybrid_property
 import enum
 
 from passlib.hash import sha512_crypt
 import secrets
 import base64
+import hmac
+import hashlib
 
 from ..util.schema import BaseSchema, LocalDateTime
+from ..util.auth.access import memoize_access, group_role
+from ..util.offload import run_blocking
 
 user_stars = db.Table('user_stars', db.metadata,
   db.Column('user_id', db.Integer, db.ForeignKey('user.id'), nullable=False),
@@ -122,6 +128,9 @@ class User(db.Model): # type: ignore
   source = db.Column(db.String(), default='local', nullable=False)
   _passkey_id = db.Column('passkey_id', db.LargeBinary(16), default=lambda: secrets.token_bytes(16), unique=True)
   password_disabled = db.Column(db.Boolean, default=False, nullable=False)
+  # deactivated because a full ldap sync did not see them. Set only by the
+  # sync, so that it can undo it without touching admin decisions.
+  ldap_deactivated = db.Column(db.Boolean, default=False, nullable=False)
 
   groups = db.relationship('UserGroup', back_populates='user', cascade='all, delete-orphan')
   tokens = db.relationship('Token', back_populates='user', cascade="all, delete-orphan")
@@ -157,16 +166,67 @@ class User(db.Model): # type: ignore
     self.tokens.append(token)
     db.session.commit()
     return token
+
+  def create_auto_token(self, client: typing.Optional[str]=None) -> 'Token':
+    """issue an auto token for a login. Repeated logins from the same client
+    (e.g. user agent, address and credential) within TOKEN_REUSE_WINDOW get
+    the same token back instead of a new row each time."""
+    window = int(current_app.config.get('TOKEN_REUSE_WINDOW', 0))
+    if client and window > 0:
+      # derive the token instead of storing it somewhere: the key uid comes
+      # from client and time slot so that we can find the row again, the
+      # rest from a random nonce kept with the row. Once the row is gone
+      # (revoked, purged) the same client gets a different token.
+      slot = int(datetime.now().timestamp()) // window
+      key_uid = self._derive_token_part(f"{slot}:{client}")[:12]
+      token = Token.query.filter(Token.key_uid == key_uid).first()
+      if token is None:
+        nonce = secrets.token_urlsafe(16)
+        token = Token(token=key_uid+self._derive_token_part(f"{slot}:{client}:{nonce}"), source='auto', reuse_nonce=nonce)
+        token.refresh()
+        self.tokens.append(token)
+        try:
+          db.session.commit()
+          return token
+        except IntegrityError:
+          # concurrent login from the same client, just make a new one
+          db.session.rollback()
+          token = None
+      if token is not None and token.user_id == self.id and token.source == 'auto' and not token.deleted \
+          and token.reuse_nonce and token.expiresAt and token.expiresAt > datetime.now():
+        derived = key_uid+self._derive_token_part(f"{slot}:{client}:{token.reuse_nonce}")
+        if token.check_token(derived):
+          current_app.logger.debug(f"reusing token {token.key_uid} for {self.username}")
+          token.generatedToken = derived
+          from Hinkskalle.util.auth.refresh import token_refresher
+          if token_refresher.needs_refresh(token):
+            token.refresh()
+            db.session.commit()
+          return token
+      # revoked or otherwise unusable, fall back to a fresh random one
+
+    token = self.create_token()
+    token.refresh()
+    token.source = 'auto'
+    db.session.commit()
+    return token
   
+  def _derive_token_part(self, msg: str) -> str:
+    return base64.urlsafe_b64encode(hmac.new(
+      current_app.config['SECRET_KEY'].encode('utf8'),
+      f"{self.id}:{msg}".encode('utf8'),
+      hashlib.sha384
+    ).digest()).decode('utf8')
+
   def set_password(self, pw: str) -> None:
-    self.password = sha512_crypt.hash(pw)
+    self.password = run_blocking(sha512_crypt.hash, pw)
   
   def check_password(self, pw: str) -> bool:
     if not self.password:
       current_app.logger.debug(f"User {self.username} password is NULL")
       return False
     try:
-      result = sha512_crypt.verify(pw, self.password)
+      result = run_blocking(sha512_crypt.verify, pw, self.password)
     except Exception as err:
       current_app.logger.debug(f"User {self.username} hash check failed: {err}")
       return False
@@ -276,13 +336,13 @@ class Group(db.Model): # type: ignore
   def get_member(self, user: User) -> typing.Optional[UserGroup]:
     return self.users_sth.filter(UserGroup.user_id == user.id).first()
   
+  @memoize_access('read')
   def check_access(self, user: User) -> bool:
     if user.is_admin:
       return True
     if self.owner == user:
       return True
-    ug = self.get_member(user)
-    if ug:
+    if group_role(self, user) is not None:
       return True
     return False
 
@@ -290,13 +350,13 @@ class Group(db.Model): # type: ignore
   def canEdit(self) -> bool:
     return self.check_update_access(g.authenticated_user)
 
+  @memoize_access('update')
   def check_update_access(self, user: User) -> bool:
     if user.is_admin:
       return True
     if self.owner == user:
       return True
-    ug = self.users_sth.filter(UserGroup.user_id == user.id).first()
-    if ug and ug.role == GroupRoles.admin:
+    if group_role(self, user) == GroupRoles.admin:
       return True
     return False
 
@@ -354,6 +414,8 @@ class Token(db.Model): # type: ignore
 
   expiresAt = db.Column(db.DateTime)
   source = db.Column(db.Enum('auto', 'manual', name="token_source_types"))
+  # per-row part of reusable auto tokens, see User.create_auto_token
+  reuse_nonce = db.Column(db.String())
 
   user = db.relationship('User', back_populates='tokens')
 
@@ -373,22 +435,70 @@ class Token(db.Model): # type: ignore
   @token.setter
   def token(self, upd: str):
     if upd and not upd.startswith('$'):
-      self._token = sha512_crypt.hash(upd, rounds=10000)
+      self._token = Token.hash_token(upd)
       self.generatedToken = upd
       self.key_uid = upd[:12]
     else:
       self._token = upd
+
+  # tokens are long random strings, no need for a slow password hash.
+  # a keyed hash with a server-side pepper is enough and costs microseconds.
+  hash_prefix = '$hmac-sha256$'
+
+  @staticmethod
+  def hash_token(token: str) -> str:
+    pepper = current_app.config.get('TOKEN_PEPPER') or current_app.config['SECRET_KEY']
+    return Token.hash_prefix + hmac.new(pepper.encode('utf8'), token.encode('utf8'), hashlib.sha256).hexdigest()
   
   def check_token(self, token: str) -> bool:
     if not self.token:
       current_app.logger.debug(f"Token {self.key_uid} token is NULL")
       return False
+    if not token:
+      return False
+    if self._token.startswith(Token.hash_prefix):
+      return hmac.compare_digest(self._token, Token.hash_token(token))
+
     try:
-      result = sha512_crypt.verify(token, self._token)
+      result = run_blocking(sha512_crypt.verify, token, self._token)
     except Exception as err:
-      current_app.logger.info(f"Token {self.key_uid}/{self.user.username} hash check failed: {err}")
+      current_app.logger.info(f"Token {self.key_uid}/{self.user.username if self.user else '-'} hash check failed: {err}")
       return False
+    if result:
+      # legacy sha512_crypt hash: upgrade on the fly. No commit here, we
+      # might be in the middle of the caller's work; its commit persists it.
+      current_app.logger.debug(f"Token {self.key_uid} upgrading legacy hash")
+      self._token = Token.hash_token(token)
     return result
 
   def refresh(self) -> None:
     self.expiresAt = datetime.now() + Token.defaultExpiration
+
+
+@event.listens_for(Token, 'after_delete')
+def _token_deleted(mapper, connection, target: Token):
+  from Hinkskalle.util.auth.cache import token_cache
+  token_cache.invalidate_token(target.id)
+
+@event.listens_for(Token, 'after_update')
+def _token_updated(mapper, connection, target: Token):
+  from Hinkskalle.util.auth.cache import token_cache
+  state = inspect(target)
+  # auto tokens get their expiration extended all the time, only
+  # shortening it has to kick them out of the cache
+  expires = state.attrs.expiresAt.history
+  shortened = expires.has_changes() and target.expiresAt is not None and \
+    (not expires.deleted or expires.deleted[0] is None or target.expiresAt < expires.deleted[0])
+  if target.deleted or state.attrs._token.history.has_changes() or shortened:
+    token_cache.invalidate_token(target.id)
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target: User):
+  from Hinkskalle.util.auth.cache import token_cache
+  token_cache.invalidate_user(target.id)
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target: User):
+  from Hinkskalle.util.auth.cache import token_cache
+  if not target.is_active:
+    token_cache.invalidate_user(target.id)
@@ -64,6 +64,28 @@ class LdapStatusSchema(Schema):
   status = fields.String()
   config = fields.Dict()
 
+class TokenCacheStatusSchema(Schema):
+  enabled = fields.Boolean()
+  ttl = fields.Integer()
+  maxSize = fields.Integer()
+  size = fields.Integer()
+  hits = fields.Integer()
+  misses = fields.Integer()
+
+class TokenCacheStatusResponseSchema(ResponseSchema):
+  data = fields.Nested(TokenCacheStatusSchema)
+
+class AuthThrottleStatusSchema(Schema):
+  failureCacheTTL = fields.Integer()
+  burst = fields.Integer()
+  rate = fields.Float()
+  failures = fields.Integer()
+  negativeHits = fields.Integer()
+  throttled = fields.Integer()
+
+class AuthThrottleStatusResponseSchema(ResponseSchema):
+  data = fields.Nested(AuthThrottleStatusSchema)
+
 class LdapPingResponseSchema(ResponseSchema):
   data = fields.Nested(LdapPingSchema)
 
@@ -175,6 +197,28 @@ def sync_ldap():
   """deprecated, use /v1/adm/ldap_sync_results/run"""
   return start_task(AdmKeys.ldap_sync_results.name)
 
+@registry.handles(
+  rule='/v1/token-cache/status',
+  method='GET',
+  response_body_schema=TokenCacheStatusResponseSchema(),
+  authenticators=authenticator.with_scope(Scopes.admin), # type: ignore
+  tags=['admin'],
+)
+def token_cache_status():
+  from Hinkskalle.util.auth.cache import token_cache
+  return { 'data': token_cache.stats() }
+
+@registry.handles(
+  rule='/v1/auth-throttle/status',
+  method='GET',
+  response_body_schema=AuthThrottleStatusResponseSchema(),
+  authenticators=authenticator.with_scope(Scopes.admin), # type: ignore
+  tags=['admin'],
+)
+def auth_throttle_status():
+  from Hinkskalle.util.auth.throttle import auth_throttle
+  return { 'data': auth_throttle.stats() }
+
 @registry.handles(
   rule='/v1/adm/<string:key>/run',
   method='POST',
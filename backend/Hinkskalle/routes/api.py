@@ -0,0 +1,21 @@
+# the full api (see create_app)
+
+import Hinkskalle.routes.hooks
+import Hinkskalle.routes.base
+import Hinkskalle.routes.auth
+import Hinkskalle.routes.entities
+import Hinkskalle.routes.collections
+import Hinkskalle.routes.containers
+import Hinkskalle.routes.images
+import Hinkskalle.routes.imagefiles
+import Hinkskalle.routes.tags
+import Hinkskalle.routes.search
+import Hinkskalle.routes.shub
+import Hinkskalle.routes.oras
+import Hinkskalle.routes.manifests
+
+import Hinkskalle.routes.users
+import Hinkskalle.routes.tokens
+import Hinkskalle.routes.groups
+
+import Hinkskalle.routes.adm
\ No newline at end of file
@@ -6,8 +6,10 @@ from Hinkskalle.models.Entity import Entity
 from Hinkskalle.models.User import TokenSchema, User, UserSchema, PassKey, PassKeySchema, Token
 from Hinkskalle.util.auth.token import Scopes
 from Hinkskalle.util.auth.exceptions import UserNotFound, UserDisabled, InvalidPassword, PasswordAuthDisabled
+from Hinkskalle.util.auth.throttle import auth_throttle, client_identities
 from Hinkskalle.routes.util import _get_service_url
-from .util import _get_service_url
+from .util import _get_service_url, _get_container, _can_pull
+from Hinkskalle.models.Image import Image, UploadStates
 from flask_rebar import RequestSchema, ResponseSchema, errors
 from marshmallow import fields, Schema
 from flask import current_app, g, session, request
@@ -86,13 +88,28 @@ def token_status():
 )
 def get_token():
   body = rebar.validated_body
+  credential = f"{body['username']}:{body['password']}"
+  # the client's own bucket before any hashing. The username's only after
+  # a failure, otherwise anybody could lock out somebody else.
+  retry_after = auth_throttle.is_throttled(*client_identities())
+  if retry_after:
+    raise errors.TooManyRequests(f'Too many failed attempts, retry in {retry_after}s', additional_data={ 'retryAfter': retry_after })
   try:
+    if auth_throttle.is_known_bad(credential):
+      raise InvalidPassword()
     user = password_checkers.check_password(body['username'], body['password'])
     if not user.is_active:
       raise UserDisabled()
     if user.password_disabled:
       raise PasswordAuthDisabled()
-  except (UserNotFound, UserDisabled, PasswordAuthDisabled, InvalidPassword) as err:
+  except (UserNotFound, InvalidPassword) as err:
+    identities = client_identities(body['username'])
+    retry_after = auth_throttle.is_throttled(*identities)
+    auth_throttle.record_failure(credential, *identities)
+    if retry_after:
+      raise errors.TooManyRequests(f'Too many failed attempts, retry in {retry_after}s', additional_data={ 'retryAfter': retry_after })
+    raise errors.Unauthorized(err.message)
+  except (UserDisabled, PasswordAuthDisabled) as err:
     raise errors.Unauthorized(err.message)
 
   g.authenticated_user = user
@@ -122,11 +139,54 @@ def get_download_token():
       'exp': data.get('exp', timegm(datetime.utcnow().utctimetuple())+current_app.config['DOWNLOAD_TOKEN_EXPIRATION']),
     }, current_app.config['SECRET_KEY'], algorithm="HS256")
     target = f"{_get_service_url()}/v1/manifests/{data['id']}/download?temp_token={encoded_jwt}"
+  elif data['type'] == 'image' or data['type'] == 'blob':
+    # resolve everything now, the download itself only checks the signature
+    user = _download_user(data)
+    image = _get_download_image(data['type'], data['id'])
+    if not _can_pull(image.container_ref, user):
+      raise errors.Forbidden('access denied')
+    encoded_jwt = jwt.encode({
+      'id': image.id,
+      'container': image.container_id,
+      'type': data['type'],
+      'username': user.username,
+      'location': image.location,
+      'size': image.size,
+      'digest': image.hash,
+      'exp': data.get('exp', timegm(datetime.utcnow().utctimetuple())+current_app.config['DOWNLOAD_TOKEN_EXPIRATION']),
+    }, current_app.config['SECRET_KEY'], algorithm="HS256")
+    target = f"{_get_service_url()}/v1/downloads?temp_token={encoded_jwt}"
   else:
     raise errors.NotAcceptable('Invalid type')
   response = make_response({'location': target }, 202)
   response.headers['Location']=target
   return response
+
+def _download_user(data: dict) -> User:
+  if not data.get('username'):
+    return g.authenticated_user
+  try:
+    return User.query.filter(User.username==data['username']).one()
+  except NoResultFound:
+    raise errors.NotAcceptable('Invalid username')
+
+def _get_download_image(type: str, id: str) -> Image:
+  if type == 'image':
+    image = Image.query.get(id) if id.isdigit() else None
+  else:
+    # blob: name@sha256:...
+    name, _, digest = id.rpartition('@')
+    parts = name.split('/')
+    if not name or len(parts) > 3 or not digest.startswith('sha256:'):
+      raise errors.NotAcceptable('blob id should be name@sha256:...')
+    entity_id, collection_id, container_id = (['default', 'default'] + parts)[-3:]
+    container = _get_container(entity_id, collection_id, container_id)
+    image = container.images_ref.filter(Image.hash == digest.replace('sha256:', 'sha256.')).first()
+  if not image:
+    raise errors.NotFound(f"{type} {id} not found")
+  if image.uploadState != UploadStates.completed or not image.location:
+    raise errors.NotFound(f"{type} {id} not uploaded yet or already deleted")
+  return image
   
 
 @registry.handles(
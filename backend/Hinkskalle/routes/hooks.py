@@ -0,0 +1,67 @@
+from flask import current_app, jsonify, make_response, request, redirect
+from flask_rebar import errors
+import re
+
+from .util import _get_service_url
+
+# request hooks and error handlers, shared by the full app and the
+# transfer-only app (see routes.transfer)
+
+@current_app.before_request
+def before_request_func():
+  # fake content type (singularity does not set it)
+  if (request.path.startswith('/v1') or (request.path.startswith('/v2') and not request.path == '/v2/' and not request.path.startswith('/v2/__uploads') and not request.path.endswith('/blobs/uploads/'))) and (request.method=='POST' or request.method=='PUT'):
+    request.headers.environ.update(CONTENT_TYPE='application/json') # type: ignore
+  
+  # redirect double slashes to /default/ (singularity client sends meaningful //)
+  # only pull (/imagefile//) should not be redirected. For some reason
+  # singularity pull uses a double slash there. Let the regular (werkzeug) // normalization
+  # take care of that.
+  if request.path.startswith('/v1') and re.search(r"(?<!imagefile)//", request.path):
+    newpath = re.sub(r"(?<!imagefile)//", "/default/", request.path)
+    return redirect(newpath, 308)
+
+def create_error_object(code, msg):
+  return [
+    { 'title': 'Fail!', 'detail': msg, 'code': code }
+  ]
+
+@current_app.errorhandler(errors.Unauthorized)
+def unauthorized(error):
+  response = make_response(jsonify(status='error', errors=create_error_object(401, 'Not Authorized')), 401)
+  response.headers['WWW-Authenticate']=f'bearer realm="{_get_service_url()}/v2/"'
+  return response
+
+
+@current_app.errorhandler(404)
+def not_found(error):
+  return make_response(jsonify(status='error', errors=create_error_object(404, 'Not found.')), 404)
+
+@current_app.errorhandler(500)
+def internal_error(error):
+  current_app.logger.error(error)
+  return make_response(jsonify(status='error', errors=create_error_object(500, str(error))), 500)
+
+@current_app.errorhandler(403)
+def forbidden_error(error):
+  return make_response(jsonify(status="error", errors=create_error_object(403, str(error))), 403)
+
+@current_app.errorhandler(400)
+def bad_request_error(error):
+  current_app.logger.error(error)
+  return make_response(jsonify(status="error", errors=create_error_object(400, str(error))), 400)
+
+@current_app.after_request
+def add_header(r):
+  # blob downloads set their own (see util._send_blob)
+  if not getattr(r, 'cacheable', False):
+    r.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    r.headers["Pragma"] = "no-cache"
+    r.headers["Expires"] = "0"
+    r.headers['Cache-Control'] = 'public, max-age=0'
+  r.headers['Access-Control-Allow-Origin'] = '*'
+  r.headers['Access-Control-Allow-Credentials'] = 'true'
+  r.headers['Access-Control-Allow-Headers'] = 'Authorization, Content-Type'
+  r.headers['Access-Control-Allow-Methods'] = 'PUT, POST, GET, DELETE, OPTIONS'
+
+  return r
@@ -8,8 +8,11 @@ from flask import request, current_app, send_file, g, make_response
 from werkzeug.security import safe_join
 from typing import IO, Tuple
 from .images import _get_image
-from .util import _get_service_url
+from .util import _get_service_url, _send_blob, _head_blob, _counts_as_download, _decode_temp_token, _can_pull, DownloadQuerySchema
 from Hinkskalle.models import Entity, Image, Container, ImageUploadUrl, UploadStates, UploadTypes
+from Hinkskalle.util.offload import run_blocking
+from Hinkskalle.util.counters import download_counter
+from Hinkskalle.util.proxy import pull_through, UpstreamError
 
 import os
 import os.path
@@ -98,7 +101,12 @@ class ImageFileCompleteResponseSchema(ResponseSchema):
 def pull_image(entity_id, collection_id, tagged_container_id):
   """https://singularityhub.github.io/library-api/#/spec/main?id=get-v1imagefileusernamecollectionimagetagarcharch"""
   args = rebar.validated_args
-  image = _get_image(entity_id, collection_id, tagged_container_id, arch=args.get('arch', None))
+  try:
+    image = _get_image(entity_id, collection_id, tagged_container_id, arch=args.get('arch', None))
+  except errors.NotFound:
+    if not pull_through.handles(entity_id):
+      raise
+    image = _fetch_image(entity_id, collection_id, tagged_container_id, arch=args.get('arch', None))
   if not image.check_access(g.authenticated_user):
     raise errors.Forbidden('Private image, access denied.')
 
@@ -112,16 +120,52 @@ def pull_image(entity_id, collection_id, tagged_container_id):
   if not os.path.exists(image.location):
     raise errors.InternalError(f"Image not found at {image.location}")
   
-  if request.method != 'HEAD':
-    container = Container.query.filter(Container.id==image.container_id).one()
-    container.downloadCount += 1
-    container.latestDownload = datetime.now()
-    image.downloadCount += 1
-    image.latestDownload = datetime.now()
-    db.session.commit()
+  if _counts_as_download(image.hash):
+    download_counter.count(image=image, container=image.container_ref)
 
-  return send_file(image.location)
+  return _send_blob(image.location, image.hash)
   
+def _fetch_image(entity_id: str, collection_id: str, tagged_container_id: str, arch: typing.Optional[str]=None) -> Image:
+  """pull-through (see util.proxy), for logged in users only"""
+  # routes.proxy imports this module
+  from .proxy import _pull_image
+  if not g.authenticated_user:
+    raise errors.Unauthorized(f"Log in to fetch {tagged_container_id} from upstream")
+  try:
+    image = _pull_image(entity_id, collection_id, tagged_container_id, arch=arch)
+  except UpstreamError as err:
+    current_app.logger.warning(f"fetching image {entity_id}/{collection_id}/{tagged_container_id} failed: {err}")
+    raise errors.ServiceUnavailable(f"upstream not available")
+  if image is None:
+    raise errors.NotFound(f"{tagged_container_id} not found upstream")
+  return image
+
+# signed urls from /v1/get-download-token carry everything we need, no
+# database lookups at all
+@registry.handles(
+  rule='/v1/downloads',
+  method='GET',
+  query_string_schema=DownloadQuerySchema(),
+  tags=['hinkskalle-ext']
+)
+def download_signed():
+  args = rebar.validated_args
+  if not args.get('temp_token'):
+    raise errors.Unauthorized()
+  decoded = _decode_temp_token(args['temp_token'], ['image', 'blob'])
+  location = decoded.get('location')
+  if not location or not os.path.exists(location):
+    raise errors.NotFound(f"Image not found")
+
+  if request.method == 'HEAD' and decoded.get('size') is not None:
+    response = _head_blob(location, decoded['size'], decoded['digest'], immutable=True)
+  else:
+    if _counts_as_download(decoded['digest']):
+      download_counter.count_ids(image=decoded['id'], container=decoded['container'])
+    response = _send_blob(location, decoded['digest'], immutable=True)
+  response.headers['Docker-Content-Digest'] = decoded['digest'].replace('sha256.', 'sha256:')
+  return response
+
 @registry.handles(
   rule='/v1/imagefile/<string:collection_id>/<string:tagged_container_id>',
   method='GET',
@@ -170,6 +214,30 @@ def push_image_v2_init(image_id):
   image = _get_image_id(image_id)
   body = rebar.validated_body
 
+  # create_image links known files before the client decides to upload.
+  # Here it is too late to stop the transfer: clients PUT to whatever url
+  # they get. Point them to an upload that is already done, we answer
+  # without storing the body and keep a single copy.
+  existing = _find_uploaded(image, body.get('sha256sum'), body.get('filesize'))
+  if existing:
+    upload = ImageUploadUrl(
+      image_id=image.id,
+      size=body.get('filesize'),
+      md5sum=body.get('md5sum'),
+      sha256sum=body.get('sha256sum'),
+      path=existing.location,
+      state=UploadStates.completed,
+      owner=g.authenticated_user,
+      type=UploadTypes.single,
+    )
+    db.session.add(upload)
+    _link_image(image, existing)
+    return {
+      'data': {
+        'uploadURL': _get_service_url()+"/v2/imagefile/_upload/"+upload.id
+      }
+    }
+
   if not _check_quota(image, add_size=body.get('filesize')):
     raise errors.RequestEntityTooLarge(f"quota exceeded")
 
@@ -303,6 +371,12 @@ def push_image_v2_upload(upload_id):
   except NoResultFound:
     raise errors.NotFound(f"Invalid/unknown upload {upload_id}")
   
+  if _is_linked(upload):
+    current_app.logger.debug(f"Upload {upload.id} linked to existing image, skipping")
+    response = make_response('Danke!')
+    response.headers.set('ETag', upload.sha256sum)
+    return response
+
   if upload.state != UploadStates.initialized:
     raise errors.NotAcceptable(f"Upload {upload.id} has invalid state")
   if upload.expiresAt < datetime.now():
@@ -336,23 +410,24 @@ def push_image_v2_upload(upload_id):
 def push_image_v2_complete(image_id):
   """https://singularityhub.github.io/library-api/#/spec/main?id=put-v2imagefileimageid_complete"""
   image = _get_image_id(image_id)
-  upload = image.uploads_ref.filter(ImageUploadUrl.state == UploadStates.uploaded, ImageUploadUrl.type == UploadTypes.single).order_by(ImageUploadUrl.createdAt.desc()).first()
-  if not upload:
+  upload = image.uploads_ref.filter(ImageUploadUrl.state.in_([UploadStates.uploaded, UploadStates.completed]), ImageUploadUrl.type == UploadTypes.single).order_by(ImageUploadUrl.createdAt.desc()).first()
+  if not upload or (upload.state == UploadStates.completed and not _is_linked(upload)):
     raise errors.NotFound(f"No valid upload for {image_id} found")
   if not upload.check_access(g.authenticated_user):
     raise errors.Forbidden(f"Not allowed to access image")
 
-  try:
-    _move_image(upload.path, image)
-  except Exception as exc:
-    db.session.rollback()
-    upload.state = UploadStates.failed
-    upload.image_ref.uploadState = UploadStates.failed
-    db.session.commit()
-    raise exc
+  if upload.state == UploadStates.uploaded:
+    try:
+      _move_image(upload.path, image)
+    except Exception as exc:
+      db.session.rollback()
+      upload.state = UploadStates.failed
+      upload.image_ref.uploadState = UploadStates.failed
+      db.session.commit()
+      raise exc
 
-  upload.state = UploadStates.completed
-  db.session.commit()
+    upload.state = UploadStates.completed
+    db.session.commit()
   return {
     'data': {
       'quota': {
@@ -464,7 +539,55 @@ def _make_filename(image: Image) -> str:
   os.makedirs(os.path.dirname(outfn), exist_ok=True)
   return outfn
 
-def _move_image(tmpf: str, image: Image) -> Image:
+def _find_uploaded(image: Image, sha256sum: typing.Optional[str], size: typing.Optional[int]=None) -> typing.Optional[Image]:
+  if not sha256sum:
+    return None
+  digest = f"sha256.{sha256sum}"
+  # the file is stored under the image hash
+  if image.hash and image.hash != digest:
+    return None
+  candidates = Image.query.filter(
+    Image.hash==digest,
+    Image.uploadState==UploadStates.completed,
+    Image.location!=None,
+    Image.id!=image.id,
+  )
+  if size is not None:
+    candidates = candidates.filter(Image.size==size)
+  for candidate in candidates.order_by(Image.id).all():
+    if _can_pull(candidate.container_ref, g.authenticated_user) and os.path.exists(candidate.location):
+      return candidate
+  return None
+
+def _link_image(image: Image, existing: Image) -> Image:
+  current_app.logger.debug(f"linking image {image.id} to {existing.location}")
+  image.hash = existing.hash
+  image.location = existing.location
+  image.size = existing.size
+  image.signed = existing.signed
+  image.signatureVerified = existing.signatureVerified
+  image.sigdata = existing.sigdata
+  image.encrypted = existing.encrypted
+  image.uploadState = UploadStates.completed
+
+  # no new space if entity or owner already have the file
+  image.container_ref.collection_ref.entity_ref.calculate_used()
+  if image.owner:
+    image.owner.calculate_used()
+  if not _check_quota(image, add_size=0):
+    db.session.rollback()
+    raise errors.RequestEntityTooLarge(f"quota exceeded")
+  db.session.commit()
+
+  if image.media_type == Image.singularity_media_type:
+    image.container_ref.tag_image('latest', image.id, arch=current_app.config.get('DEFAULT_ARCH', 'amd64'))
+  return image
+
+def _is_linked(upload: ImageUploadUrl) -> bool:
+  # set up by push_image_v2_init, no data to receive
+  return upload.state == UploadStates.completed and upload.image_ref is not None and upload.path == upload.image_ref.location
+
+def _move_image(tmpf: str, image: Image, tag_latest: bool=True) -> Image:
   outfn = _make_filename(image)
 
   new_size = os.path.getsize(tmpf)
@@ -472,7 +595,7 @@ def _move_image(tmpf: str, image: Image) -> Image:
     raise errors.RequestEntityTooLarge(f'quota exceeded')
 
   current_app.logger.debug(f"moving image from {tmpf} to {outfn}")
-  shutil.move(tmpf, outfn)
+  run_blocking(shutil.move, tmpf, outfn)
   image.location=outfn
   image.size=os.path.getsize(image.location)
   image.uploadState=UploadStates.completed
@@ -492,23 +615,46 @@ def _move_image(tmpf: str, image: Image) -> Image:
     current_app.logger.warning(f"Image signature check failed: {err}")
    
   # XXX another race condition
-  if image.media_type == Image.singularity_media_type:
+  if tag_latest and image.media_type == Image.singularity_media_type:
     image.container_ref.tag_image('latest', image.id, arch=current_app.config.get('DEFAULT_ARCH', 'amd64'))
   return image
 
 
+_OFFLOAD_BUFFER = 1024*1024
+
+def _digest_write(m, tmpf: IO, chunk: bytes) -> None:
+  m.update(chunk)
+  tmpf.write(chunk)
+
+def _digest_copy(m, tmpf: IO, path: str) -> None:
+  with open(path, "rb") as chunk_fh:
+    while True:
+      chunk_data = chunk_fh.read(1024*1024)
+      if not chunk_data:
+        break
+      m.update(chunk_data)
+      tmpf.write(chunk_data)
+
 def _receive_upload(tmpf: IO, checksum: typing.Optional[str]=None) -> Tuple[IO, int]:
   m = hashlib.sha256()
   #current_app.logger.debug(f"starting upload to {tmpf.name}")
 
   read = 0
+  # collect a few chunks per trip to the offload pool
+  pending: typing.List[bytes] = []
+  pending_size = 0
   while (True):
     chunk = request.stream.read(current_app.config.get("UPLOAD_CHUNK_SIZE", 16385))
     if len(chunk) == 0:
       break
     read = read + len(chunk)
-    m.update(chunk)
-    tmpf.write(chunk)
+    pending.append(chunk)
+    pending_size += len(chunk)
+    if pending_size >= _OFFLOAD_BUFFER:
+      run_blocking(_digest_write, m, tmpf, b''.join(pending))
+      pending, pending_size = [], 0
+  if pending:
+    run_blocking(_digest_write, m, tmpf, b''.join(pending))
   
   #current_app.logger.debug(f"calculating checksum...")
   digest = m.hexdigest()
@@ -541,10 +687,7 @@ def _rebuild_chunks(upload: ImageUploadUrl):
   tmpf = tempfile.NamedTemporaryFile('wb', dir=upload_tmp, delete=False)
   for chunk in chunks:
     try:
-      with open(chunk.path, "rb") as chunk_fh:
-        chunk_data = chunk_fh.read()
-        m.update(chunk_data)
-        tmpf.file.write(chunk_data)
+      run_blocking(_digest_copy, m, tmpf.file, chunk.path)
 
       chunk.state=UploadStates.completed
     except FileNotFoundError:
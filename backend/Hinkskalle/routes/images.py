@@ -2,6 +2,7 @@ from typing import Tuple
 import typing
 from Hinkskalle import registry, rebar, authenticator, db
 from Hinkskalle.util.auth.token import Scopes
+from Hinkskalle.util.blob_cache import invalidate_container
 from flask_rebar import RequestSchema, ResponseSchema, errors
 from marshmallow import fields, Schema, pre_load
 from flask import request, current_app, g
@@ -204,16 +205,17 @@ def create_image():
   except IntegrityError as err:
     raise errors.PreconditionFailed(f"Image {new_image.id}/{new_image.hash} already exists")
 
+  # routes.imagefiles imports this module
+  from .imagefiles import _find_uploaded, _link_image
   # this will flush the session; if the image is not unique it would crash unless we try to insert before
-  existing_images = [ img for img in Image.query.filter(Image.hash==new_image.hash).all() if img.container_id != container.id and img.uploadState == UploadStates.completed ]
-  if len(existing_images) > 0:
-    current_app.logger.debug(f"hash already found, re-using image location {existing_images[0].location}")
-    new_image.uploadState = existing_images[0].uploadState
-    new_image.size=existing_images[0].size
-    new_image.location=existing_images[0].location
-    db.session.commit()
-
-  if new_image.uploadState == UploadStates.completed:
+  existing = None
+  if new_image.uploadState != UploadStates.completed and new_image.hash and new_image.hash.startswith('sha256.'):
+    existing = _find_uploaded(new_image, new_image.hash.replace('sha256.', ''))
+  if existing:
+    # the client sees a completed image and skips the upload
+    current_app.logger.debug(f"hash already found, re-using image location {existing.location}")
+    _link_image(new_image, existing)
+  elif new_image.uploadState == UploadStates.completed:
     container.tag_image('latest', new_image.id, arch=current_app.config.get('DEFAULT_ARCH', 'amd64'))
 
   return { 'data': new_image }
@@ -298,6 +300,7 @@ def _delete_image(image: Image):
   db.session.commit()
   image.container_ref.collection_ref.entity_ref.calculate_used()
   db.session.commit()
+  invalidate_container(image.container_id)
   if image.uploadState == UploadStates.completed and image.location and os.path.exists(image.location):
     other_refs = Image.query.filter(Image.location==image.location).count()
     if other_refs == 0:
@@ -9,7 +9,6 @@ from flask import g, send_file, current_app, redirect
 from flask_rebar import ResponseSchema, errors
 from marshmallow import fields
 from sqlalchemy.orm.exc import NoResultFound  # type: ignore
-import jwt
 from datetime import datetime
 from calendar import timegm
 
@@ -17,7 +16,8 @@ from Hinkskalle.models.Manifest import Manifest, ManifestSchema, ManifestTypes
 from Hinkskalle.models.Image import Image, UploadStates
 from Hinkskalle.models.User import User
 
-from .util import _get_container, DownloadQuerySchema
+from .util import _get_container, DownloadQuerySchema, _decode_temp_token, _send_blob, _counts_as_download
+from Hinkskalle.util.counters import download_counter
 
 class ManifestListResponseSchema(ResponseSchema):
   data = fields.Nested(ManifestSchema, many=True)
@@ -48,17 +48,7 @@ def download_manifest(manifest_id):
   if g.authenticated_user:
     user = g.authenticated_user
   elif args.get('temp_token'):
-    try:
-      decoded = jwt.decode(args.get('temp_token'), current_app.config['SECRET_KEY'], algorithms=["HS256"])
-    except jwt.InvalidSignatureError as err:
-      current_app.logger.debug(err)
-      raise errors.Unauthorized('invalid signature')
-    except jwt.ExpiredSignatureError as err:
-      current_app.logger.debug(err)
-      raise errors.Unauthorized('token invalid')
-    if decoded.get('type') != 'manifest':
-      current_app.logger.debug('token type mismatch')
-      raise errors.NotAcceptable('invalid token, type should be manifest')
+    decoded = _decode_temp_token(args.get('temp_token'), ['manifest'])
     if manifest_id != str(decoded.get('id')):
       current_app.logger.debug('token id mismatch')
       raise errors.NotAcceptable('invalid token, id mismatch')
@@ -96,11 +86,9 @@ def download_manifest(manifest_id):
   if image.uploadState != UploadStates.completed:
     raise errors.NotAcceptable(f"Image not uploaded")
   
-  image.downloadCount += 1
-  image.container_ref.downloadCount += 1
-  manifest.downloadCount += 1
-  db.session.commit()
+  if _counts_as_download(image.hash):
+    download_counter.count(image=image, container=image.container_ref, manifest=manifest)
   
-  response = send_file(image.location, as_attachment=True, download_name=fn, conditional=True)
+  response = _send_blob(image.location, image.hash, as_attachment=True, download_name=fn)
   response.headers['Docker-Content-Digest'] = image.hash.replace('sha256.', 'sha256:')
   return response
\ No newline at end of file
@@ -30,10 +30,17 @@ from Hinkskalle.models import Manifest, Container, UploadTypes, UploadStates, Im
 from Hinkskalle import db, registry, authenticator, rebar, password_checkers
 
 from Hinkskalle.util.auth.token import Scopes
+from Hinkskalle.util.auth import access_token
+from Hinkskalle.util.auth.throttle import auth_throttle, client_identities, client_address
+from Hinkskalle.util.counters import download_counter
+from Hinkskalle.util.blob_cache import blob_cache
+from Hinkskalle.util.manifest_cache import manifest_cache, ManifestResponse
+from Hinkskalle.util.proxy import pull_through, UpstreamError
 from Hinkskalle.util.auth.exceptions import UserNotFound, UserDisabled, InvalidPassword
-from .util import _get_container as __get_container, _get_service_url
-from .imagefiles import _move_image, _receive_upload as __receive_upload, _rebuild_chunks
+from .util import _get_container as __get_container, _get_service_url, _send_blob, _head_blob, _counts_as_download, _can_pull
+from .imagefiles import _move_image, _receive_upload as __receive_upload, _rebuild_chunks, _check_quota
 from .images import _delete_image
+from .proxy import _pull_manifest, _pull_blob
 from ..util.schema import BaseSchema, LocalDateTime
 
 class OrasPushBlobQuerySchema(RequestSchema):
@@ -124,6 +131,19 @@ class OrasContentRangeInvalid(OrasError):
   code = 'RANGE_INVALID'
   message = 'Requested Range Not Satisfiable'
 
+class OrasUpstreamUnavailable(OrasError):
+  status_code = 503
+  code = 'UNAVAILABLE'
+  message = 'upstream registry not available'
+
+class OrasTooManyRequests(OrasError):
+  status_code = 429
+  code = 'TOOMANYREQUESTS'
+  message = 'too many requests'
+  def __init__(self, retry_after: typing.Optional[int]=None, **kwargs):
+    self.retry_after = retry_after
+    super().__init__(**kwargs)
+
 @current_app.errorhandler(OrasError)
 def handle_oras_error(error: OrasError):
   body = {
@@ -135,6 +155,8 @@ def handle_oras_error(error: OrasError):
   resp.status_code = error.status_code
   if error.status_code == 401:
     resp.headers['WWW-Authenticate']=f'bearer realm="{_get_service_url()}/v2/"'
+  if getattr(error, 'retry_after', None):
+    resp.headers['Retry-After']=str(error.retry_after)
   return resp
 
 @registry.handles(
@@ -164,39 +186,62 @@ def authenticate_check():
       current_app.logger.debug(f"Invalid basic auth data {decoded}")
       raise OrasUnauthorized()
 
+    # failed attempts are expensive (hashing, ldap), repeat offenders get
+    # told to slow down
+    credential = f"{username}:{password}"
+    # client first, before hashing. username only after a failure, see
+    # routes.auth.get_token
+    retry_after = auth_throttle.is_throttled(*client_identities())
+    if retry_after:
+      raise OrasTooManyRequests(retry_after=retry_after)
     try:
-      user: User = User.query.filter(User.username==username).one()
-    except:
-      raise OrasUnauthorized()
-    
-    if not user.is_active:
-      raise OrasUnauthorized()
-
-    auth_valid = False
-    for token in user.manual_tokens:
-      if token.check_token(password):
-        auth_valid = True
-        break
-
-    if not auth_valid:
-      if not user.password_disabled: 
-        try:
-          _user = password_checkers.check_password(username, password)
-        except (UserNotFound, InvalidPassword) as err:
-          current_app.logger.debug(f"password check fail {err}")
-          raise OrasUnauthorized()
-      else:
+      if auth_throttle.is_known_bad(credential):
         raise OrasUnauthorized()
-    
-    token = user.create_token()
-    token.refresh()
-    token.source = 'auto'
-    db.session.add(token)
-    db.session.commit()
+      user = _check_basic_auth(username, password)
+    except OrasUnauthorized:
+      identities = client_identities(username)
+      retry_after = auth_throttle.is_throttled(*identities)
+      auth_throttle.record_failure(credential, *identities)
+      if retry_after:
+        raise OrasTooManyRequests(retry_after=retry_after)
+      raise
+
+    # docker & co log in before every push/pull, hand out the same token
+    # to the same client as long as it is valid.
+    token = user.create_auto_token(client=f"{request.headers.get('User-Agent', '')}|{client_address()}|{password}")
     return _auth_token(token)
   else:
     raise OrasUnauthorized()
 
+def _check_basic_auth(username: str, password: str) -> User:
+  try:
+    user: User = User.query.filter(User.username==username).one()
+  except:
+    raise OrasUnauthorized()
+  
+  if not user.is_active:
+    raise OrasUnauthorized()
+
+  # key_uid is unique, so at most one token needs a hash check
+  manual_token = Token.query.filter(
+    Token.key_uid == password[:12],
+    Token.user_id == user.id,
+    Token.source == 'manual',
+    Token.deleted == False,
+  ).first()
+  auth_valid = manual_token is not None and manual_token.check_token(password)
+
+  if not auth_valid:
+    if not user.password_disabled: 
+      try:
+        _user = password_checkers.check_password(username, password)
+      except (UserNotFound, InvalidPassword) as err:
+        current_app.logger.debug(f"password check fail {err}")
+        raise OrasUnauthorized()
+    else:
+      raise OrasUnauthorized()
+  return user
+
 @registry.handles(
   rule='/v2/',
   method='POST',
@@ -214,12 +259,23 @@ def authenticate():
   except errors.Unauthorized as err:
     current_app.logger.debug(f"get identity: {err.error_message}")
     raise OrasUnauthorized(err.error_message)
-  if db_token.source != 'manual':
+  except errors.TooManyRequests as err:
+    raise OrasTooManyRequests(retry_after=err.additional_data.get('retryAfter') if err.additional_data else None)
+  # with signed access tokens the login tokens act as refresh tokens, too
+  if db_token.source != 'manual' and not access_token.enabled():
     raise OrasUnauthorized('only manual tokens allowed')
   db_token.generatedToken = token
   return _auth_token(db_token) 
 
 def _auth_token(token: Token):
+  if access_token.enabled():
+    return jsonify({
+      "token_type": "Bearer",
+      "expires_in": access_token.expiration(),
+      "access_token": access_token.create_access_token(token.user),
+      "refresh_token": token.generatedToken,
+      "scope": "all"
+    })
   expires_in: timedelta = token.expiresAt - datetime.now() if token.expiresAt else timedelta(days=366)
   return jsonify({
     "token_type": "Bearer",
@@ -234,15 +290,15 @@ def _auth_token(token: Token):
   rule='/v2/<distname:name>/tags/list',
   method='GET',
   query_string_schema=OrasListTagQuerySchema(),
-  authenticators=authenticator.with_scope(Scopes.user), # type: ignore
+  authenticators=authenticator.with_scope(Scopes.optional), # type: ignore
   tags=['oci']
 )
 def oras_list_tags(name: str):
   """https://github.com/opencontainers/distribution-spec/blob/main/spec.md#endpoints end-8a"""
   args = rebar.validated_args
   container = _get_container(name)
-  if not container.check_access(g.authenticated_user):
-    raise OrasDenied(f"Not your container")
+  if not _can_pull(container, g.authenticated_user):
+    raise _pull_denied(f"Container is private.")
   
   if args.get('n') is None or args.get('n') > 0:
     cur_tags: List[str] = [ t.name for t in Tag.query.filter(Tag.image_id.in_([ i.id for i in container.images_ref ])).order_by(Tag.name) ]
@@ -268,17 +324,33 @@ def oras_list_tags(name: str):
 @registry.handles(
   rule='/v2/<distname:name>/manifests/<string:reference>',
   method='GET',
-  authenticators=authenticator.with_scope(Scopes.user),  # type: ignore
+  authenticators=authenticator.with_scope(Scopes.optional),  # type: ignore
   tags=['oci'],
 )
 def oras_manifest(name: str, reference: str):
   """https://github.com/opencontainers/distribution-spec/blob/main/spec.md#endpoints end-3"""
   # should check accept header for 
   # application/vnd.oci.image.manifest.v1+json
+  cached = manifest_cache.get(name, reference)
+  if cached is not None:
+    if not cached.check_access(g.authenticated_user):
+      raise _pull_denied(f"Container is private.")
+    return _manifest_response(cached)
+
+  try:
+    manifest = _get_manifest(name, reference)
+  except (OrasNameUnknown, OrasManifestUnknown):
+    if not pull_through.handles(_split_name(name)[0]):
+      raise
+    manifest = _fetch_manifest(name, reference)
+
+  return _manifest_response(manifest_cache.set(name, reference, manifest))
+
+def _get_manifest(name: str, reference: str) -> Manifest:
   container = _get_container(name)
   if container.private or container.collection_ref.private:
-    if not container.check_access(g.authenticated_user):
-      raise OrasDenied(f"Container is private.")
+    if not g.authenticated_user or not container.check_access(g.authenticated_user):
+      raise _pull_denied(f"Container is private.")
 
   if reference.startswith('sha256:'):
     try:
@@ -294,22 +366,28 @@ def oras_manifest(name: str, reference: str):
       if tag.image_ref.media_type == Image.singularity_media_type:
         manifest = tag.image_ref.generate_manifest()
         tag.manifest_ref=manifest
+        db.session.commit()
       else:
         raise OrasManifestUnknown(f"Tag {reference} not found")
     else:
       manifest = tag.manifest_ref
-
-
-  manifest_type = manifest.content_json.get('mediaType', 'application/vnd.oci.image.manifest.v1+json')
-
-  if request.method != 'HEAD':
-    manifest.downloadCount += 1
-    manifest.latestDownload = datetime.now()
-    db.session.commit()
-
-  response = make_response(manifest.content)
-  response.headers['Content-Type']=manifest_type
-  response.headers['Docker-Content-Digest']=f'sha256:{manifest.hash}'
+  return manifest
+
+def _manifest_response(cached: ManifestResponse):
+  digest = f'sha256:{cached.hash}'
+  if request.if_none_match.contains(digest):
+    # client has it already, not a download
+    response = make_response('', 304)
+  elif request.method == 'HEAD':
+    response = make_response('')
+    response.headers['Content-Type']=cached.media_type
+    response.headers['Content-Length']=str(len(cached.content.encode('utf-8')))
+  else:
+    download_counter.count_ids(manifest=cached.manifest_id)
+    response = make_response(cached.content)
+    response.headers['Content-Type']=cached.media_type
+  response.headers['Docker-Content-Digest']=digest
+  response.set_etag(digest)
   return response
   
 
@@ -318,7 +396,7 @@ def oras_manifest(name: str, reference: str):
 @registry.handles(
   rule='/v2/<distname:name>/blobs/<string:digest>',
   method='GET',
-  authenticators=authenticator.with_scope(Scopes.user), # type: ignore
+  authenticators=authenticator.with_scope(Scopes.optional), # type: ignore
   tags=['oci']
 )
 def oras_blob(name, digest):
@@ -328,10 +406,37 @@ def oras_blob(name, digest):
   if not digest.startswith('sha256:'):
     raise OrasUnsupported(f"only sha256 digest supported")
   
+  # repeated pulls of the same layer are resolved from the cache, no
+  # database lookups
+  blob = blob_cache.get(name, digest)
+  if blob is None:
+    try:
+      image = _get_blob(name, digest)
+    except (OrasNameUnknown, OrasBlobUnknwon):
+      if not pull_through.handles(_split_name(name)[0]):
+        raise
+      image = _fetch_blob(name, digest)
+    blob = blob_cache.set(name, digest, image)
+  elif not blob.check_access(g.authenticated_user):
+    raise _pull_denied(f"Private container denied")
+
+  if request.method == 'HEAD' and blob.size is not None:
+    ret = _head_blob(blob.location, blob.size, blob.hash, immutable=True)
+    ret.headers['Docker-Content-Digest']=f"sha256:{blob.hash.replace('sha256.', '')}"
+    return ret
+
+  if _counts_as_download(blob.hash):
+    download_counter.count_ids(image=blob.image_id, container=blob.container_id)
+  
+  ret = _send_blob(blob.location, blob.hash, immutable=True)
+  ret.headers['Docker-Content-Digest']=f"sha256:{blob.hash.replace('sha256.', '')}"
+  return ret
+
+def _get_blob(name: str, digest: str) -> Image:
   container = _get_container(name)
   if container.private or container.collection_ref.private:
-    if not container.check_access(g.authenticated_user):
-      raise OrasDenied(f"Private container denied")
+    if not g.authenticated_user or not container.check_access(g.authenticated_user):
+      raise _pull_denied(f"Private container denied")
   try:
     image = container.images_ref.filter(Image.hash == f"sha256.{digest.replace('sha256:', '')}").one()
   except NoResultFound:
@@ -340,17 +445,7 @@ def oras_blob(name, digest):
   
   if image.uploadState != UploadStates.completed or not image.location:
     raise OrasBlobUnknwon(f"Blob {digest} not uploaded or already deleted.")
-
-  if request.method != 'HEAD':
-    image.downloadCount += 1
-    container.downloadCount += 1
-    image.latestDownload = datetime.now()
-    container.latestDownload = datetime.now()
-    db.session.commit()
-  
-  ret = send_file(image.location)
-  ret.headers['Docker-Content-Digest']=f"sha256:{image.hash.replace('sha256.', '')}"
-  return ret
+  return image
 
 @registry.handles(
   rule='/v2/<distname:name>/manifests/<string:reference>',
@@ -509,6 +604,11 @@ def oras_start_upload_session(name):
   
   if args.get('from') and args.get('mount'):
     return _do_mount(container=container, _from=args.get('from'), mount=args.get('mount'))
+  
+  if args.get('digest') and not args.get('staged', False):
+    existing = _find_readable_blob(args.get('digest'), container)
+    if existing:
+      return _link_blob(container, existing)
 
   upload_tmp = os.path.join(current_app.config['IMAGE_PATH'], '_tmp')
   os.makedirs(upload_tmp, exist_ok=True)
@@ -576,22 +676,53 @@ def _do_mount(container: Container, _from: str, mount: str):
     from_image = Image.query.filter(Image.container_id==from_container.id, Image.hash==mount.replace('sha256:', 'sha256.')).one()
   except NoResultFound:
     raise OrasBlobUnknwon(f"mounting blob {mount} from {_from}: not found")
-  image = Image(
-    container_ref=container, 
-    owner=g.authenticated_user, 
-    hash=from_image.hash,
-    size=from_image.size,
-    uploadState=from_image.uploadState,
-    arch=from_image.arch,
-    signed=from_image.signed,
-    signatureVerified=from_image.signatureVerified,
-    encrypted=from_image.encrypted,
-    sigdata=from_image.sigdata,
-    media_type=from_image.media_type,
-    location=from_image.location,
-  )
-  db.session.add(image)
-  db.session.commit()
+  return _link_blob(container, from_image)
+
+def _find_readable_blob(digest: str, container: Container) -> typing.Optional[Image]:
+  # clients announce the digest when they start the upload. If we
+  # have the blob already somewhere the user can read we can skip the
+  # transfer, like a mount without from
+  digest = digest.replace('sha256:', 'sha256.')
+  if not digest.startswith('sha256.'):
+    return None
+  candidates = Image.query.filter(Image.hash==digest, Image.uploadState==UploadStates.completed, Image.location!=None).order_by(Image.id).all()
+  for image in candidates:
+    if image.container_id == container.id:
+      return image
+  for image in candidates:
+    if _can_pull(image.container_ref, g.authenticated_user) and os.path.exists(image.location):
+      return image
+  return None
+
+def _link_blob(container: Container, from_image: Image):
+  if from_image.container_id == container.id:
+    current_app.logger.debug(f"blob {from_image.hash} already in container {container.id}")
+    image = from_image
+  else:
+    current_app.logger.debug(f"linking blob {from_image.hash} from container {from_image.container_id}")
+    image = Image(
+      container_ref=container, 
+      owner=g.authenticated_user, 
+      hash=from_image.hash,
+      size=from_image.size,
+      uploadState=from_image.uploadState,
+      arch=from_image.arch,
+      signed=from_image.signed,
+      signatureVerified=from_image.signatureVerified,
+      encrypted=from_image.encrypted,
+      sigdata=from_image.sigdata,
+      media_type=from_image.media_type,
+      location=from_image.location,
+    )
+    db.session.add(image)
+    if image.uploadState == UploadStates.completed and image.size is not None:
+      if not _check_quota(image):
+        db.session.rollback()
+        raise errors.RequestEntityTooLarge(f"quota exceeded")
+      image.container_ref.collection_ref.entity_ref.calculate_used()
+      if image.owner:
+        image.owner.calculate_used()
+    db.session.commit()
   blob_url = _get_service_url()+f"/v2/{image.container_ref.entityName}/{image.container_ref.collectionName}/{image.container_ref.name}/blobs/{image.hash.replace('sha256.', 'sha256:')}"
   response = make_response('', 201)
   response.headers['Location']=blob_url
@@ -933,6 +1064,39 @@ def _split_name(name: str) -> Tuple[str, str, str]:
   return entity, collection, container
 
 
+def _pull_denied(detail: str) -> OrasError:
+  # public containers can be pulled without a token, anonymous clients
+  # get a challenge for private ones so that they log in and try again
+  if not g.authenticated_user:
+    return OrasUnauthorized(detail)
+  return OrasDenied(detail)
+
+# pull-through (see util.proxy): misses under PROXY_ENTITY come from
+# upstream. Only logged in users can make us fetch something.
+def _fetch_manifest(name: str, reference: str) -> Manifest:
+  if not g.authenticated_user:
+    raise _pull_denied(f"Log in to fetch {name} from upstream")
+  try:
+    manifest = _pull_manifest(*_split_name(name), reference)
+  except UpstreamError as err:
+    current_app.logger.warning(f"fetching manifest {name}:{reference} failed: {err}")
+    raise OrasUpstreamUnavailable(str(err))
+  if manifest is None:
+    raise OrasManifestUnknown(f"Manifest {reference} not found upstream")
+  return manifest
+
+def _fetch_blob(name: str, digest: str) -> Image:
+  if not g.authenticated_user:
+    raise _pull_denied(f"Log in to fetch {name} from upstream")
+  try:
+    image = _pull_blob(*_split_name(name), digest)
+  except UpstreamError as err:
+    current_app.logger.warning(f"fetching blob {name}@{digest} failed: {err}")
+    raise OrasUpstreamUnavailable(str(err))
+  if image is None:
+    raise OrasBlobUnknwon(f"Blob {digest} not found upstream")
+  return image
+
 def _get_container(name: str) -> Container:
   entity, collection, container = _split_name(name)
   
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+import typing
+
+from flask import current_app
+from flask_rebar import errors
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from Hinkskalle import db
+from Hinkskalle.models import Entity, Collection, Container, Image, Manifest, Tag, UploadStates
+from Hinkskalle.util.proxy import pull_through, UpstreamError
+from .util import _get_container
+from .images import _get_image, _parse_tag
+from .imagefiles import _move_image
+
+# local copies of upstream repositories (see util.proxy): PROXY_ENTITY/a/b
+# is a/b upstream. Functions return None if upstream does not know the
+# reference either and raise UpstreamError if upstream is not reachable.
+
+def _upstream_name(collection_id: str, container_id: str) -> str:
+  return f"{collection_id}/{container_id}"
+
+def _proxy_container(entity_id: str, collection_id: str, container_id: str) -> Container:
+  try:
+    return _get_container(entity_id, collection_id, container_id)
+  except errors.NotFound:
+    pass
+
+  current_app.logger.debug(f"creating proxy container {entity_id}/{collection_id}/{container_id}...")
+  try:
+    entity = Entity.query.filter(func.lower(Entity.name)==entity_id.lower()).first()
+    if entity is None:
+      entity = Entity(name=entity_id)
+      db.session.add(entity)
+    collection = entity.collections_ref.filter(func.lower(Collection.name)==collection_id.lower()).first()
+    if collection is None:
+      collection = Collection(name=collection_id, entity_ref=entity)
+      db.session.add(collection)
+    container = Container(name=container_id, collection_ref=collection)
+    db.session.add(container)
+    db.session.commit()
+  except IntegrityError:
+    # manifest and blob fetches for the same repository can run at the
+    # same time
+    db.session.rollback()
+    container = _get_container(entity_id, collection_id, container_id)
+  return container
+
+def _fetch_target() -> str:
+  upload_tmp = os.path.join(current_app.config['IMAGE_PATH'], '_tmp')
+  os.makedirs(upload_tmp, exist_ok=True)
+  with tempfile.NamedTemporaryFile(dir=upload_tmp, delete=False) as tmpf:
+    return tmpf.name
+
+def _store(target: str, image: Image) -> Image:
+  try:
+    # only the tags upstream has, an automatic latest would stick
+    return _move_image(target, image, tag_latest=False)
+  finally:
+    if os.path.exists(target):
+      os.remove(target)
+
+def _find_manifest(entity_id: str, collection_id: str, container_id: str, reference: str) -> typing.Optional[Manifest]:
+  try:
+    container = _get_container(entity_id, collection_id, container_id)
+  except errors.NotFound:
+    return None
+  if reference.startswith('sha256:'):
+    return Manifest.query.filter(Manifest.hash==reference.replace('sha256:', ''), Manifest.container_id==container.id).first()
+  tag = container.get_tag(reference)
+  return tag.manifest_ref if tag else None
+
+def _pull_manifest(entity_id: str, collection_id: str, container_id: str, reference: str) -> typing.Optional[Manifest]:
+  def fetch() -> typing.Optional[Manifest]:
+    content = pull_through.upstream.manifest(_upstream_name(collection_id, container_id), reference)
+    if content is None:
+      return None
+    container = _proxy_container(entity_id, collection_id, container_id)
+    manifest_data = json.loads(content)
+
+    with db.session.no_autoflush: # type: ignore
+      manifest = Manifest.query.filter(Manifest.hash==hashlib.sha256(content).hexdigest(), Manifest.container_id==container.id).first()
+      if manifest is None:
+        manifest = Manifest(content=content.decode('utf8'), container_ref=container)
+        db.session.add(manifest)
+
+      # layers are fetched on their first pull
+      images = []
+      for layer in manifest_data.get('layers', []) + [ manifest_data.get('config', {}) ]:
+        if not 'digest' in layer:
+          continue
+        image = Image.query.filter(Image.hash==layer['digest'].replace('sha256:', 'sha256.'), Image.container_id==container.id).first()
+        if image is None:
+          image = Image(container_ref=container, hash=layer['digest'].replace('sha256:', 'sha256.'), size=layer.get('size'), uploadState=UploadStates.initialized)
+          db.session.add(image)
+        image.media_type = layer.get('mediaType')
+        images.append(image)
+
+      if not reference.startswith('sha256:'):
+        tag = container.get_tag(reference)
+        if not tag:
+          tag = Tag(name=reference)
+          db.session.add(tag)
+        # same as oras_push_manifest
+        for image in images:
+          if not image.hide:
+            tag.image_ref = image
+        tag.container_ref = container
+        tag.manifest_ref = manifest
+    db.session.commit()
+    current_app.logger.debug(f"fetched manifest {reference} for {container.entityName}/{container.collectionName}/{container.name}")
+    return manifest
+
+  return pull_through.single_flight(
+    f"manifest:{entity_id}/{collection_id}/{container_id}:{reference}".lower(),
+    lambda: _find_manifest(entity_id, collection_id, container_id, reference),
+    fetch
+  )
+
+def _find_blob(entity_id: str, collection_id: str, container_id: str, digest: str) -> typing.Optional[Image]:
+  try:
+    container = _get_container(entity_id, collection_id, container_id)
+  except errors.NotFound:
+    return None
+  image = container.images_ref.filter(Image.hash==digest.replace('sha256:', 'sha256.')).first()
+  if image is None or image.uploadState != UploadStates.completed or not image.location:
+    return None
+  return image
+
+def _pull_blob(entity_id: str, collection_id: str, container_id: str, digest: str) -> typing.Optional[Image]:
+  def fetch() -> typing.Optional[Image]:
+    target = _fetch_target()
+    try:
+      found = pull_through.upstream.blob(_upstream_name(collection_id, container_id), digest, target)
+    except Exception:
+      os.remove(target)
+      raise
+    if not found:
+      os.remove(target)
+      return None
+    container = _proxy_container(entity_id, collection_id, container_id)
+    image = container.images_ref.filter(Image.hash==digest.replace('sha256:', 'sha256.')).first()
+    if image is None:
+      # blob pulled without its manifest, we don't know what it is
+      image = Image(container_ref=container, hash=digest.replace('sha256:', 'sha256.'), media_type='application/octet-stream')
+      db.session.add(image)
+    current_app.logger.debug(f"fetched blob {digest} for {container.entityName}/{container.collectionName}/{container.name}")
+    return _store(target, image)
+
+  return pull_through.single_flight(
+    f"blob:{entity_id}/{collection_id}/{container_id}@{digest}".lower(),
+    lambda: _find_blob(entity_id, collection_id, container_id, digest),
+    fetch
+  )
+
+def _find_image(entity_id: str, collection_id: str, tagged_container_id: str, arch: typing.Optional[str]=None) -> typing.Optional[Image]:
+  try:
+    image = _get_image(entity_id, collection_id, tagged_container_id, arch=arch)
+  except errors.NotFound:
+    return None
+  if image is None or image.uploadState != UploadStates.completed or not image.location:
+    return None
+  return image
+
+def _pull_image(entity_id: str, collection_id: str, tagged_container_id: str, arch: typing.Optional[str]=None) -> typing.Optional[Image]:
+  container_id, tag = _parse_tag(tagged_container_id)
+
+  def fetch() -> typing.Optional[Image]:
+    target = _fetch_target()
+    try:
+      digest = pull_through.upstream.imagefile(_upstream_name(collection_id, container_id), tag, target, arch=arch)
+    except Exception:
+      os.remove(target)
+      raise
+    if digest is None:
+      os.remove(target)
+      return None
+    if tag.startswith('sha256.') and tag != f"sha256.{digest}":
+      os.remove(target)
+      raise UpstreamError(f"image {tagged_container_id}: digest mismatch")
+    container = _proxy_container(entity_id, collection_id, container_id)
+    image = container.images_ref.filter(Image.hash==f"sha256.{digest}").first()
+    if image is None:
+      image = Image(container_ref=container, hash=f"sha256.{digest}", arch=arch)
+      db.session.add(image)
+    if image.uploadState == UploadStates.completed and image.location:
+      # same image as another tag
+      os.remove(target)
+    else:
+      _store(target, image)
+    if not tag.startswith('sha256.'):
+      container.tag_image(tag, image.id, arch=arch)
+    current_app.logger.debug(f"fetched image {tagged_container_id} for {container.entityName}/{container.collectionName}/{container.name}")
+    return image
+
+  return pull_through.single_flight(
+    f"image:{entity_id}/{collection_id}/{tagged_container_id}:{arch or ''}".lower(),
+    lambda: _find_image(entity_id, collection_id, tagged_container_id, arch=arch),
+    fetch
+  )
@@ -0,0 +1,62 @@
+from flask_rebar import Rebar
+
+from Hinkskalle import registry
+
+import Hinkskalle.routes.hooks
+import Hinkskalle.routes.imagefiles
+import Hinkskalle.routes.manifests
+import Hinkskalle.routes.oras
+
+# up- and downloads of image files and blobs can take hours and tie up a
+# worker the whole time. wsgi_transfer.py serves only these so that
+# transfers and API calls can run in separate pools. The proxy routes by
+# path (see docs/deployment.md), so every method on a transfer path has to
+# be here, too.
+TRANSFER_HANDLERS = (
+  # library api
+  'pull_image',
+  'pull_image_default_entity',
+  'pull_image_default_collection_default_entity_single',
+  'download_signed',
+  'download_manifest',
+  'push_image',
+  'push_image_v2_init',
+  'push_image_v2_upload',
+  'push_image_v2_complete',
+  'push_image_v2_multi_init',
+  'push_image_v2_multi_part',
+  'push_image_v2_multi_complete',
+  'push_image_v2_multi_abort',
+  # oci registry
+  'oras_blob',
+  'delete_blob',
+  'oras_start_upload_session',
+  'oras_push_chunk_init',
+  'oras_push_chunk',
+  'oras_push_chunk_finish',
+  'oras_push_registered',
+)
+
+transfer_rebar = Rebar()
+# no swagger: the spec belongs to the api
+transfer_registry = transfer_rebar.create_handler_registry(prefix='/', spec_path=None, swagger_ui_path=None)
+transfer_registry.set_default_authenticator(None)
+
+for methods in registry.paths.values():
+  for definition in methods.values():
+    if definition.func.__name__ not in TRANSFER_HANDLERS:
+      continue
+    transfer_registry.add_handler(
+      func=definition.func,
+      rule=definition.path,
+      method=definition.method,
+      endpoint=definition.endpoint,
+      response_body_schema=definition.response_body_schema,
+      query_string_schema=definition.query_string_schema,
+      request_body_schema=definition.request_body_schema,
+      headers_schema=definition.headers_schema,
+      authenticators=definition.authenticators,
+      tags=definition.tags,
+      mimetype=definition.mimetype,
+      hidden=definition.hidden,
+    )
@@ -249,6 +249,9 @@ def update_user(username):
   
   for key in body:
     setattr(user, key, body[key])
+  if 'is_active' in body:
+    # admin decision, the ldap sync keeps out of it from now on
+    user.ldap_deactivated = False
   user.updatedAt = datetime.datetime.now()
   if new_password:
     user.set_password(new_password)
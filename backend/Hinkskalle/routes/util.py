@@ -1,4 +1,14 @@
-from flask import current_app, request
+import os
+import os.path
+import typing
+import secrets
+import jwt
+from urllib.parse import quote
+from datetime import datetime, timezone
+
+from flask import current_app, request, send_file, Response
+from werkzeug.http import parse_date, unquote_etag
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 from flask_rebar import errors
 from sqlalchemy import func
 from sqlalchemy.orm.exc import NoResultFound # type: ignore
@@ -10,6 +20,21 @@ from Hinkskalle.models import Entity, Collection, Container
 class DownloadQuerySchema(RequestSchema):
   temp_token = fields.String(required=False)
 
+def _decode_temp_token(temp_token: str, types: typing.Iterable[str]) -> dict:
+  """verify a download token from /v1/get-download-token"""
+  try:
+    decoded = jwt.decode(temp_token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
+  except jwt.InvalidSignatureError as err:
+    current_app.logger.debug(err)
+    raise errors.Unauthorized('invalid signature')
+  except jwt.InvalidTokenError as err:
+    current_app.logger.debug(err)
+    raise errors.Unauthorized('token invalid')
+  if decoded.get('type') not in types:
+    current_app.logger.debug('token type mismatch')
+    raise errors.NotAcceptable(f"invalid token, type should be {'/'.join(types)}")
+  return decoded
+
 def _get_service_url() -> str:
   if current_app.config.get('BACKEND_URL'):
     return current_app.config['BACKEND_URL']
@@ -19,6 +44,13 @@ def _get_service_url() -> str:
     service_url = service_url.replace('http:', 'https:')
   return service_url
 
+def _can_pull(container: Container, user) -> bool:
+  """same check as the pull routes: private container or collection need
+  read access"""
+  if container.private or container.collection_ref.private:
+    return user is not None and container.check_access(user)
+  return True
+
 def _get_entity(entity_id: str) -> Entity:
   try:
     entity = Entity.query.filter(func.lower(Entity.name)==entity_id.lower()).one()
@@ -45,3 +77,159 @@ def _get_container(entity_id: str, collection_id: str, container_id: str) -> Con
     current_app.logger.debug(f"container {collection.entityName}/{collection.name}/{container_id} not found")
     raise errors.NotFound(f"container {collection.entityName}/{collection.name}/{container_id} not found")
   return container
+
+
+# more ranges than this are not worth the multipart overhead (and could be
+# used to make us seek around like crazy), we just send the whole file then.
+MAX_RANGES = 16
+
+def _counts_as_download(digest: str) -> bool:
+  """resumed or segmented downloads should be counted only once, revalidations (304) not at all"""
+  if request.method == 'HEAD':
+    return False
+  if request.if_none_match and request.if_none_match.contains(digest.replace('sha256.', 'sha256:')):
+    return False
+  if request.range is None:
+    return True
+  return any(start == 0 for start, _ in request.range.ranges)
+
+def _send_blob(path: str, digest: str, immutable: bool=False, **kwargs) -> Response:
+  """send_file with digest ETag, Range/If-Range (also multiple ranges) and cache headers"""
+  etag = digest.replace('sha256.', 'sha256:')
+  response = _send_offloaded(path, etag, **kwargs)
+  try:
+    if response is None and request.range is not None and len(request.range.ranges) > 1:
+      ranges = _requested_ranges(path, etag, os.path.getsize(path))
+      if ranges is not None:
+        response = _send_multirange(path, ranges, os.path.getsize(path))
+        response.set_etag(etag)
+        response.last_modified = datetime.fromtimestamp(os.path.getmtime(path), tz=timezone.utc)
+      else:
+        # too many ranges, If-Range did not match or 304: not partial
+        request.environ.pop('HTTP_RANGE', None)
+    if response is None:
+      # werkzeug takes care of single ranges, If-Range, 206 and 304
+      response = send_file(path, etag=etag, conditional=True, **kwargs)
+  except RequestedRangeNotSatisfiable:
+    # would end up as 500 in rebar's generic error handler
+    response = Response(status=416)
+    response.headers['Content-Range'] = f"bytes */{os.path.getsize(path)}"
+  return _blob_cache_headers(response, immutable)
+
+def _head_blob(path: str, size: int, digest: str, immutable: bool=False) -> Response:
+  """HEAD from stored metadata, without opening or stat'ing the file.
+  Clients check every layer like this before push and pull."""
+  etag = digest.replace('sha256.', 'sha256:')
+  if request.if_none_match and request.if_none_match.contains(etag):
+    response = Response(status=304)
+  else:
+    response = Response(status=200, mimetype='application/octet-stream')
+    response.headers['Content-Length'] = str(size)
+  response.set_etag(etag)
+  return _blob_cache_headers(response, immutable)
+
+def _blob_cache_headers(response: Response, immutable: bool) -> Response:
+  response.headers['Accept-Ranges'] = 'bytes'
+  # blobs take care of their own caching (see after_request)
+  response.cache_control.no_cache = None if immutable else True
+  response.cache_control.private = True
+  if immutable:
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+  response.cacheable = True # type: ignore
+  return response
+
+def _send_offloaded(path: str, etag: str, as_attachment: bool=False, download_name: typing.Optional[str]=None, **kwargs) -> typing.Optional[Response]:
+  """let the front proxy (nginx: X-Accel-Redirect, apache/lighttpd:
+  X-Sendfile) send the file. It also takes care of ranges then."""
+  mode = current_app.config.get('DOWNLOAD_OFFLOAD')
+  if not mode or request.method != 'GET':
+    return None
+  # only 304 is cheaper
+  if request.if_none_match and request.if_none_match.contains(etag):
+    return None
+  imgs_root = os.path.join(os.path.abspath(current_app.config['IMAGE_PATH']), '_imgs')
+  relative = os.path.relpath(os.path.abspath(path), imgs_root)
+  if relative.startswith(os.pardir):
+    # e.g. staged uploads
+    return None
+
+  response = Response(status=200, mimetype='application/octet-stream')
+  if mode == 'nginx':
+    location = current_app.config.get('DOWNLOAD_OFFLOAD_LOCATION', '/_imgs/')
+    response.headers['X-Accel-Redirect'] = location.rstrip('/') + '/' + quote(relative)
+  else:
+    response.headers['X-Sendfile'] = os.path.abspath(path)
+  if as_attachment:
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name or os.path.basename(path))
+  response.set_etag(etag)
+  return response
+
+def _requested_ranges(path: str, etag: str, size: int) -> typing.Optional[typing.List[typing.Tuple[int, int]]]:
+  """satisfiable (start, stop) tuples of a multi-range request, None if
+  the complete file should be sent instead"""
+  parsed = request.range
+  if parsed.units != 'bytes' or len(parsed.ranges) > MAX_RANGES:
+    return None
+  if_range = request.headers.get('If-Range')
+  if if_range:
+    if_range_etag, weak = unquote_etag(if_range)
+    if if_range_etag is not None and if_range.strip().startswith(('"', 'W/')):
+      if weak or if_range_etag != etag:
+        return None
+    else:
+      if_range_date = parse_date(if_range)
+      mtime = datetime.fromtimestamp(int(os.path.getmtime(path)), tz=timezone.utc)
+      if if_range_date is None or if_range_date < mtime:
+        return None
+  # has to be answered with 304
+  if request.if_none_match and request.if_none_match.contains(etag):
+    return None
+
+  ranges = []
+  for start, stop in parsed.ranges:
+    if start < 0:
+      start, stop = max(size + start, 0), size
+    elif stop is None or stop > size:
+      stop = size
+    if start >= stop:
+      continue
+    ranges.append((start, stop))
+  if not ranges:
+    raise RequestedRangeNotSatisfiable(length=size)
+  return ranges
+
+def _send_multirange(path: str, ranges: typing.List[typing.Tuple[int, int]], size: int) -> Response:
+  if len(ranges) == 1:
+    start, stop = ranges[0]
+    response = Response(_read_range(path, start, stop), status=206, mimetype='application/octet-stream', direct_passthrough=True)
+    response.headers['Content-Range'] = f"bytes {start}-{stop-1}/{size}"
+    response.headers['Content-Length'] = str(stop - start)
+    return response
+
+  boundary = secrets.token_hex(16)
+  heads = [ f"--{boundary}\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes {start}-{stop-1}/{size}\r\n\r\n".encode('ascii') for start, stop in ranges ]
+  tail = f"--{boundary}--\r\n".encode('ascii')
+  length = sum(len(head) + stop - start + 2 for head, (start, stop) in zip(heads, ranges)) + len(tail)
+
+  def generate():
+    for head, (start, stop) in zip(heads, ranges):
+      yield head
+      yield from _read_range(path, start, stop)
+      yield b"\r\n"
+    yield tail
+
+  response = Response(generate(), status=206, content_type=f"multipart/byteranges; boundary={boundary}", direct_passthrough=True)
+  response.headers['Content-Length'] = str(length)
+  return response
+
+def _read_range(path: str, start: int, stop: int, chunk_size: int=1024*1024) -> typing.Iterator[bytes]:
+  with open(path, 'rb') as fh:
+    fh.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+      data = fh.read(min(chunk_size, remaining))
+      if not data:
+        break
+      remaining -= len(data)
+      yield data
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import threading
+import typing
+
+from flask import Flask, request, make_response, jsonify
+from werkzeug.serving import make_server
+
+class StandInUpstream():
+  """local registry for pull-through tests. Serves manifests, blobs and
+  library image files from memory, wants a bearer token if token is set."""
+  def __init__(self, token: typing.Optional[str]=None):
+    self.token = token
+    self.manifests: typing.Dict[typing.Tuple[str, str], bytes] = {}
+    self.blobs: typing.Dict[str, bytes] = {}
+    self.imagefiles: typing.Dict[str, bytes] = {}
+    self.requests: typing.List[str] = []
+
+    self.app = Flask('upstream')
+    self.app.add_url_rule('/token', 'token', self._token)
+    self.app.add_url_rule('/v2/<path:name>/manifests/<reference>', 'manifest', self._manifest)
+    self.app.add_url_rule('/v2/<path:name>/blobs/<digest>', 'blob', self._blob)
+    self.app.add_url_rule('/v1/imagefile/<path:name>', 'imagefile', self._imagefile)
+    self.server = make_server('127.0.0.1', 0, self.app, threaded=True)
+    self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+  def __enter__(self) -> 'StandInUpstream':
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    return self
+
+  def __exit__(self, *args):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def add_image(self, name: str, tag: str, layers: typing.List[typing.Tuple[bytes, str]]) -> str:
+    """returns the manifest digest"""
+    config = b'{}'
+    self.blobs[f"sha256:{hashlib.sha256(config).hexdigest()}"] = config
+    descriptors = []
+    for data, media_type in layers:
+      digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+      self.blobs[digest] = data
+      descriptors.append({ 'mediaType': media_type, 'digest': digest, 'size': len(data) })
+    manifest = json.dumps({
+      'schemaVersion': 2,
+      'mediaType': 'application/vnd.oci.image.manifest.v1+json',
+      'config': { 'mediaType': 'application/vnd.oci.image.config.v1+json', 'digest': f"sha256:{hashlib.sha256(config).hexdigest()}", 'size': len(config) },
+      'layers': descriptors,
+    }).encode('utf8')
+    digest = f"sha256:{hashlib.sha256(manifest).hexdigest()}"
+    self.manifests[(name, tag)] = manifest
+    self.manifests[(name, digest)] = manifest
+    return digest
+
+  def _authorized(self) -> bool:
+    return self.token is None or request.headers.get('Authorization') == f"Bearer {self.token}"
+
+  def _challenge(self):
+    response = make_response('', 401)
+    response.headers['WWW-Authenticate'] = f'Bearer realm="{self.url}/token",service="upstream",scope="repository:{request.view_args.get("name")}:pull"' # type: ignore
+    return response
+
+  def _token(self):
+    self.requests.append(request.path)
+    return jsonify(token=self.token, expires_in=300)
+
+  def _manifest(self, name: str, reference: str):
+    self.requests.append(request.path)
+    if not self._authorized():
+      return self._challenge()
+    if (name, reference) not in self.manifests:
+      return make_response('', 404)
+    response = make_response(self.manifests[(name, reference)])
+    response.headers['Content-Type'] = 'application/vnd.oci.image.manifest.v1+json'
+    return response
+
+  def _blob(self, name: str, digest: str):
+    self.requests.append(request.path)
+    if not self._authorized():
+      return self._challenge()
+    if digest not in self.blobs:
+      return make_response('', 404)
+    return make_response(self.blobs[digest])
+
+  def _imagefile(self, name: str):
+    self.requests.append(request.path)
+    if not self._authorized():
+      return self._challenge()
+    if name not in self.imagefiles:
+      return make_response('', 404)
+    return make_response(self.imagefiles[name])
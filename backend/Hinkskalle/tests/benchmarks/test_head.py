@@ -0,0 +1,66 @@
+import os
+import time
+import unittest
+from contextlib import nullcontext
+from unittest import mock
+
+from Hinkskalle import db
+from Hinkskalle.tests.route_base import RouteBase
+from Hinkskalle.tests._util import _create_image, _fake_img_file
+from Hinkskalle.models import Tag
+
+# HEAD requests for blobs and manifests (push existence checks, pull
+# planning): answered from stored metadata and the resolution caches vs.
+# going through the full GET handlers (send_file, staleness check).
+# HINKSKALLE_BENCHMARK=1 python -m pytest -s Hinkskalle/tests/benchmarks/test_head.py
+@unittest.skipUnless(os.environ.get('HINKSKALLE_BENCHMARK'), "benchmarks not enabled (set HINKSKALLE_BENCHMARK)")
+class TestHeadBenchmark(RouteBase):
+  requests = 500
+
+  def setUp(self):
+    super().setUp()
+    image = _create_image()[0]
+    self.file = _fake_img_file(image, data=os.urandom(1024*1024))
+    tag = Tag(name='latest', image_ref=image)
+    tag.manifest_ref = image.generate_manifest()
+    db.session.add(tag)
+    db.session.commit()
+    name = f"{image.entityName}/{image.collectionName}/{image.containerName}"
+    self.urls = {
+      'blob': f"/v2/{name}/blobs/{image.hash.replace('sha256.', 'sha256:')}",
+      'manifest': f"/v2/{name}/manifests/latest",
+    }
+
+  def _full_handler(self):
+    # as before: no caches, HEAD handled by send_file
+    from Hinkskalle.routes.util import _send_blob
+    self.app.config['BLOB_CACHE_TTL'] = 0
+    self.app.config['MANIFEST_CACHE_TTL'] = 0
+    return mock.patch('Hinkskalle.routes.oras._head_blob', side_effect=lambda path, size, digest, immutable=False: _send_blob(path, digest, immutable=immutable))
+
+  def _fast_path(self):
+    self.app.config['BLOB_CACHE_TTL'] = 300
+    self.app.config['MANIFEST_CACHE_TTL'] = 300
+    return nullcontext()
+
+  def _run(self, label: str, url: str) -> float:
+    with self.fake_auth():
+      start = time.perf_counter()
+      for _ in range(self.requests):
+        ret = self.client.head(url)
+        self.assertEqual(ret.status_code, 200)
+      elapsed = time.perf_counter() - start
+    rate = self.requests / elapsed
+    print(f"{label}: {rate:.0f} HEAD/s")
+    return rate
+
+  def test_head_throughput(self):
+    print()
+    results = {}
+    for kind, url in self.urls.items():
+      with self._full_handler():
+        results[(kind, 'full')] = self._run(f"{kind} full handler", url)
+      with self._fast_path():
+        results[(kind, 'fast')] = self._run(f"{kind} fast path", url)
+    for kind in self.urls:
+      self.assertGreater(results[(kind, 'fast')], results[(kind, 'full')])
@@ -0,0 +1,69 @@
+import base64
+import os
+import time
+import unittest
+
+from passlib.hash import sha512_crypt
+
+from Hinkskalle import db
+from Hinkskalle.models.User import Token, User
+from Hinkskalle.tests.route_base import RouteBase
+from Hinkskalle.tests._util import _create_user
+
+# benchmarks are slow and noisy, run them explicitly:
+# HINKSKALLE_BENCHMARK=1 python -m pytest -s Hinkskalle/tests/benchmarks
+@unittest.skipUnless(os.environ.get('HINKSKALLE_BENCHMARK'), "benchmarks not enabled (set HINKSKALLE_BENCHMARK)")
+class TestOciLoginBenchmark(RouteBase):
+  rounds = 3
+  token_counts = [1, 10, 30]
+  # hashing is as expensive as verifying, only do it once
+  _legacy_hashes: dict = {}
+
+  def _setup_tokens(self, count: int, legacy: bool) -> str:
+    db.session.rollback()
+    db.drop_all()
+    db.create_all()
+    user = _create_user('oink.hase')
+    user.password_disabled = True
+    for i in range(count):
+      token = Token(token=f'{i:04d}-oinkoinkoinkoink', user_id=user.id, source='manual')
+      if legacy:
+        # tokens issued before hmac hashing are stored as sha512_crypt
+        if i not in self._legacy_hashes:
+          self._legacy_hashes[i] = sha512_crypt.hash(f'{i:04d}-oinkoinkoinkoink')
+        token._token = self._legacy_hashes[i]
+      db.session.add(token)
+    db.session.commit()
+    # worst case for a scan: the last token matches
+    return f'{count-1:04d}-oinkoinkoinkoink'
+
+  def _login(self, password: str) -> float:
+    auth_data = base64.b64encode(f'oink.hase:{password}'.encode('utf8')).decode('utf8')
+    start = time.perf_counter()
+    ret = self.client.get('/v2/', headers={'Authorization': f'basic {auth_data}'})
+    elapsed = time.perf_counter() - start
+    self.assertEqual(ret.status_code, 200)
+    return elapsed
+
+  def _scan(self, password: str) -> float:
+    # what authenticate_check used to do: try every manual token
+    start = time.perf_counter()
+    user = User.query.filter(User.username == 'oink.hase').one()
+    valid = any(token.check_token(password) for token in user.manual_tokens)
+    elapsed = time.perf_counter() - start
+    self.assertTrue(valid)
+    return elapsed
+
+  def _run(self, legacy: bool):
+    print()
+    for count in self.token_counts:
+      # legacy hashes get upgraded on first use, so start fresh every round
+      indexed = min(self._login(self._setup_tokens(count, legacy)) for _ in range(self.rounds))
+      scan = min(self._scan(self._setup_tokens(count, legacy)) for _ in range(self.rounds))
+      print(f"{'legacy' if legacy else 'hmac':>6} tokens={count:3d} indexed={indexed*1000:8.2f}ms scan={scan*1000:8.2f}ms")
+
+  def test_login_hmac(self):
+    self._run(legacy=False)
+
+  def test_login_legacy(self):
+    self._run(legacy=True)
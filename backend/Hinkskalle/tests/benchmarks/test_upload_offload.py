@@ -0,0 +1,82 @@
+import hashlib
+import io
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from Hinkskalle.tests.route_base import RouteBase
+from Hinkskalle.util import offload
+
+try:
+  import gevent
+except ImportError:
+  gevent = None
+
+# small requests served by the same (gevent) worker while a large upload
+# is checksummed and written to disk. Without offloading the probe has to
+# wait until the upload is done.
+# HINKSKALLE_BENCHMARK=1 python -m pytest -s Hinkskalle/tests/benchmarks/test_upload_offload.py
+@unittest.skipUnless(os.environ.get('HINKSKALLE_BENCHMARK'), "benchmarks not enabled (set HINKSKALLE_BENCHMARK)")
+@unittest.skipIf(gevent is None, "needs gevent")
+class TestUploadOffloadBenchmark(RouteBase):
+  upload_size = 256*1024*1024
+  probe_interval = 0.005
+
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    cls.img_data = os.urandom(cls.upload_size)
+    cls.digest = f"sha256.{hashlib.sha256(cls.img_data).hexdigest()}"
+
+  def setUp(self):
+    super().setUp()
+    self.upload_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.upload_dir)
+    offload._pool = None
+    offload._pool_size = 0
+    super().tearDown()
+
+  def _upload(self) -> float:
+    from Hinkskalle.routes.imagefiles import _receive_upload
+    start = time.perf_counter()
+    with self.app.test_request_context('/', method='POST', input_stream=io.BytesIO(self.img_data)):
+      _receive_upload(tempfile.NamedTemporaryFile('wb', delete=False, dir=self.upload_dir), self.digest)
+    return time.perf_counter() - start
+
+  def _probe(self, uploads: list) -> list:
+    # latency counts from when the request should have been sent: a
+    # blocked hub delays the wakeup just as it would delay accept()
+    latencies = []
+    while not uploads or not uploads[0].ready():
+      due = time.perf_counter() + self.probe_interval
+      gevent.sleep(self.probe_interval)
+      ret = self.client.get('/version')
+      latencies.append(time.perf_counter() - due)
+      self.assertEqual(ret.status_code, 200)
+    return latencies
+
+  def _run(self, threads: int):
+    self.app.config['OFFLOAD_THREADS'] = threads
+    uploads: list = []
+    with mock.patch.object(offload, '_cooperative', return_value=True):
+      probe = gevent.spawn(self._probe, uploads)
+      gevent.sleep(0)
+      uploads.append(gevent.spawn(self._upload))
+      gevent.joinall([uploads[0], probe], raise_error=True)
+    upload = uploads[0]
+    latencies = probe.value
+    print(f"offload threads {threads}: upload {upload.value:.2f}s, {len(latencies)} probe requests, median {statistics.median(latencies)*1000:.1f}ms, max {max(latencies)*1000:.1f}ms")
+    return latencies
+
+  def test_upload_latency(self):
+    print()
+    inline = self._run(0)
+    offloaded = self._run(4)
+    self.assertGreater(len(offloaded), len(inline))
+    self.assertLess(max(offloaded), max(inline))
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+from ..job_base import JobBase
+from .._util import _create_user
+
+from Hinkskalle import db
+from Hinkskalle.models.Adm import Adm, AdmKeys
+from Hinkskalle.models.User import Token, User
+
+from Hinkskalle.util.jobs import expire_tokens
+
+class TestExpireTokensJob(JobBase):
+  def _create_token(self, prefix: str, **attrs) -> Token:
+    user = User.query.first() or _create_user()
+    token = Token(token=f"{prefix}-oinkoinkoink", **attrs)
+    user.tokens.append(token)
+    db.session.commit()
+    return token
+
+  def test_job(self):
+    job = self.queue.enqueue(expire_tokens)
+    self.assertTrue(job.is_finished)
+    self.assertEqual(job.meta['progress'], 'done')
+    self.assertEqual(job.meta['result']['deleted'], 0)
+
+    adm = Adm.query.filter(Adm.key == AdmKeys.expire_tokens).first()
+    self.assertDictEqual(adm.val, job.meta['result'])
+
+  def test_expire(self):
+    expired = self._create_token('expired', source='auto', expiresAt=datetime.now() - timedelta(days=1)).id
+    valid = self._create_token('valid', source='auto', expiresAt=datetime.now() + timedelta(days=1)).id
+    manual = self._create_token('manual', source='manual', expiresAt=datetime.now() - timedelta(days=1)).id
+    manual_deleted = self._create_token('mandel', source='manual', deleted=True).id
+    no_expiry = self._create_token('noexpiry', source='manual').id
+
+    job = self.queue.enqueue(expire_tokens)
+    self.assertEqual(job.meta['progress'], 'done')
+    self.assertEqual(job.meta['result']['deleted'], 1)
+
+    remaining = [ t.id for t in Token.query.all() ]
+    self.assertNotIn(expired, remaining)
+    self.assertIn(manual_deleted, remaining)
+    self.assertIn(valid, remaining)
+    self.assertIn(manual, remaining)
+    self.assertIn(no_expiry, remaining)
+
+  def test_expire_batches(self):
+    self.app.config['TOKEN_PURGE_BATCH'] = 2
+    for i in range(5):
+      self._create_token(f'expired{i:02d}', source='auto', expiresAt=datetime.now() - timedelta(days=1))
+    job = self.queue.enqueue(expire_tokens)
+    self.app.config['TOKEN_PURGE_BATCH'] = 1000
+    self.assertEqual(job.meta['result']['deleted'], 5)
+    self.assertEqual(Token.query.count(), 0)
+
+  def test_expire_pending_refresh(self):
+    from Hinkskalle.util.auth.refresh import token_refresher
+    token = self._create_token('pending', source='auto', expiresAt=datetime.now() - timedelta(minutes=1))
+    token_refresher.connection.hset(f"{token_refresher.prefix}:pending", token.id, (datetime.now() + timedelta(days=1)).timestamp())
+
+    job = self.queue.enqueue(expire_tokens)
+    self.assertEqual(job.meta['result']['deleted'], 0)
+    db.session.expire_all()
+    self.assertGreater(Token.query.get(token.id).expiresAt, datetime.now())
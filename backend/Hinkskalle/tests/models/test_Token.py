@@ -1,7 +1,9 @@
 import typing
+from datetime import datetime, timedelta
 
 from Hinkskalle.models import Token, User, TokenSchema
 from Hinkskalle import db
+from passlib.hash import sha512_crypt
 
 from ..model_base import ModelBase
 from .._util import _create_user
@@ -34,6 +36,42 @@ class TestToken(ModelBase):
     self.assertFalse(token1.check_token(secret))
     self.assertFalse(token1.check_token(None)) # type: ignore
 
+
+  def test_token_hash_format(self):
+    user = _create_user()
+    token1 = Token(user=user, token='geheimhase012-geheimhase')
+    self.assertTrue(token1.token.startswith(Token.hash_prefix))
+    self.assertEqual(token1.token, Token.hash_token('geheimhase012-geheimhase'))
+
+  def test_token_pepper(self):
+    user = _create_user()
+    secret = 'geheimhase012-geheimhase'
+    token1 = Token(user=user, token=secret)
+    self.assertTrue(token1.check_token(secret))
+    self.app.config['TOKEN_PEPPER'] = 'anderer-pfeffer'
+    try:
+      self.assertFalse(token1.check_token(secret))
+    finally:
+      self.app.config.pop('TOKEN_PEPPER')
+
+  def test_token_legacy_upgrade(self):
+    user = _create_user()
+    secret = 'geheimhase012-geheimhase'
+    token1 = Token(user=user, token=sha512_crypt.hash(secret, rounds=10000))
+    token1.key_uid = secret[:12]
+    db.session.add(token1)
+    db.session.commit()
+
+    self.assertFalse(token1.check_token(secret+'oink'))
+    self.assertFalse(token1.token.startswith(Token.hash_prefix))
+
+    self.assertTrue(token1.check_token(secret))
+    # left to the caller
+    self.assertIn(token1, db.session.dirty)
+    db.session.commit()
+    read_token = Token.query.filter(Token.key_uid=='geheimhase01').one()
+    self.assertEqual(read_token.token, Token.hash_token(secret))
+    self.assertTrue(read_token.check_token(secret))
   
   def test_generate_token(self):
     user = _create_user()
@@ -58,6 +96,80 @@ class TestToken(ModelBase):
     db.session.commit()
     self.assertListEqual([ t.id for t in user.manual_tokens ], [ token1.id ])
 
+  def test_auto_token_reuse(self):
+    self.app.config['TOKEN_REUSE_WINDOW'] = 3600
+    user = _create_user()
+    token1 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    self.assertEqual(token1.source, 'auto')
+    self.assertIsNotNone(token1.expiresAt)
+    token2 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    self.assertEqual(token1.id, token2.id)
+    self.assertEqual(token1.generatedToken, token2.generatedToken)
+    self.assertTrue(token2.check_token(token2.generatedToken))
+    self.assertEqual(Token.query.filter(Token.user_id==user.id).count(), 1)
+
+    token3 = user.create_auto_token(client='oras|127.0.0.1|geheim')
+    self.assertNotEqual(token1.id, token3.id)
+
+    other = _create_user('other.hase')
+    token4 = other.create_auto_token(client='docker|127.0.0.1|geheim')
+    self.assertNotEqual(token1.id, token4.id)
+
+  def test_auto_token_reuse_disabled(self):
+    self.app.config['TOKEN_REUSE_WINDOW'] = 0
+    user = _create_user()
+    token1 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    token2 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    self.assertNotEqual(token1.id, token2.id)
+    token3 = user.create_auto_token()
+    self.assertNotEqual(token2.id, token3.id)
+    self.app.config['TOKEN_REUSE_WINDOW'] = 3600
+
+  def test_auto_token_reuse_revoked(self):
+    self.app.config['TOKEN_REUSE_WINDOW'] = 3600
+    user = _create_user()
+    token1 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    token1.deleted = True
+    db.session.commit()
+    token2 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    self.assertNotEqual(token1.id, token2.id)
+    self.assertFalse(token2.deleted)
+
+  def test_auto_token_reuse_purged(self):
+    self.app.config['TOKEN_REUSE_WINDOW'] = 3600
+    user = _create_user()
+    token1 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    revoked = token1.generatedToken
+    db.session.delete(token1)
+    db.session.commit()
+    token2 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    self.assertNotEqual(token2.generatedToken, revoked)
+    self.assertFalse(token2.check_token(revoked))
+    # same key uid, so the new row is found again
+    self.assertEqual(token2.key_uid, revoked[:12])
+    token3 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    self.assertEqual(token3.id, token2.id)
+    self.assertEqual(token3.generatedToken, token2.generatedToken)
+
+  def test_auto_token_reuse_expired(self):
+    self.app.config['TOKEN_REUSE_WINDOW'] = 3600
+    user = _create_user()
+    token1 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    token1.expiresAt = datetime.now() - timedelta(minutes=1)
+    db.session.commit()
+    token2 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    self.assertNotEqual(token1.id, token2.id)
+
+  def test_auto_token_reuse_extend(self):
+    self.app.config['TOKEN_REUSE_WINDOW'] = 3600
+    user = _create_user()
+    token1 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    token1.expiresAt = datetime.now() + timedelta(minutes=5)
+    db.session.commit()
+    token2 = user.create_auto_token(client='docker|127.0.0.1|geheim')
+    self.assertEqual(token1.id, token2.id)
+    self.assertGreater(token2.expiresAt, datetime.now() + timedelta(hours=12))
+
   def test_schema_token(self):
     schema = TokenSchema()
     user = _create_user()
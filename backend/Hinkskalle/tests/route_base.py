@@ -31,12 +31,32 @@ class RouteBase(unittest.TestCase):
     self.app.config['DEFAULT_GROUP_QUOTA'] = 0
     self.app.config['SINGULARITY_FLAVOR'] = 'singularity'
     self.app.config['ENABLE_REGISTER'] = False
+    self.app.config['OCI_ACCESS_TOKEN_JWT'] = False
+    self.app.config['AUTH_FAILURE_CACHE_TTL'] = 300
+    self.app.config['AUTH_THROTTLE_BURST'] = 10
+    self.app.config['TRUSTED_PROXY_COUNT'] = 0
+    self.app.config['DOWNLOAD_OFFLOAD'] = None
+    self.app.config['DOWNLOAD_OFFLOAD_LOCATION'] = '/_imgs/'
+    self.app.config['BLOB_CACHE_TTL'] = 300
+    self.app.config['MANIFEST_CACHE_TTL'] = 300
+    self.app.config['PROXY_UPSTREAM'] = None
     self.app.testing = True
     self.client = self.app.test_client()
 
     self.app.app_context().push()
     db.create_all()
 
+    # fakeredis lives on between tests
+    from Hinkskalle.util.auth.throttle import auth_throttle
+    from Hinkskalle.util.counters import download_counter
+    from Hinkskalle.util.blob_cache import blob_cache
+    from Hinkskalle.util.manifest_cache import manifest_cache
+    from Hinkskalle.util.proxy import pull_through
+    from Hinkskalle.util.auth.cache import token_cache
+    for prefix in [ auth_throttle.prefix, download_counter.prefix, blob_cache.prefix, manifest_cache.prefix, pull_through.prefix, token_cache.prefix ]:
+      for key in auth_throttle.connection.scan_iter(f"{prefix}:*"):
+        auth_throttle.connection.delete(key)
+
     self.admin_username='admin.hase'
     self.admin_user = _create_user(name=self.admin_username, is_admin=True)
     self.username='user.hase'
@@ -6,6 +6,7 @@ from Hinkskalle import db
 
 import base64
 import typing
+from unittest import mock
 
 class TestOrasAuth(RouteBase):
   # no extensive tests for account status etc.
@@ -52,6 +53,60 @@ class TestOrasAuth(RouteBase):
     db_token = Token.query.filter(Token.key_uid==token[:12]).first()
     self.assertIsNotNone(db_token)
   
+  def test_get_base_basic_auth_reuse(self):
+    user = _create_user('oink.hase')
+    user.set_password('supergeheim')
+    db.session.commit()
+
+    auth_data = base64.b64encode(f'{user.username}:supergeheim'.encode('utf8')).decode('utf8')
+    tokens = []
+    for _ in range(3):
+      ret = self.client.get('/v2/', headers={'Authorization': f'basic {auth_data}', 'User-Agent': 'docker/20.10'})
+      self.assertEqual(ret.status_code, 200)
+      tokens.append(typing.cast(dict, ret.get_json())['access_token'])
+    self.assertEqual(len(set(tokens)), 1)
+    self.assertEqual(Token.query.filter(Token.user_id==user.id, Token.source=='auto').count(), 1)
+
+    ret = self.client.get('/v2/', headers={'Authorization': f'basic {auth_data}', 'User-Agent': 'oras/0.16'})
+    self.assertEqual(ret.status_code, 200)
+    self.assertNotEqual(typing.cast(dict, ret.get_json())['access_token'], tokens[0])
+
+  def test_get_base_basic_auth_token_many(self):
+    user = _create_user('oink.hase')
+    for i in range(10):
+      db.session.add(Token(token=f'{i:02d}-oinkoinkoinkoink', user_id=user.id, source='manual'))
+    db.session.commit()
+
+    auth_data = base64.b64encode(f'{user.username}:07-oinkoinkoinkoink'.encode('utf8')).decode('utf8')
+    with mock.patch.object(Token, 'check_token', autospec=True, side_effect=lambda self, token: True) as check_mock:
+      ret = self.client.get('/v2/', headers={'Authorization': f'basic {auth_data}'})
+    self.assertEqual(ret.status_code, 200)
+    check_mock.assert_called_once()
+    self.assertEqual(check_mock.call_args[0][0].key_uid, '07-oinkoinko')
+
+  def test_get_base_basic_auth_token_other_user(self):
+    user = _create_user('oink.hase')
+    user.password_disabled = True
+    other = _create_user('grunz.hase')
+    token = Token(token='oinkoinkoinkoink', user_id=other.id, source='manual')
+    db.session.add(token)
+    db.session.commit()
+
+    auth_data = base64.b64encode(f'{user.username}:oinkoinkoinkoink'.encode('utf8')).decode('utf8')
+    ret = self.client.get('/v2/', headers={'Authorization': f'basic {auth_data}'})
+    self.assertEqual(ret.status_code, 401)
+
+  def test_get_base_basic_auth_token_deleted(self):
+    user = _create_user('oink.hase')
+    user.password_disabled = True
+    token = Token(token='oinkoinkoinkoink', user_id=user.id, source='manual', deleted=True)
+    db.session.add(token)
+    db.session.commit()
+
+    auth_data = base64.b64encode(f'{user.username}:oinkoinkoinkoink'.encode('utf8')).decode('utf8')
+    ret = self.client.get('/v2/', headers={'Authorization': f'basic {auth_data}'})
+    self.assertEqual(ret.status_code, 401)
+
   def test_get_base_basic_auth_token_password_disabled(self):
     user = _create_user('oink.hase')
     user.password_disabled = True
@@ -149,4 +204,57 @@ class TestOrasAuth(RouteBase):
     token_data = typing.cast(dict, ret.get_json())
     self.assertIn('access_token', token_data)
     token = token_data['access_token'] # type: ignore
-    self.assertEqual(token, 'oinkoinkoinkoink')
\ No newline at end of file
+    self.assertEqual(token, 'oinkoinkoinkoink')
+  def test_get_base_basic_auth_access_token(self):
+    self.app.config['OCI_ACCESS_TOKEN_JWT'] = True
+    user = _create_user('oink.hase')
+    user.set_password('supergeheim')
+    db.session.commit()
+
+    auth_data = base64.b64encode(f'{user.username}:supergeheim'.encode('utf8')).decode('utf8')
+    ret = self.client.get('/v2/', headers={'Authorization': f'basic {auth_data}'})
+    self.assertEqual(ret.status_code, 200)
+    token_data = typing.cast(dict, ret.get_json())
+    self.assertEqual(token_data['expires_in'], self.app.config['OCI_ACCESS_TOKEN_EXPIRATION'])
+    self.assertEqual(token_data['access_token'].count('.'), 2)
+    db_token = Token.query.filter(Token.key_uid==token_data['refresh_token'][:12]).first()
+    self.assertIsNotNone(db_token)
+
+    ret = self.client.get('/v2/', headers={'Authorization': f"bearer {token_data['access_token']}"})
+    self.assertEqual(ret.status_code, 200)
+
+    # auto tokens work as refresh tokens
+    ret = self.client.post('/v2/', data={'refresh_token': token_data['refresh_token']})
+    self.assertEqual(ret.status_code, 200)
+    refreshed = typing.cast(dict, ret.get_json())
+    self.assertEqual(refreshed['access_token'].count('.'), 2)
+    self.assertEqual(refreshed['refresh_token'], token_data['refresh_token'])
+
+  def test_get_base_basic_auth_throttled(self):
+    self.app.config['AUTH_THROTTLE_BURST'] = 2
+    user = _create_user('oink.hase')
+    user.set_password('supergeheim')
+    db.session.commit()
+
+    auth_data = base64.b64encode(f'{user.username}:falsch'.encode('utf8')).decode('utf8')
+    with mock.patch('Hinkskalle.models.User.User.check_password', return_value=False) as check_mock:
+      for _ in range(2):
+        ret = self.client.get('/v2/', headers={'Authorization': f'basic {auth_data}'})
+        self.assertEqual(ret.status_code, 401)
+      ret = self.client.get('/v2/', headers={'Authorization': f'basic {auth_data}'})
+    self.assertEqual(ret.status_code, 429)
+    self.assertEqual(ret.get_json()['errors'][0]['code'], 'TOOMANYREQUESTS')
+    self.assertIn('Retry-After', ret.headers)
+    # second attempt was rejected from the failure cache
+    check_mock.assert_called_once()
+
+    # this client gets nothing verified anymore
+    auth_data = base64.b64encode(f'{user.username}:supergeheim'.encode('utf8')).decode('utf8')
+    with mock.patch('Hinkskalle.models.User.User.check_password') as check_mock:
+      ret = self.client.get('/v2/', headers={'Authorization': f'basic {auth_data}'})
+    self.assertEqual(ret.status_code, 429)
+    check_mock.assert_not_called()
+
+    # the correct password from somewhere else is fine
+    ret = self.client.get('/v2/', headers={'Authorization': f'basic {auth_data}'}, environ_base={ 'REMOTE_ADDR': '10.0.0.2' })
+    self.assertEqual(ret.status_code, 200)
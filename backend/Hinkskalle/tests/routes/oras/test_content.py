@@ -12,11 +12,25 @@ from Hinkskalle.models.Manifest import Manifest
 class TestOrasContent(RouteBase):
 
   def test_tag_list_noauth(self):
-    image = _create_image()[0]
+    image, container, _, _ = _create_image()
     tag1 = Tag(name='oink', image_ref=image)
-
     db.session.add(tag1)
 
+    ret = self.client.get(f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/tags/list")
+    self.assertEqual(ret.status_code, 200)
+    self.assertListEqual(ret.get_json()['tags'], ['oink'])
+
+    container.private = True
+    db.session.commit()
+    ret = self.client.get(f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/tags/list")
+    self.assertEqual(ret.status_code, 401)
+    self.assertIn('WWW-Authenticate', ret.headers)
+
+  def test_tag_list_noauth_private_collection(self):
+    image, _, collection, _ = _create_image()
+    collection.private = True
+    db.session.commit()
+
     ret = self.client.get(f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/tags/list")
     self.assertEqual(ret.status_code, 401)
 
@@ -59,6 +73,7 @@ class TestOrasContent(RouteBase):
   def test_tag_list_user_denied(self):
     image, container, collection, entity = _create_image()
     container.owner = self.other_user
+    container.private = True
     collection.owner = self.other_user
     entity.owner = self.other_user
     tag1 = Tag(name='oink', image_ref=image)
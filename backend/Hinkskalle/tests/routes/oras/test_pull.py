@@ -2,11 +2,16 @@ from Hinkskalle.tests.route_base import RouteBase
 from Hinkskalle.tests._util import _fake_img_file, _create_image
 
 from Hinkskalle import db
+from Hinkskalle.util.counters import download_counter
+from Hinkskalle.util.manifest_cache import manifest_cache
 from Hinkskalle.models.Tag import Tag
 from Hinkskalle.models.Manifest import Manifest
-from Hinkskalle.models.Image import Image
+from Hinkskalle.models.Image import Image, UploadStates
 
 from datetime import datetime, timedelta
+import os
+import tempfile
+from unittest import mock
 
 class TestOrasPull(RouteBase):
   def test_manifest(self):
@@ -60,7 +65,35 @@ class TestOrasPull(RouteBase):
 
     db.session.commit()
 
+    # public containers can be pulled anonymously
     ret = self.client.get(f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/manifests/latest")
+    self.assertEqual(ret.status_code, 200)
+
+  def test_manifest_noauth_private(self):
+    image, container, _, _ = _create_image()
+    container.private = True
+    latest_tag = Tag(name='latest', image_ref=image)
+    db.session.add(latest_tag)
+    db.session.commit()
+    url = f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/manifests/latest"
+
+    with self.fake_admin_auth():
+      ret = self.client.get(url)
+    self.assertEqual(ret.status_code, 200)
+
+    # challenge also from the cache
+    for _ in range(2):
+      ret = self.client.get(url)
+      self.assertEqual(ret.status_code, 401)
+      self.assertIn('bearer realm=', ret.headers.get('WWW-Authenticate'))
+
+  def test_manifest_invalid_token(self):
+    image = _create_image()[0]
+    latest_tag = Tag(name='latest', image_ref=image)
+    db.session.add(latest_tag)
+    db.session.commit()
+
+    ret = self.client.get(f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/manifests/latest", headers={'Authorization': 'Bearer oink'})
     self.assertEqual(ret.status_code, 401)
 
   def test_manifest_user(self):
@@ -273,6 +306,7 @@ class TestOrasPull(RouteBase):
     self.assertEqual(ret.status_code, 200)
 
     self.assertDictEqual(ret.get_json(), {'oi': 'nk'})
+    download_counter.flush()
     manifest = Manifest.query.get(manifest_id)
     self.assertEqual(manifest.downloadCount, 1)
     self.assertAlmostEqual(manifest.latestDownload, datetime.now(), delta=timedelta(seconds=2))
@@ -291,8 +325,131 @@ class TestOrasPull(RouteBase):
       ret = self.client.head(f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/manifests/sha256:{manifest.hash}")
     self.assertEqual(ret.status_code, 200)
 
+    download_counter.flush()
     manifest = Manifest.query.get(manifest_id)
     self.assertEqual(manifest.downloadCount, 0)
+
+  def test_manifest_head(self):
+    image = _create_image()[0]
+    latest_tag = Tag(name='latest', image_ref=image)
+    manifest = Manifest(content='{"oi": "nk"}', container_ref=image.container_ref)
+    latest_tag.manifest_ref=manifest
+    db.session.add(latest_tag)
+    db.session.commit()
+    url = f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/manifests/latest"
+    digest = f"sha256:{manifest.hash}"
+
+    for _ in range(2):
+      with self.fake_auth():
+        ret = self.client.head(url)
+      self.assertEqual(ret.status_code, 200)
+      self.assertEqual(ret.headers.get('Content-Length'), str(len('{"oi": "nk"}')))
+      self.assertEqual(ret.headers.get('Content-Type'), 'application/vnd.oci.image.manifest.v1+json')
+      self.assertEqual(ret.headers.get('Docker-Content-Digest'), digest)
+      self.assertEqual(ret.data, b'')
+
+  def test_manifest_etag(self):
+    image = _create_image()[0]
+    latest_tag = Tag(name='latest', image_ref=image)
+    manifest = Manifest(content='{"oi": "nk"}', container_ref=image.container_ref)
+    latest_tag.manifest_ref=manifest
+    db.session.add(latest_tag)
+    db.session.commit()
+    url = f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/manifests/latest"
+    digest = f"sha256:{manifest.hash}"
+
+    with self.fake_auth():
+      ret = self.client.get(url)
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(ret.headers.get('ETag'), f'"{digest}"')
+
+    for _ in range(2):
+      with self.fake_auth():
+        ret = self.client.get(url, headers={'If-None-Match': f'"{digest}"'})
+      self.assertEqual(ret.status_code, 304)
+      self.assertEqual(ret.data, b'')
+      self.assertEqual(ret.headers.get('Docker-Content-Digest'), digest)
+
+    with self.fake_auth():
+      ret = self.client.get(url, headers={'If-None-Match': '"sha256:nope"'})
+    self.assertEqual(ret.status_code, 200)
+    self.assertDictEqual(ret.get_json(), {'oi': 'nk'})
+
+    # 304s are not downloads
+    manifest_id = manifest.id
+    download_counter.flush()
+    self.assertEqual(Manifest.query.get(manifest_id).downloadCount, 2)
+
+  def test_manifest_cached(self):
+    image = _create_image()[0]
+    latest_tag = Tag(name='latest', image_ref=image)
+    manifest = Manifest(content='{"oi": "nk"}', container_ref=image.container_ref)
+    latest_tag.manifest_ref=manifest
+    db.session.add(latest_tag)
+    db.session.commit()
+    manifest_id = manifest.id
+    name = f"{image.entityName}/{image.collectionName}/{image.containerName}"
+
+    with self.fake_auth():
+      ret = self.client.get(f"/v2/{name}/manifests/latest")
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(manifest_cache.get(name, 'latest').manifest_id, manifest_id)
+
+    with mock.patch('Hinkskalle.routes.oras._get_container', side_effect=Exception('oink')):
+      with self.fake_auth():
+        ret = self.client.get(f"/v2/{name}/manifests/latest")
+    self.assertEqual(ret.status_code, 200)
+    self.assertDictEqual(ret.get_json(), {'oi': 'nk'})
+    download_counter.flush()
+    self.assertEqual(Manifest.query.get(manifest_id).downloadCount, 2)
+
+  def test_manifest_cache_invalidate_tag(self):
+    image = _create_image()[0]
+    latest_tag = Tag(name='latest', image_ref=image)
+    manifest = Manifest(content='{"oi": "nk"}', container_ref=image.container_ref)
+    latest_tag.manifest_ref=manifest
+    db.session.add(latest_tag)
+    db.session.commit()
+    tag_id = latest_tag.id
+    container_id = image.container_id
+    name = f"{image.entityName}/{image.collectionName}/{image.containerName}"
+
+    with self.fake_auth():
+      ret = self.client.get(f"/v2/{name}/manifests/latest")
+    self.assertDictEqual(ret.get_json(), {'oi': 'nk'})
+
+    tag = Tag.query.get(tag_id)
+    tag.manifest_ref = Manifest(content='{"oi": "nk", "grunz": "z"}', container_id=container_id)
+    db.session.commit()
+    self.assertIsNone(manifest_cache.get(name, 'latest'))
+
+    with self.fake_auth():
+      ret = self.client.get(f"/v2/{name}/manifests/latest")
+    self.assertDictEqual(ret.get_json(), {'oi': 'nk', 'grunz': 'z'})
+
+  def test_manifest_cache_invalidate_delete(self):
+    image = _create_image()[0]
+    latest_tag = Tag(name='latest', image_ref=image)
+    manifest = Manifest(content='{"oi": "nk"}', container_ref=image.container_ref)
+    latest_tag.manifest_ref=manifest
+    db.session.add(latest_tag)
+    db.session.commit()
+    name = f"{image.entityName}/{image.collectionName}/{image.containerName}"
+    reference = f"sha256:{manifest.hash}"
+
+    with self.fake_auth():
+      ret = self.client.get(f"/v2/{name}/manifests/{reference}")
+    self.assertEqual(ret.status_code, 200)
+    self.assertIsNotNone(manifest_cache.get(name, reference))
+
+    with self.fake_admin_auth():
+      ret = self.client.delete(f"/v2/{name}/manifests/{reference}")
+    self.assertEqual(ret.status_code, 202)
+    self.assertIsNone(manifest_cache.get(name, reference))
+
+    with self.fake_auth():
+      ret = self.client.get(f"/v2/{name}/manifests/{reference}")
+    self.assertEqual(ret.status_code, 404)
     self.assertIsNone(manifest.latestDownload)
 
   def test_manifest_hash_notfound(self):
@@ -316,12 +473,195 @@ class TestOrasPull(RouteBase):
       ret = self.client.get(f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/blobs/sha256:{image.hash.replace('sha256.', '')}")
     self.assertEqual(ret.status_code, 200)
     self.assertEqual(ret.data, b'Hello Dorian!')
+    download_counter.flush()
     image = Image.query.get(image_id)
     self.assertEqual(image.downloadCount, 1)
     self.assertEqual(image.container_ref.downloadCount, 1)
     self.assertAlmostEqual(image.latestDownload, datetime.now(), delta=timedelta(seconds=2))
     self.assertAlmostEqual(image.container_ref.latestDownload, datetime.now(), delta=timedelta(seconds=2))
 
+  def _blob_url(self, image: Image) -> str:
+    return f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/blobs/sha256:{image.hash.replace('sha256.', '')}"
+
+  def test_blob_etag(self):
+    image = _create_image()[0]
+    image_id = image.id
+    file = _fake_img_file(image)
+    digest = image.hash.replace('sha256.', 'sha256:')
+    url = self._blob_url(image)
+
+    with self.fake_auth():
+      ret = self.client.get(url)
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(ret.headers.get('ETag'), f'"{digest}"')
+    self.assertEqual(ret.headers.get('Accept-Ranges'), 'bytes')
+    self.assertIn('immutable', ret.headers.get('Cache-Control'))
+    self.assertIsNone(ret.headers.get('Pragma'))
+    ret.close()
+
+    with self.fake_auth():
+      ret = self.client.get(url, headers={'If-None-Match': f'"{digest}"'})
+    self.assertEqual(ret.status_code, 304)
+
+    # revalidation is not a download
+    download_counter.flush()
+    image = Image.query.get(image_id)
+    self.assertEqual(image.downloadCount, 1)
+    self.assertEqual(image.container_ref.downloadCount, 1)
+
+  def test_blob_range(self):
+    image = _create_image()[0]
+    image_id = image.id
+    file = _fake_img_file(image)
+
+    with self.fake_auth():
+      ret = self.client.get(self._blob_url(image), headers={'Range': 'bytes=6-'})
+    self.assertEqual(ret.status_code, 206)
+    self.assertEqual(ret.data, b'Dorian!')
+    self.assertEqual(ret.headers.get('Content-Range'), 'bytes 6-12/13')
+    self.assertEqual(ret.headers.get('Docker-Content-Digest'), image.hash.replace('sha256.', 'sha256:'))
+    ret.close()
+    # resuming is not another download
+    download_counter.flush()
+    image = Image.query.get(image_id)
+    self.assertEqual(image.downloadCount, 0)
+
+    with self.fake_auth():
+      ret = self.client.get(self._blob_url(image), headers={'Range': 'bytes=0-4'})
+    self.assertEqual(ret.status_code, 206)
+    self.assertEqual(ret.data, b'Hello')
+    ret.close()
+    download_counter.flush()
+    image = Image.query.get(image_id)
+    self.assertEqual(image.downloadCount, 1)
+
+  def test_blob_range_invalid(self):
+    image = _create_image()[0]
+    file = _fake_img_file(image)
+
+    with self.fake_auth():
+      ret = self.client.get(self._blob_url(image), headers={'Range': 'bytes=100-200'})
+    self.assertEqual(ret.status_code, 416)
+    self.assertEqual(ret.headers.get('Content-Range'), 'bytes */13')
+
+    with self.fake_auth():
+      ret = self.client.get(self._blob_url(image), headers={'Range': 'bytes=100-200,300-'})
+    self.assertEqual(ret.status_code, 416)
+    self.assertEqual(ret.headers.get('Content-Range'), 'bytes */13')
+
+  def test_blob_if_range(self):
+    image = _create_image()[0]
+    file = _fake_img_file(image)
+    digest = image.hash.replace('sha256.', 'sha256:')
+
+    with self.fake_auth():
+      ret = self.client.get(self._blob_url(image), headers={'Range': 'bytes=6-', 'If-Range': f'"{digest}"'})
+    self.assertEqual(ret.status_code, 206)
+    self.assertEqual(ret.data, b'Dorian!')
+    ret.close()
+
+    for if_range in ['"sha256:nope"', 'Wed, 21 Oct 2015 07:28:00 GMT']:
+      for range in ['bytes=6-', 'bytes=0-4,6-']:
+        with self.fake_auth():
+          ret = self.client.get(self._blob_url(image), headers={'Range': range, 'If-Range': if_range})
+        self.assertEqual(ret.status_code, 200, f"{range} {if_range}")
+        self.assertEqual(ret.data, b'Hello Dorian!')
+        ret.close()
+
+  def test_blob_multirange(self):
+    image = _create_image()[0]
+    file = _fake_img_file(image)
+
+    with self.fake_auth():
+      ret = self.client.get(self._blob_url(image), headers={'Range': 'bytes=0-4,6-9,-1'})
+    self.assertEqual(ret.status_code, 206)
+    content_type = ret.headers.get('Content-Type')
+    self.assertRegex(content_type, r'^multipart/byteranges; boundary=')
+    boundary = content_type.split('boundary=')[1]
+    self.assertEqual(int(ret.headers.get('Content-Length')), len(ret.data))
+    parts = ret.data.split(f"--{boundary}".encode('ascii'))
+    self.assertEqual(parts[0], b'')
+    self.assertEqual(parts[-1], b'--\r\n')
+    self.assertListEqual([ part.split(b'\r\n\r\n', 1)[1] for part in parts[1:-1] ], [ b'Hello\r\n', b'Dori\r\n', b'!\r\n' ])
+    self.assertIn(b'Content-Range: bytes 0-4/13', parts[1])
+    self.assertIn(b'Content-Range: bytes 6-9/13', parts[2])
+    self.assertIn(b'Content-Range: bytes 12-12/13', parts[3])
+    ret.close()
+
+  def test_blob_multirange_too_many(self):
+    image = _create_image()[0]
+    file = _fake_img_file(image, data=b'oink'*10)
+
+    with self.fake_auth():
+      ret = self.client.get(self._blob_url(image), headers={'Range': 'bytes='+','.join(f"{i*2}-{i*2}" for i in range(20))})
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(ret.data, b'oink'*10)
+    ret.close()
+
+  def _stored_img_file(self, image: Image, data=b"Hello Dorian!") -> str:
+    self.app.config['IMAGE_PATH'] = tempfile.mkdtemp()
+    path = os.path.join(self.app.config['IMAGE_PATH'], '_imgs', 'o', 'i', 'sha256.oink')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as fh:
+      fh.write(data)
+    image.location = path
+    image.size = len(data)
+    image.uploadState = UploadStates.completed
+    db.session.commit()
+    return path
+
+  def test_blob_offload_nginx(self):
+    image = _create_image()[0]
+    image_id = image.id
+    self._stored_img_file(image)
+    self.app.config['DOWNLOAD_OFFLOAD'] = 'nginx'
+    self.app.config['DOWNLOAD_OFFLOAD_LOCATION'] = '/internal/imgs/'
+
+    with self.fake_auth():
+      ret = self.client.get(self._blob_url(image))
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(ret.headers.get('X-Accel-Redirect'), '/internal/imgs/o/i/sha256.oink')
+    self.assertEqual(ret.headers.get('Docker-Content-Digest'), 'sha256:oink')
+    self.assertEqual(ret.headers.get('ETag'), '"sha256:oink"')
+    self.assertEqual(ret.data, b'')
+    download_counter.flush()
+    image = Image.query.get(image_id)
+    self.assertEqual(image.downloadCount, 1)
+
+  def test_blob_offload_sendfile(self):
+    image = _create_image()[0]
+    path = self._stored_img_file(image)
+    self.app.config['DOWNLOAD_OFFLOAD'] = 'x-sendfile'
+
+    with self.fake_auth():
+      ret = self.client.get(self._blob_url(image))
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(ret.headers.get('X-Sendfile'), path)
+    self.assertEqual(ret.data, b'')
+
+  def test_blob_offload_outside(self):
+    image = _create_image()[0]
+    file = _fake_img_file(image)
+    self.app.config['IMAGE_PATH'] = tempfile.mkdtemp()
+    self.app.config['DOWNLOAD_OFFLOAD'] = 'nginx'
+
+    with self.fake_auth():
+      ret = self.client.get(self._blob_url(image))
+    self.assertEqual(ret.status_code, 200)
+    self.assertIsNone(ret.headers.get('X-Accel-Redirect'))
+    self.assertEqual(ret.data, b'Hello Dorian!')
+    ret.close()
+
+  def test_blob_offload_not_modified(self):
+    image = _create_image()[0]
+    self._stored_img_file(image)
+    self.app.config['DOWNLOAD_OFFLOAD'] = 'nginx'
+
+    with self.fake_auth():
+      ret = self.client.get(self._blob_url(image), headers={'If-None-Match': '"sha256:oink"'})
+    self.assertEqual(ret.status_code, 304)
+    self.assertIsNone(ret.headers.get('X-Accel-Redirect'))
+
   def test_blob_head_no_increment(self):
     image = _create_image()[0]
     image_id = image.id
@@ -330,12 +670,43 @@ class TestOrasPull(RouteBase):
     with self.fake_auth():
       ret = self.client.head(f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/blobs/sha256:{image.hash.replace('sha256.', '')}")
     self.assertEqual(ret.status_code, 200)
+    download_counter.flush()
     image = Image.query.get(image_id)
     self.assertEqual(image.downloadCount, 0)
     self.assertEqual(image.container_ref.downloadCount, 0)
     self.assertIsNone(image.latestDownload)
     self.assertIsNone(image.container_ref.latestDownload)
 
+  def test_blob_head(self):
+    image = _create_image()[0]
+    file = _fake_img_file(image)
+    url = self._blob_url(image)
+
+    with self.fake_auth(), mock.patch('Hinkskalle.routes.util.send_file') as send_mock, mock.patch('os.path.getsize') as size_mock:
+      ret = self.client.head(url)
+      self.assertEqual(ret.status_code, 200)
+      self.assertEqual(ret.headers.get('Content-Length'), str(len(b'Hello Dorian!')))
+      self.assertEqual(ret.headers.get('Content-Type'), 'application/octet-stream')
+      self.assertEqual(ret.headers.get('Docker-Content-Digest'), 'sha256:oink')
+      self.assertEqual(ret.headers.get('ETag'), '"sha256:oink"')
+      self.assertEqual(ret.data, b'')
+
+      ret = self.client.head(url, headers={'If-None-Match': '"sha256:oink"'})
+      self.assertEqual(ret.status_code, 304)
+    send_mock.assert_not_called()
+    size_mock.assert_not_called()
+
+  def test_blob_head_no_size(self):
+    image = _create_image()[0]
+    file = _fake_img_file(image)
+    image.size = None
+    db.session.commit()
+
+    with self.fake_auth():
+      ret = self.client.head(self._blob_url(image))
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(ret.headers.get('Content-Length'), str(len(b'Hello Dorian!')))
+
   def test_blob_not_uploaded(self):
     image = _create_image()[0]
     image_id = image.id
@@ -349,6 +720,24 @@ class TestOrasPull(RouteBase):
     file = _fake_img_file(image)
 
     ret = self.client.get(f"/v2/{image.entityName}/{image.collectionName}/{image.containerName}/blobs/sha256:{image.hash.replace('sha256.', '')}")
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(ret.data, b'Hello Dorian!')
+
+  def test_blob_noauth_private(self):
+    image, container, _, _ = _create_image()
+    container.private = True
+    file = _fake_img_file(image)
+
+    ret = self.client.get(self._blob_url(image))
+    self.assertEqual(ret.status_code, 401)
+    self.assertIn('bearer realm=', ret.headers.get('WWW-Authenticate'))
+
+    with self.fake_admin_auth():
+      ret = self.client.get(self._blob_url(image))
+    self.assertEqual(ret.status_code, 200)
+    ret.close()
+
+    ret = self.client.head(self._blob_url(image))
     self.assertEqual(ret.status_code, 401)
 
   def test_blob_private(self):
@@ -11,7 +11,7 @@ import os
 import json
 
 from Hinkskalle.tests.route_base import RouteBase
-from Hinkskalle.tests._util import _create_image, _create_container, _prepare_img_data, _create_user
+from Hinkskalle.tests._util import _create_image, _create_container, _prepare_img_data, _create_user, _fake_img_file
 
 from Hinkskalle import db
 from Hinkskalle.models import Manifest, ImageUploadUrl, UploadStates, UploadTypes, User
@@ -213,6 +213,103 @@ class TestOrasPush(RouteBase):
       ret = self.client.post(f"/v2/{image1.entityName}/{image1.collectionName}/{image1.containerName}/blobs/uploads/?mount={image2.hash.replace('sha256.', 'sha256:')}oink&from={image2.entityName}/{image2.collectionName}/{image2.containerName}")
     self.assertEqual(ret.status_code, 404)
 
+  def _existing_blob(self):
+    img_data, digest = _prepare_img_data()
+    from_image = _create_image(postfix='from', hash=digest, uploadState=UploadStates.completed, media_type='application/octet-stream')[0]
+    self._tmpf = _fake_img_file(from_image, data=img_data)
+    from_image.size = len(img_data)
+    entity = Entity(name=self.username, owner=self.user)
+    collection = Collection(name='to', entity_ref=entity, owner=self.user)
+    container = Container(name='to', collection_ref=collection, owner=self.user)
+    db.session.add(container)
+    db.session.commit()
+    return from_image, container, img_data, digest.replace('sha256.', 'sha256:')
+
+  def test_push_monolith_auto_mount(self):
+    from_image, container, img_data, digest = self._existing_blob()
+    from_location = from_image.location
+    container_id = container.id
+    user_id = self.user.id
+
+    with self.fake_auth():
+      ret = self.client.post(f"/v2/{container.entityName}/{container.collectionName}/{container.name}/blobs/uploads/?digest={digest}")
+    self.assertEqual(ret.status_code, 201)
+    self.assertEqual(ret.headers.get('Docker-Content-Digest'), digest)
+    self.assertRegex(ret.headers.get('location', ''), rf'/blobs/{digest}$')
+
+    new_image = Image.query.filter(Image.hash==digest.replace('sha256:', 'sha256.'), Image.container_id==container_id).one()
+    self.assertEqual(new_image.uploadState, UploadStates.completed)
+    self.assertEqual(new_image.location, from_location)
+    self.assertEqual(new_image.size, len(img_data))
+    self.assertEqual(new_image.media_type, 'application/octet-stream')
+    self.assertEqual(ImageUploadUrl.query.count(), 0)
+    self.assertEqual(User.query.get(user_id).used_quota, len(img_data))
+
+  def test_push_monolith_auto_mount_single_post(self):
+    from_image, container, img_data, digest = self._existing_blob()
+    from_location = from_image.location
+    container_id = container.id
+
+    with self.fake_auth():
+      ret = self.client.post(f"/v2/{container.entityName}/{container.collectionName}/{container.name}/blobs/uploads/?digest={digest}", data=img_data, content_type='application/octet-stream')
+    self.assertEqual(ret.status_code, 201)
+    new_image = Image.query.filter(Image.hash==digest.replace('sha256:', 'sha256.'), Image.container_id==container_id).one()
+    self.assertEqual(new_image.location, from_location)
+
+  def test_push_monolith_auto_mount_same_container(self):
+    from_image, _, img_data, digest = self._existing_blob()
+    from_image_id = from_image.id
+    from_image.container_ref.owner = self.user
+    db.session.commit()
+
+    with self.fake_auth():
+      ret = self.client.post(f"/v2/{from_image.entityName}/{from_image.collectionName}/{from_image.containerName}/blobs/uploads/?digest={digest}")
+    self.assertEqual(ret.status_code, 201)
+    self.assertEqual(Image.query.filter(Image.hash==digest.replace('sha256:', 'sha256.')).one().id, from_image_id)
+
+  def test_push_monolith_auto_mount_private(self):
+    from_image, container, img_data, digest = self._existing_blob()
+    from_image.container_ref.private = True
+    container_id = container.id
+    db.session.commit()
+
+    with self.fake_auth():
+      ret = self.client.post(f"/v2/{container.entityName}/{container.collectionName}/{container.name}/blobs/uploads/?digest={digest}")
+    self.assertEqual(ret.status_code, 202)
+    self.assertIsNone(Image.query.filter(Image.hash==digest.replace('sha256:', 'sha256.'), Image.container_id==container_id).first())
+
+  def test_push_monolith_auto_mount_private_collection(self):
+    from_image, container, img_data, digest = self._existing_blob()
+    from_image.container_ref.collection_ref.private = True
+    from_image.container_ref.private = False
+    container_id = container.id
+    db.session.commit()
+
+    with self.fake_auth():
+      ret = self.client.post(f"/v2/{container.entityName}/{container.collectionName}/{container.name}/blobs/uploads/?digest={digest}")
+    self.assertEqual(ret.status_code, 202)
+    self.assertIsNone(Image.query.filter(Image.hash==digest.replace('sha256:', 'sha256.'), Image.container_id==container_id, Image.uploadState==UploadStates.completed).first())
+
+  def test_push_monolith_auto_mount_incomplete(self):
+    from_image, container, img_data, digest = self._existing_blob()
+    from_image.uploadState = UploadStates.initialized
+    db.session.commit()
+
+    with self.fake_auth():
+      ret = self.client.post(f"/v2/{container.entityName}/{container.collectionName}/{container.name}/blobs/uploads/?digest={digest}")
+    self.assertEqual(ret.status_code, 202)
+
+  def test_push_monolith_auto_mount_quota(self):
+    from_image, container, img_data, digest = self._existing_blob()
+    self.user.quota = len(img_data)-1
+    db.session.commit()
+
+    with self.fake_auth():
+      ret = self.client.post(f"/v2/{container.entityName}/{container.collectionName}/{container.name}/blobs/uploads/?digest={digest}")
+    self.assertEqual(ret.status_code, 413)
+    self.user.quota = 0
+    db.session.commit()
+
   def test_push_monolith_get_session_existing(self):
     _, container, collection, entity = _create_image(postfix='1')
     with self.fake_admin_auth():
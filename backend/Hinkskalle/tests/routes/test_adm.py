@@ -183,6 +183,19 @@ class TestAdm(RouteBase):
       ret = self.client.get(f"/v1/ldap/status")
     self.assertEqual(ret.status_code, 403)
 
+  def test_token_cache_status(self):
+    with self.fake_admin_auth():
+      ret = self.client.get(f"/v1/token-cache/status")
+    self.assertEqual(ret.status_code, 200)
+    data = ret.get_json().get('data')
+    self.assertTrue(data['enabled'])
+    for key in ['ttl', 'maxSize', 'size', 'hits', 'misses']:
+      self.assertIn(key, data)
+
+  def test_token_cache_status_user(self):
+    with self.fake_auth():
+      ret = self.client.get(f"/v1/token-cache/status")
+    self.assertEqual(ret.status_code, 403)
   
   def test_get_job(self):
     from Hinkskalle.util.jobs import sync_ldap
@@ -4,14 +4,16 @@ import typing
 from flask import g, session
 from ..route_base import RouteBase
 
-from .._util import _create_user
+from .._util import _create_user, _create_image, _fake_img_file
 from Hinkskalle.models.User import Token, PassKey, User
 from Hinkskalle.models.Entity import Entity
+from Hinkskalle.models.Image import UploadStates
 from Hinkskalle import db
 from webauthn.helpers.base64url_to_bytes import base64url_to_bytes
 import re
 import jwt
 import base64
+from unittest import mock
 
 class TestPasswordAuth(RouteBase):
   def test_password(self):
@@ -82,6 +84,43 @@ class TestPasswordAuth(RouteBase):
       self.assertEqual(ret.status_code, 401)
       self.assertIsNone(g.get('authenticated_user'))
     
+  def test_password_fail_cached(self):
+    user = _create_user(name='oink.hase')
+    user.set_password('supergeheim')
+    db.session.commit()
+
+    with mock.patch('Hinkskalle.models.User.User.check_password', return_value=False) as check_mock:
+      for _ in range(3):
+        ret = self.client.post('/v1/get-token', json={ 'username': user.username, 'password': 'superfalsch' } )
+        self.assertEqual(ret.status_code, 401)
+    check_mock.assert_called_once()
+
+  def test_password_fail_throttled(self):
+    self.app.config['AUTH_THROTTLE_BURST'] = 2
+    user = _create_user(name='oink.hase')
+    user.set_password('supergeheim')
+    db.session.commit()
+
+    for i in range(2):
+      ret = self.client.post('/v1/get-token', json={ 'username': user.username, 'password': f'superfalsch{i}' } )
+      self.assertEqual(ret.status_code, 401)
+    ret = self.client.post('/v1/get-token', json={ 'username': user.username, 'password': 'superfalsch3' } )
+    self.assertEqual(ret.status_code, 429)
+    self.assertGreater(ret.get_json()['retryAfter'], 0)
+
+    # this client is done, no more hashing for it
+    with mock.patch('Hinkskalle.models.User.User.check_password') as check_mock:
+      ret = self.client.post('/v1/get-token', json={ 'username': user.username, 'password': 'supergeheim' } )
+    self.assertEqual(ret.status_code, 429)
+    check_mock.assert_not_called()
+
+    # nobody can lock out the real user
+    ret = self.client.post('/v1/get-token', json={ 'username': user.username, 'password': 'supergeheim' }, environ_base={ 'REMOTE_ADDR': '10.0.0.2' })
+    self.assertEqual(ret.status_code, 200)
+    # but the username bucket is empty for failures
+    ret = self.client.post('/v1/get-token', json={ 'username': user.username, 'password': 'superfalsch4' }, environ_base={ 'REMOTE_ADDR': '10.0.0.3' })
+    self.assertEqual(ret.status_code, 429)
+
   def test_password_user_not_found(self):
     with self.app.test_client() as c:
       ret = c.post('/v1/get-token', json={ 'username': 'gits.net', 'password': 'superfalsch' } )
@@ -156,6 +195,92 @@ class TestDownloadToken(RouteBase):
     ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'manifest', 'id': '1' })
     self.assertEqual(ret.status_code, 401)
 
+  def _signed_location(self, ret) -> dict:
+    self.assertEqual(ret.status_code, 202)
+    location = ret.headers.get('Location', '')
+    temp_token = typing.cast(re.Match, re.search(r'(.*)\?temp_token=(.*)', location))
+    self.assertTrue(temp_token[1].endswith('/v1/downloads'))
+    return jwt.decode(temp_token[2], self.app.config['SECRET_KEY'], algorithms=["HS256"])
+
+  def test_get_download_token_image(self):
+    image = _create_image()[0]
+    tmpf = _fake_img_file(image)
+    image_id, container_id, hash = image.id, image.container_id, image.hash
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'image', 'id': str(image_id) })
+    decoded = self._signed_location(ret)
+    self.assertEqual(decoded.get('type'), 'image')
+    self.assertEqual(decoded.get('id'), image_id)
+    self.assertEqual(decoded.get('container'), container_id)
+    self.assertEqual(decoded.get('location'), tmpf.name)
+    self.assertEqual(decoded.get('size'), len(b'Hello Dorian!'))
+    self.assertEqual(decoded.get('digest'), hash)
+    self.assertEqual(decoded.get('username'), self.admin_username)
+
+  def test_get_download_token_blob(self):
+    image = _create_image()[0]
+    tmpf = _fake_img_file(image)
+    image_id = image.id
+    name = f"{image.entityName}/{image.collectionName}/{image.containerName}"
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'blob', 'id': f"{name}@sha256:oink" })
+    decoded = self._signed_location(ret)
+    self.assertEqual(decoded.get('type'), 'blob')
+    self.assertEqual(decoded.get('id'), image_id)
+
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'blob', 'id': f"{name}@sha256:grunz" })
+    self.assertEqual(ret.status_code, 404)
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'blob', 'id': f"{name}" })
+    self.assertEqual(ret.status_code, 406)
+
+  def test_get_download_token_image_not_uploaded(self):
+    image = _create_image()[0]
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'image', 'id': str(image.id) })
+    self.assertEqual(ret.status_code, 404)
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'image', 'id': 'oink' })
+    self.assertEqual(ret.status_code, 404)
+
+  def test_get_download_token_image_denied(self):
+    image, container, collection, entity = _create_image()
+    container.private = True
+    container.owner = self.other_user
+    collection.owner = self.other_user
+    entity.owner = self.other_user
+    tmpf = _fake_img_file(image)
+    image_id = image.id
+    with self.fake_auth():
+      ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'image', 'id': str(image_id) })
+    self.assertEqual(ret.status_code, 403)
+
+    # handout token for a user without access
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'image', 'id': str(image_id), 'username': self.username })
+    self.assertEqual(ret.status_code, 403)
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'image', 'id': str(image_id), 'username': 'oink' })
+    self.assertEqual(ret.status_code, 406)
+
+  def test_get_download_token_private_collection(self):
+    image, container, collection, entity = _create_image(uploadState=UploadStates.completed)
+    collection.private = True
+    container.owner = self.other_user
+    collection.owner = self.other_user
+    entity.owner = self.other_user
+    db.session.commit()
+    tmpf = _fake_img_file(image)
+    image_id = image.id
+    blob_id = f"{image.entityName}/{image.collectionName}/{image.containerName}@{image.hash.replace('sha256.', 'sha256:')}"
+
+    with self.fake_auth():
+      ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'image', 'id': str(image_id) })
+      self.assertEqual(ret.status_code, 403)
+      ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'blob', 'id': blob_id })
+      self.assertEqual(ret.status_code, 403)
+
   def test_get_download_token_invalid_type(self):
     with self.fake_admin_auth():
       ret = self.client.post(f"/v1/get-download-token", json={ 'type': 'oink', 'id': '1' })
@@ -270,6 +395,10 @@ class TestTokenAuth(RouteBase):
     ret = self.client.get('/v1/search?value=grunz', headers={ 'Authorization': f"bearer {token_text}"})
     self.assertEqual(ret.status_code, 200)
 
+    # refresh is written behind
+    from Hinkskalle.util.jobs import flush_token_refreshes
+    flush_token_refreshes()
+
     db_token = Token.query.get(token.id)
     self.assertLess(abs(db_token.expiresAt - (datetime.datetime.now()+Token.defaultExpiration)), datetime.timedelta(minutes=1))
 
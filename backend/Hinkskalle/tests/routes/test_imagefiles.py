@@ -2,6 +2,9 @@ import os.path
 import tempfile
 from tempfile import mkdtemp
 from datetime import datetime, timedelta
+from calendar import timegm
+from unittest import mock
+import jwt
 
 from ..route_base import RouteBase
 from .._util import _create_image, _fake_img_file, _prepare_img_data, _create_user, _create_group
@@ -10,6 +13,7 @@ from Hinkskalle.models import Image, Tag, Container, UploadStates, User
 from Hinkskalle.models.Entity import Entity
 from Hinkskalle.routes.imagefiles import _check_quota
 from Hinkskalle import db
+from Hinkskalle.util.counters import download_counter
 
 class TestImagefiles(RouteBase):
 
@@ -30,6 +34,114 @@ class TestImagefiles(RouteBase):
     self.assertEqual(fn, f"{self.app.config.get('IMAGE_PATH')}/_imgs/sha256.oink.sif")
 
 
+  def test_pull_range(self):
+    image, container, _, _ = _create_image()
+    latest_tag = Tag(name='latest', image_ref=image)
+    db.session.commit()
+    image_id = image.id
+
+    tmpf = _fake_img_file(image)
+
+    ret = self.client.get(f"/v1/imagefile/{image.entityName}/{image.collectionName}/{image.containerName}:{latest_tag.name}", headers={'Range': 'bytes=6-'})
+    self.assertEqual(ret.status_code, 206)
+    self.assertEqual(ret.data, b"Dorian!")
+    self.assertEqual(ret.headers.get('ETag'), f'"{image.hash.replace("sha256.", "sha256:")}"')
+    # pulls by tag must be revalidated
+    self.assertIn('no-cache', ret.headers.get('Cache-Control'))
+    ret.close()
+    download_counter.flush()
+    db_image: Image = Image.query.get(image_id)
+    self.assertEqual(db_image.downloadCount, 0)
+
+  def test_pull_not_modified(self):
+    image, container, _, _ = _create_image()
+    latest_tag = Tag(name='latest', image_ref=image)
+    db.session.commit()
+    image_id = image.id
+
+    tmpf = _fake_img_file(image)
+
+    ret = self.client.get(f"/v1/imagefile/{image.entityName}/{image.collectionName}/{image.containerName}:{latest_tag.name}", headers={'If-None-Match': f'"{image.hash.replace("sha256.", "sha256:")}"'})
+    self.assertEqual(ret.status_code, 304)
+    download_counter.flush()
+    db_image: Image = Image.query.get(image_id)
+    self.assertEqual(db_image.downloadCount, 0)
+    self.assertEqual(db_image.container_ref.downloadCount, 0)
+
+  def _signed_url(self, image: Image, type: str='image', **override) -> str:
+    token = jwt.encode({
+      'id': image.id,
+      'container': image.container_id,
+      'type': type,
+      'username': self.username,
+      'location': image.location,
+      'size': image.size,
+      'digest': image.hash,
+      'exp': timegm(datetime.utcnow().utctimetuple())+60,
+      **override,
+    }, self.app.config['SECRET_KEY'], algorithm="HS256")
+    return f"/v1/downloads?temp_token={token}"
+
+  def test_download_signed(self):
+    image = _create_image()[0]
+    tmpf = _fake_img_file(image)
+    image_id = image.id
+    url = self._signed_url(image)
+
+    with mock.patch.object(Image, 'query') as query_mock:
+      ret = self.client.get(url)
+      self.assertEqual(ret.status_code, 200)
+      self.assertEqual(ret.data, b"Hello Dorian!")
+      self.assertEqual(ret.headers.get('Docker-Content-Digest'), 'sha256:oink')
+      ret.close()
+      ret = self.client.head(url)
+      self.assertEqual(ret.status_code, 200)
+      self.assertEqual(ret.headers.get('Content-Length'), str(len(b"Hello Dorian!")))
+    query_mock.assert_not_called()
+
+    download_counter.flush()
+    db_image = Image.query.get(image_id)
+    self.assertEqual(db_image.downloadCount, 1)
+    self.assertEqual(db_image.container_ref.downloadCount, 1)
+
+  def test_download_signed_not_modified(self):
+    image = _create_image()[0]
+    tmpf = _fake_img_file(image)
+    image_id = image.id
+
+    ret = self.client.get(self._signed_url(image, type='blob'), headers={'If-None-Match': '"sha256:oink"'})
+    self.assertEqual(ret.status_code, 304)
+    download_counter.flush()
+    db_image = Image.query.get(image_id)
+    self.assertEqual(db_image.downloadCount, 0)
+
+  def test_download_signed_range(self):
+    image = _create_image()[0]
+    tmpf = _fake_img_file(image)
+    ret = self.client.get(self._signed_url(image, type='blob'), headers={'Range': 'bytes=6-'})
+    self.assertEqual(ret.status_code, 206)
+    self.assertEqual(ret.data, b"Dorian!")
+    ret.close()
+
+  def test_download_signed_invalid(self):
+    image = _create_image()[0]
+    tmpf = _fake_img_file(image)
+
+    ret = self.client.get(f"/v1/downloads")
+    self.assertEqual(ret.status_code, 401)
+    ret = self.client.get(f"/v1/downloads?temp_token=oink")
+    self.assertEqual(ret.status_code, 401)
+    ret = self.client.get(self._signed_url(image, exp=timegm(datetime.utcnow().utctimetuple())-60))
+    self.assertEqual(ret.status_code, 401)
+    ret = self.client.get(self._signed_url(image, type='manifest'))
+    self.assertEqual(ret.status_code, 406)
+    ret = self.client.get(self._signed_url(image, location='/oink/nonexistent'))
+    self.assertEqual(ret.status_code, 404)
+
+    token = jwt.encode({ 'type': 'image', 'location': image.location, 'digest': image.hash }, 'geheim', algorithm="HS256")
+    ret = self.client.get(f"/v1/downloads?temp_token={token}")
+    self.assertEqual(ret.status_code, 401)
+
   def test_pull(self):
     image, container, _, _ = _create_image()
     latest_tag = Tag(name='latest', image_ref=image)
@@ -40,6 +152,7 @@ class TestImagefiles(RouteBase):
     ret = self.client.get(f"/v1/imagefile/{image.entityName}/{image.collectionName}/{image.containerName}:{latest_tag.name}")
     self.assertEqual(ret.status_code, 200)
     self.assertEqual(ret.data, b"Hello Dorian!")
+    download_counter.flush()
     db_container = Container.query.get(container.id)
     self.assertEqual(db_container.downloadCount, 1)
     self.assertAlmostEqual(db_container.latestDownload, datetime.now(), delta=timedelta(seconds=2))
@@ -55,6 +168,7 @@ class TestImagefiles(RouteBase):
 
     ret = self.client.get(ret.headers.get('Location'))
     self.assertEqual(ret.data, b"Hello Dorian!")
+    download_counter.flush()
     db_container = Container.query.get(container.id)
     self.assertEqual(db_container.downloadCount, 2)
     db_image: Image = Image.query.get(image.id)
@@ -63,6 +177,7 @@ class TestImagefiles(RouteBase):
     ret.close() # avoid unclosed filehandle warning
 
     ret = self.client.head(f"/v1/imagefile/{image.entityName}/{image.collectionName}/{image.containerName}:{latest_tag.name}")
+    download_counter.flush()
     db_container = Container.query.get(container.id)
     self.assertEqual(db_container.downloadCount, 2)
     db_image = Image.query.get(image.id)
@@ -8,9 +8,9 @@ import os.path
 
 
 from ..route_base import RouteBase
-from .._util import _create_image, _create_user
+from .._util import _create_image, _create_user, _fake_img_file
 
-from Hinkskalle.models import Image, ImageUploadUrl, UploadStates, UploadTypes, User
+from Hinkskalle.models import Image, ImageUploadUrl, UploadStates, UploadTypes, User, Collection, Container
 from Hinkskalle import db
 
 
@@ -74,6 +74,122 @@ class TestImagefilesV2(RouteBase):
       ret = self.client.post(f"/v2/imagefile/{image.id}", json=img_data)
     self.assertEqual(ret.status_code, 406)
   
+  def _existing_image(self, **kwargs):
+    img_data, digest = _prepare_img_data()
+    existing = _create_image(postfix='from', hash=digest, **kwargs)[0]
+    self._tmpf = _fake_img_file(existing, data=img_data)
+    return existing, img_data, digest
+
+  def test_push_v2_single_dedup(self):
+    existing, img_data, digest = self._existing_image()
+    existing_location = existing.location
+    user = _create_user()
+    user_id = user.id
+    image = _create_image(postfix='to', hash=digest, owner=user)[0]
+    image_id = image.id
+
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v2/imagefile/{image.id}", json={ 'filesize': len(img_data), 'sha256sum': digest.replace('sha256.', '') })
+    self.assertEqual(ret.status_code, 200)
+    upload_id = urlparse(ret.get_json()['data']['uploadURL']).path.split('/').pop()
+    db_upload = ImageUploadUrl.query.get(upload_id)
+    self.assertEqual(db_upload.state, UploadStates.completed)
+
+    read_image = Image.query.get(image_id)
+    self.assertEqual(read_image.uploadState, UploadStates.completed)
+    self.assertEqual(read_image.location, existing_location)
+    self.assertEqual(read_image.size, len(img_data))
+    self.assertIn('latest', read_image.container_ref.imageTags)
+    self.assertEqual(User.query.get(user_id).used_quota, len(img_data))
+
+    # clients PUT anyway, nothing is stored
+    ret = self.client.put(f"/v2/imagefile/_upload/{upload_id}", data=img_data)
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(ret.headers.get('ETag'), digest.replace('sha256.', ''))
+    with self.fake_admin_auth():
+      ret = self.client.put(f"/v2/imagefile/{image_id}/_complete", json={})
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(ret.get_json()['data']['quota']['quotaUsage'], len(img_data))
+    self.assertEqual(Image.query.get(image_id).location, existing_location)
+
+  def test_push_v2_single_dedup_mismatch(self):
+    existing, img_data, digest = self._existing_image()
+    image = _create_image(postfix='to', hash=digest)[0]
+    image_id = image.id
+
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v2/imagefile/{image.id}", json={ 'filesize': len(img_data)+1, 'sha256sum': digest.replace('sha256.', '') })
+    self.assertEqual(ret.status_code, 200)
+    upload_id = urlparse(ret.get_json()['data']['uploadURL']).path.split('/').pop()
+    self.assertEqual(ImageUploadUrl.query.get(upload_id).state, UploadStates.initialized)
+    self.assertEqual(Image.query.get(image_id).uploadState, UploadStates.initialized)
+
+    other_image = _create_image(postfix='other', hash='sha256.oink')[0]
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v2/imagefile/{other_image.id}", json={ 'filesize': len(img_data), 'sha256sum': digest.replace('sha256.', '') })
+    self.assertEqual(ret.status_code, 200)
+    upload_id = urlparse(ret.get_json()['data']['uploadURL']).path.split('/').pop()
+    self.assertEqual(ImageUploadUrl.query.get(upload_id).state, UploadStates.initialized)
+
+  def test_push_v2_single_dedup_private(self):
+    existing, img_data, digest = self._existing_image()
+    existing.container_ref.private = True
+    entity = Entity(name=self.username, owner=self.user)
+    container = Container(name='to', collection_ref=Collection(name='to', entity_ref=entity, owner=self.user), owner=self.user)
+    image = Image(container_ref=container, hash=digest, owner=self.user, uploadState=UploadStates.initialized)
+    db.session.add(image)
+    db.session.commit()
+    image_id = image.id
+
+    with self.fake_auth():
+      ret = self.client.post(f"/v2/imagefile/{image.id}", json={ 'filesize': len(img_data), 'sha256sum': digest.replace('sha256.', '') })
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(Image.query.get(image_id).uploadState, UploadStates.initialized)
+
+  def test_push_v2_single_dedup_private_collection(self):
+    existing, img_data, digest = self._existing_image()
+    existing.container_ref.collection_ref.private = True
+    entity = Entity(name=self.username, owner=self.user)
+    container = Container(name='to', collection_ref=Collection(name='to', entity_ref=entity, owner=self.user), owner=self.user)
+    image = Image(container_ref=container, hash=digest, owner=self.user, uploadState=UploadStates.initialized)
+    db.session.add(image)
+    db.session.commit()
+    image_id = image.id
+
+    with self.fake_auth():
+      ret = self.client.post(f"/v2/imagefile/{image.id}", json={ 'filesize': len(img_data), 'sha256sum': digest.replace('sha256.', '') })
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(Image.query.get(image_id).uploadState, UploadStates.initialized)
+    self.assertIsNone(Image.query.get(image_id).location)
+
+  def test_push_v2_single_dedup_quota(self):
+    user = _create_user()
+    existing, img_data, digest = self._existing_image(owner=user)
+    user.calculate_used()
+    # a second copy would not fit, but we don't need one
+    user.quota = len(img_data)+1
+    db.session.commit()
+    image = _create_image(postfix='to', hash=digest, owner=user)[0]
+    image_id = image.id
+
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v2/imagefile/{image.id}", json={ 'filesize': len(img_data), 'sha256sum': digest.replace('sha256.', '') })
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(Image.query.get(image_id).uploadState, UploadStates.completed)
+
+  def test_push_v2_single_dedup_quota_check(self):
+    existing, img_data, digest = self._existing_image()
+    user = _create_user()
+    user.quota = len(img_data)
+    image = _create_image(postfix='to', hash=digest, owner=user)[0]
+    image_id = image.id
+
+    with self.fake_admin_auth():
+      ret = self.client.post(f"/v2/imagefile/{image.id}", json={ 'filesize': len(img_data), 'sha256sum': digest.replace('sha256.', '') })
+    self.assertEqual(ret.status_code, 413)
+    self.assertEqual(Image.query.get(image_id).uploadState, UploadStates.initialized)
+    self.assertEqual(ImageUploadUrl.query.count(), 0)
+
   def test_push_v2_single_do(self):
     user = _create_user()
     image = _create_image(owner=user)[0]
@@ -450,6 +450,45 @@ class TestImages(RouteBase):
       'latest': str(other_image.id)
     })
 
+  def test_reuse_image_private(self):
+    image, container, collection, _ = _create_image()
+    image.uploadState=UploadStates.completed
+    image.location=__file__
+    image.size=999
+    collection.private = True
+    db.session.commit()
+    entity = Entity(name=self.username, owner=self.user)
+    other_container = Container(name='other', collection_ref=Collection(name='other', entity_ref=entity, owner=self.user), owner=self.user)
+    db.session.add(other_container)
+    db.session.commit()
+
+    with self.fake_auth():
+      ret = self.client.post('/v1/images', json={
+        'hash': image.hash,
+        'container': str(other_container.id),
+      })
+    self.assertEqual(ret.status_code, 200)
+    data = ret.get_json().get('data') # type: ignore
+    self.assertEqual(data['uploadState'], UploadStates.initialized.value)
+    self.assertIsNone(Image.query.get(data['id']).location)
+
+  def test_reuse_image_quota(self):
+    image, _, _, entity = _create_image()
+    image.uploadState=UploadStates.completed
+    image.location=__file__
+    image.size=999
+    db.session.commit()
+    entity_id = entity.id
+    other_container, _, _ = _create_container()
+    with self.fake_admin_auth():
+      ret = self.client.post('/v1/images', json={
+        'hash': image.hash,
+        'container': str(other_container.id),
+      })
+    self.assertEqual(ret.status_code, 200)
+    # same file, counted once
+    self.assertEqual(Entity.query.get(entity_id).used_quota, 999)
+
   def test_reuse_image_not_uploaded(self):
     image, _, _, _ = _create_image()
     image.uploadState = UploadStates.initialized
@@ -1,14 +1,17 @@
 from Hinkskalle import db
+from Hinkskalle.util.counters import download_counter
 
 from ..route_base import RouteBase
 from .._util import _fake_img_file, _create_image
 
 import jwt
+import os
+import tempfile
 from datetime import datetime
 from calendar import timegm
 
 from Hinkskalle.models.Manifest import Manifest
-from Hinkskalle.models.Image import Image
+from Hinkskalle.models.Image import Image, UploadStates
 
 class TestManifests(RouteBase):
   def test_list_noauth(self):
@@ -75,6 +78,7 @@ class TestManifests(RouteBase):
     with self.fake_admin_auth():
       ret = self.client.get(f"/v1/manifests/{manifest.id}/download")
     self.assertEqual(ret.status_code, 200)
+    download_counter.flush()
     image: Image = Image.query.get(image_id)
     self.assertEqual(ret.headers['Content-Disposition'], f'attachment; filename={image.containerName}')
     self.assertEqual(ret.headers['Content-Type'], 'application/octet-stream')
@@ -85,6 +89,43 @@ class TestManifests(RouteBase):
     manifest = Manifest.query.get(manifest_id)
     self.assertEqual(manifest.downloadCount, 1)
 
+  def test_download_range(self):
+    image = _create_image()[0]
+    image_id = image.id
+    tmpf = _fake_img_file(image, data=b'oink')
+    manifest = image.generate_manifest()
+    db.session.commit()
+
+    with self.fake_admin_auth():
+      ret = self.client.get(f"/v1/manifests/{manifest.id}/download", headers={'Range': 'bytes=2-'})
+    self.assertEqual(ret.status_code, 206)
+    self.assertEqual(ret.data, b'nk')
+    self.assertEqual(ret.headers.get('Content-Range'), 'bytes 2-3/4')
+    download_counter.flush()
+    image = Image.query.get(image_id)
+    self.assertEqual(image.downloadCount, 0)
+
+  def test_download_offload(self):
+    image = _create_image()[0]
+    self.app.config['IMAGE_PATH'] = tempfile.mkdtemp()
+    path = os.path.join(self.app.config['IMAGE_PATH'], '_imgs', 'sha256.oink')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as fh:
+      fh.write(b'oink')
+    image.location = path
+    image.uploadState = UploadStates.completed
+    manifest = image.generate_manifest()
+    db.session.commit()
+    filename = image.containerName
+    self.app.config['DOWNLOAD_OFFLOAD'] = 'nginx'
+
+    with self.fake_admin_auth():
+      ret = self.client.get(f"/v1/manifests/{manifest.id}/download")
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(ret.headers.get('X-Accel-Redirect'), '/_imgs/sha256.oink')
+    self.assertEqual(ret.headers['Content-Disposition'], f'attachment; filename={filename}')
+    self.assertEqual(ret.data, b'')
+
   def test_download_not_found(self):
     image = _create_image()[0]
     tmpf = _fake_img_file(image, data=b'oink')
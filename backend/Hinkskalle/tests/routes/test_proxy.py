@@ -0,0 +1,196 @@
+import hashlib
+from tempfile import mkdtemp
+
+from ..route_base import RouteBase
+from .._upstream import StandInUpstream
+from .._util import _create_image, _fake_img_file
+
+from Hinkskalle import db
+from Hinkskalle.models import Container, Image, Manifest, UploadStates
+from Hinkskalle.util.proxy import pull_through
+
+class TestProxy(RouteBase):
+  layer = b"Hello Dorian!"
+  layer_digest = f"sha256:{hashlib.sha256(layer).hexdigest()}"
+
+  def setUp(self):
+    super().setUp()
+    self.app.config['IMAGE_PATH'] = mkdtemp()
+    self.app.config['PROXY_ENTITY'] = 'proxy'
+    self.app.config['PROXY_USERNAME'] = None
+    pull_through.upstream._tokens = {}
+
+  def _upstream(self, **kwargs) -> StandInUpstream:
+    upstream = StandInUpstream(**kwargs)
+    self.app.config['PROXY_UPSTREAM'] = upstream.url
+    return upstream
+
+  def test_manifest(self):
+    with self._upstream() as upstream:
+      digest = upstream.add_image('library/alpine', 'latest', [ (self.layer, 'application/vnd.oci.image.layer.v1.tar+gzip') ])
+      with self.fake_auth():
+        ret = self.client.get('/v2/proxy/library/alpine/manifests/latest')
+      self.assertEqual(ret.status_code, 200)
+      self.assertEqual(ret.headers.get('Docker-Content-Digest'), digest)
+      self.assertEqual(ret.data, upstream.manifests[('library/alpine', 'latest')])
+
+      manifest = Manifest.query.filter(Manifest.hash==digest.replace('sha256:', '')).one()
+      self.assertEqual(manifest.container_ref.entityName, 'proxy')
+      self.assertEqual(manifest.container_ref.collectionName, 'library')
+      self.assertEqual(manifest.container_ref.name, 'alpine')
+      tag = manifest.container_ref.get_tag('latest')
+      self.assertEqual(tag.manifest_ref, manifest)
+      # layers wait for their first pull
+      layer = tag.image_ref
+      self.assertEqual(layer.hash, self.layer_digest.replace('sha256:', 'sha256.'))
+      self.assertEqual(layer.uploadState, UploadStates.initialized)
+
+      # by digest, from here now
+      with self.fake_auth():
+        ret = self.client.get(f"/v2/proxy/library/alpine/manifests/{digest}")
+      self.assertEqual(ret.status_code, 200)
+      self.assertListEqual(upstream.requests, [ '/v2/library/alpine/manifests/latest' ])
+
+  def test_blob(self):
+    with self._upstream() as upstream:
+      upstream.add_image('library/alpine', 'latest', [ (self.layer, 'application/vnd.oci.image.layer.v1.tar+gzip') ])
+      with self.fake_auth():
+        ret = self.client.get('/v2/proxy/library/alpine/manifests/latest')
+        self.assertEqual(ret.status_code, 200)
+        for _ in range(2):
+          ret = self.client.get(f"/v2/proxy/library/alpine/blobs/{self.layer_digest}")
+          self.assertEqual(ret.status_code, 200)
+          self.assertEqual(ret.data, self.layer)
+          self.assertEqual(ret.headers.get('Docker-Content-Digest'), self.layer_digest)
+          ret.close()
+      self.assertEqual(upstream.requests.count(f"/v2/library/alpine/blobs/{self.layer_digest}"), 1)
+
+    image = Image.query.filter(Image.hash==self.layer_digest.replace('sha256:', 'sha256.')).one()
+    self.assertEqual(image.uploadState, UploadStates.completed)
+    self.assertEqual(image.size, len(self.layer))
+    self.assertEqual(image.media_type, 'application/vnd.oci.image.layer.v1.tar+gzip')
+    self.assertTrue(image.location.startswith(self.app.config['IMAGE_PATH']))
+
+  def test_blob_digest_mismatch(self):
+    with self._upstream() as upstream:
+      upstream.blobs[self.layer_digest] = b"Hello Oink!"
+      with self.fake_auth():
+        ret = self.client.get(f"/v2/proxy/library/alpine/blobs/{self.layer_digest}")
+      self.assertEqual(ret.status_code, 503)
+    self.assertIsNone(Image.query.filter(Image.hash==self.layer_digest.replace('sha256:', 'sha256.')).first())
+
+  def test_token(self):
+    with self._upstream(token='geheim') as upstream:
+      upstream.add_image('library/alpine', 'latest', [ (self.layer, 'application/vnd.oci.image.layer.v1.tar+gzip') ])
+      with self.fake_auth():
+        ret = self.client.get('/v2/proxy/library/alpine/manifests/latest')
+      self.assertEqual(ret.status_code, 200)
+      with self.fake_auth():
+        ret = self.client.get(f"/v2/proxy/library/alpine/blobs/{self.layer_digest}")
+      self.assertEqual(ret.status_code, 200)
+      ret.close()
+    # blob request reuses the token
+    self.assertEqual(upstream.requests.count('/token'), 1)
+
+  def test_unknown(self):
+    with self._upstream() as upstream:
+      with self.fake_auth():
+        ret = self.client.get('/v2/proxy/library/alpine/manifests/latest')
+        self.assertEqual(ret.status_code, 404)
+        self.assertEqual(ret.get_json()['errors'][0]['code'], 'MANIFEST_UNKNOWN')
+        ret = self.client.get(f"/v2/proxy/library/alpine/blobs/{self.layer_digest}")
+        self.assertEqual(ret.status_code, 404)
+        self.assertEqual(ret.get_json()['errors'][0]['code'], 'BLOB_UNKNOWN')
+    self.assertIsNone(Container.query.filter(Container.name=='alpine').first())
+
+  def test_unavailable(self):
+    upstream = self._upstream()
+    # not started
+    upstream.server.server_close()
+    with self.fake_auth():
+      ret = self.client.get('/v2/proxy/library/alpine/manifests/latest')
+    self.assertEqual(ret.status_code, 503)
+    self.assertEqual(ret.get_json()['errors'][0]['code'], 'UNAVAILABLE')
+
+  def test_anonymous(self):
+    with self._upstream() as upstream:
+      upstream.add_image('library/alpine', 'latest', [ (self.layer, 'application/vnd.oci.image.layer.v1.tar+gzip') ])
+      ret = self.client.get('/v2/proxy/library/alpine/manifests/latest')
+      self.assertEqual(ret.status_code, 401)
+      self.assertListEqual(upstream.requests, [])
+
+      # already here: no login needed
+      with self.fake_auth():
+        ret = self.client.get('/v2/proxy/library/alpine/manifests/latest')
+      self.assertEqual(ret.status_code, 200)
+      ret = self.client.get('/v2/proxy/library/alpine/manifests/latest')
+      self.assertEqual(ret.status_code, 200)
+
+  def test_other_entity(self):
+    with self._upstream() as upstream:
+      upstream.add_image('library/alpine', 'latest', [ (self.layer, 'application/vnd.oci.image.layer.v1.tar+gzip') ])
+      with self.fake_auth():
+        ret = self.client.get('/v2/oink/library/alpine/manifests/latest')
+      self.assertEqual(ret.status_code, 404)
+      self.assertListEqual(upstream.requests, [])
+
+  def test_disabled(self):
+    with self.fake_auth():
+      ret = self.client.get('/v2/proxy/library/alpine/manifests/latest')
+    self.assertEqual(ret.status_code, 404)
+
+  def test_local_first(self):
+    image, container, collection, entity = _create_image(hash=self.layer_digest.replace('sha256:', 'sha256.'), uploadState=UploadStates.completed)
+    entity.name = 'proxy'
+    db.session.commit()
+    tmpf = _fake_img_file(image, data=self.layer)
+    with self._upstream() as upstream:
+      with self.fake_auth():
+        ret = self.client.get(f"/v2/proxy/{collection.name}/{container.name}/blobs/{self.layer_digest}")
+      self.assertEqual(ret.status_code, 200)
+      ret.close()
+      self.assertListEqual(upstream.requests, [])
+
+  def test_pull_image(self):
+    with self._upstream() as upstream:
+      upstream.imagefiles['library/alpine:3.14'] = self.layer
+      with self.fake_auth():
+        for _ in range(2):
+          ret = self.client.get('/v1/imagefile/proxy/library/alpine:3.14')
+          self.assertEqual(ret.status_code, 200)
+          self.assertEqual(ret.data, self.layer)
+          ret.close()
+      self.assertListEqual(upstream.requests, [ '/v1/imagefile/library/alpine:3.14' ])
+
+    image = Image.query.filter(Image.hash==self.layer_digest.replace('sha256:', 'sha256.')).one()
+    self.assertEqual(image.uploadState, UploadStates.completed)
+    self.assertEqual(image.media_type, Image.singularity_media_type)
+    self.assertIn('3.14', image.container_ref.imageTags)
+
+  def test_pull_image_no_latest(self):
+    with self._upstream() as upstream:
+      upstream.imagefiles['library/alpine:3.14'] = self.layer
+      upstream.imagefiles['library/alpine:latest'] = b"Hello Oink!"
+      with self.fake_auth():
+        ret = self.client.get('/v1/imagefile/proxy/library/alpine:3.14')
+        self.assertEqual(ret.status_code, 200)
+        ret.close()
+        ret = self.client.get('/v1/imagefile/proxy/library/alpine:latest')
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(ret.data, b"Hello Oink!")
+        ret.close()
+      self.assertListEqual(upstream.requests, [ '/v1/imagefile/library/alpine:3.14', '/v1/imagefile/library/alpine:latest' ])
+
+    image = Image.query.filter(Image.hash==self.layer_digest.replace('sha256:', 'sha256.')).one()
+    self.assertDictEqual(image.container_ref.imageTags, {
+      '3.14': str(image.id),
+      'latest': str(Image.query.filter(Image.hash!=image.hash).one().id),
+    })
+
+  def test_pull_image_unknown(self):
+    with self._upstream():
+      with self.fake_auth():
+        ret = self.client.get('/v1/imagefile/proxy/library/alpine:3.14')
+      self.assertEqual(ret.status_code, 404)
+      ret = self.client.get('/v1/imagefile/proxy/library/alpine:3.14')
+      self.assertEqual(ret.status_code, 401)
@@ -0,0 +1,93 @@
+import os
+import sys
+import subprocess
+from contextlib import contextmanager
+from werkzeug.wsgi import FileWrapper
+
+from ..route_base import RouteBase
+from .._util import _create_image, _create_user, _fake_img_file
+
+from Hinkskalle import create_app, db
+from Hinkskalle.models import Image, Tag, Token, UploadStates
+
+class RecordingFileWrapper(FileWrapper):
+  wrapped = []
+  def __init__(self, file, buffer_size=8192):
+    super().__init__(file, buffer_size)
+    self.wrapped.append(file.name)
+
+class TestTransfer(RouteBase):
+  @contextmanager
+  def transfer_client(self):
+    """test client for the transfer app, on its own (empty) in-memory db"""
+    transfer_app = create_app(transfer=True)
+    transfer_app.testing = True
+    db.session.remove()
+    with transfer_app.app_context():
+      db.create_all()
+      try:
+        yield transfer_app.test_client()
+      finally:
+        db.session.remove()
+        db.drop_all()
+
+  def test_routes(self):
+    from Hinkskalle.routes.transfer import TRANSFER_HANDLERS
+    transfer_app = create_app(transfer=True)
+    endpoints = { rule.endpoint for rule in transfer_app.url_map.iter_rules() if rule.endpoint != 'static' }
+    self.assertSetEqual(endpoints, set(TRANSFER_HANDLERS))
+
+    rules = { rule.rule for rule in transfer_app.url_map.iter_rules() }
+    self.assertIn('/v2/<distname:name>/blobs/<string:digest>', rules)
+    self.assertIn('/v2/__uploads/<string:upload_id>', rules)
+    # api, frontend and swagger stay with the main app
+    for rule in [ '/v1/entities', '/v2/<distname:name>/manifests/<string:reference>', '/<path:path>', '/swagger' ]:
+      self.assertNotIn(rule, rules)
+
+  def test_footprint(self):
+    ret = subprocess.run([ sys.executable, '-c', """
+import sys
+from Hinkskalle import create_app
+create_app(transfer=True)
+print(' '.join(m for m in sys.modules if m.startswith('webauthn') or m.startswith('Hinkskalle.routes')))
+"""], cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__)))), env=os.environ, capture_output=True, text=True)
+    self.assertEqual(ret.returncode, 0, ret.stderr)
+    modules = ret.stdout.split()
+    self.assertIn('Hinkskalle.routes.oras', modules)
+    self.assertNotIn('Hinkskalle.routes.auth', modules)
+    self.assertNotIn('Hinkskalle.routes.users', modules)
+    self.assertNotIn('webauthn', modules)
+
+  def test_file_wrapper(self):
+    RecordingFileWrapper.wrapped = []
+    with self.transfer_client() as client:
+      image = _create_image(uploadState=UploadStates.completed)[0]
+      Tag(name='latest', image_ref=image)
+      db.session.commit()
+      tmpf = _fake_img_file(image)
+      name = f"{image.entityName}/{image.collectionName}/{image.containerName}"
+
+      # servers hand their wsgi.file_wrapper to sendfile (gunicorn)
+      ret = client.get(f"/v2/{name}/blobs/{image.hash.replace('sha256.', 'sha256:')}", environ_overrides={ 'wsgi.file_wrapper': RecordingFileWrapper })
+      self.assertEqual(ret.status_code, 200)
+      ret.close()
+      ret = client.get(f"/v1/imagefile/{name}:latest", environ_overrides={ 'wsgi.file_wrapper': RecordingFileWrapper })
+      self.assertEqual(ret.status_code, 200)
+      ret.close()
+    self.assertListEqual(RecordingFileWrapper.wrapped, [ tmpf.name, tmpf.name ])
+
+  def test_delete_blob(self):
+    # the proxy sends every method on blobs/ to the transfer pool
+    with self.transfer_client() as client:
+      image = _create_image(uploadState=UploadStates.completed)[0]
+      name = f"{image.entityName}/{image.collectionName}/{image.containerName}"
+      digest = image.hash.replace('sha256.', 'sha256:')
+      ret = client.delete(f"/v2/{name}/blobs/{digest}")
+      self.assertEqual(ret.status_code, 401)
+
+      admin = _create_user(name='admin.hase', is_admin=True)
+      admin.tokens.append(Token(token='geheimschwein'))
+      db.session.commit()
+      ret = client.delete(f"/v2/{name}/blobs/{digest}", headers={ 'Authorization': 'Bearer geheimschwein' })
+      self.assertEqual(ret.status_code, 202)
+      self.assertIsNone(Image.query.filter(Image.hash==image.hash).first())
@@ -532,6 +532,23 @@ class TestUsers(RouteBase):
     self.assertTrue(db_user.is_admin)
     self.assertTrue(db_user.password_disabled)
 
+  def test_update_ldap_deactivated(self):
+    user = _create_user('update.hase')
+    user.is_active = False
+    user.ldap_deactivated = True
+    user.source = 'ldap'
+    db.session.commit()
+
+    # admin takes over, the sync won't reactivate anymore
+    with self.fake_admin_auth():
+      ret = self.client.put(f"/v1/users/{user.username}", json={
+        'isActive': False,
+      })
+    self.assertEqual(ret.status_code, 200)
+    db_user = User.query.filter(User.username=='update.hase').one()
+    self.assertFalse(db_user.is_active)
+    self.assertFalse(db_user.ldap_deactivated)
+
   def test_update_nonlocal_quota(self):
     user = _create_user('update.hase')
     user.quota = 1234
@@ -0,0 +1,74 @@
+from unittest import mock
+
+from Hinkskalle import db
+from ..model_base import ModelBase
+from .._util import _create_user, _create_group, _set_member, _create_container
+
+from Hinkskalle.models import GroupRoles, Entity
+from Hinkskalle.util.auth.access import get_access_context
+
+class TestAccessContext(ModelBase):
+  def _group_container(self, role=GroupRoles.contributor):
+    user = _create_user()
+    group = _create_group()
+    _set_member(user, group, role)
+    container, collection, entity = _create_container()
+    entity.group_id = group.id
+    db.session.commit()
+    return container, group, user
+
+  def test_no_request(self):
+    user = _create_user()
+    with self.app.app_context():
+      self.assertIsNone(get_access_context(user))
+
+  def test_per_request(self):
+    user = _create_user()
+    with self.app.test_request_context():
+      ctx = get_access_context(user)
+      self.assertIsNotNone(ctx)
+      self.assertIs(get_access_context(user), ctx)
+    with self.app.test_request_context():
+      self.assertIsNot(get_access_context(user), ctx)
+
+  def test_memberships_loaded_once(self):
+    container, group, user = self._group_container()
+    with self.app.test_request_context():
+      with mock.patch.object(group.__class__, 'get_member') as get_member:
+        self.assertTrue(container.check_access(user))
+        self.assertTrue(container.check_update_access(user))
+        self.assertTrue(container.collection_ref.check_update_access(user))
+        self.assertTrue(group.check_access(user))
+        self.assertFalse(group.check_update_access(user))
+      get_member.assert_not_called()
+      self.assertDictEqual(get_access_context(user).roles, { group.id: GroupRoles.contributor })
+
+  def test_decisions_memoized(self):
+    container, group, user = self._group_container()
+    with self.app.test_request_context():
+      with mock.patch.object(Entity, 'check_access', return_value=True) as check:
+        self.assertTrue(container.check_access(user))
+        self.assertTrue(container.check_access(user))
+      check.assert_called_once()
+
+  def test_readonly(self):
+    container, group, user = self._group_container(GroupRoles.readonly)
+    with self.app.test_request_context():
+      self.assertTrue(container.check_access(user))
+      self.assertFalse(container.check_update_access(user))
+
+  def test_reset_on_flush(self):
+    container, group, user = self._group_container(GroupRoles.readonly)
+    with self.app.test_request_context():
+      self.assertFalse(container.check_update_access(user))
+      ug = group.get_member(user)
+      ug.role = GroupRoles.contributor
+      db.session.commit()
+      self.assertTrue(container.check_update_access(user))
+
+  def test_users_separate(self):
+    container, group, user = self._group_container()
+    other = _create_user(name='other.hase')
+    with self.app.test_request_context():
+      self.assertTrue(container.check_access(user))
+      self.assertFalse(container.check_access(other))
@@ -0,0 +1,86 @@
+from unittest import mock
+from calendar import timegm
+from datetime import datetime
+
+import jwt
+
+from Hinkskalle import db
+from ..route_base import RouteBase
+from .._util import _create_user
+
+from flask_rebar import errors
+from flask import g
+
+from Hinkskalle.util.auth.token import TokenAuthenticator, Scopes
+from Hinkskalle.util.auth.access_token import create_access_token, decode_access_token, is_access_token
+
+class TestAccessToken(RouteBase):
+  def setUp(self):
+    super().setUp()
+    self.app.config['OCI_ACCESS_TOKEN_JWT'] = True
+    self.app.config['OCI_ACCESS_TOKEN_EXPIRATION'] = 300
+
+  def test_create(self):
+    token = create_access_token(self.user)
+    self.assertTrue(is_access_token(token))
+    decoded = decode_access_token(token)
+    self.assertEqual(decoded['sub'], str(self.user.id))
+    self.assertEqual(decoded['username'], self.user.username)
+    self.assertFalse(decoded['adm'])
+    self.assertEqual(decoded['exp'] - decoded['iat'], 300)
+
+    decoded = decode_access_token(create_access_token(self.admin_user))
+    self.assertTrue(decoded['adm'])
+
+  def test_decode_invalid(self):
+    with self.assertRaisesRegex(errors.Unauthorized, 'Invalid token'):
+      decode_access_token('oi.nk.hase')
+
+    token = jwt.encode({ 'sub': str(self.user.id), 'type': 'access', 'exp': timegm(datetime.utcnow().utctimetuple())+60 }, 'falsch', algorithm="HS256")
+    with self.assertRaisesRegex(errors.Unauthorized, 'Invalid token'):
+      decode_access_token(token)
+
+    # download tokens are signed with the same key
+    token = jwt.encode({ 'sub': str(self.user.id), 'type': 'manifest', 'exp': timegm(datetime.utcnow().utctimetuple())+60 }, self.app.config['SECRET_KEY'], algorithm="HS256")
+    with self.assertRaisesRegex(errors.Unauthorized, 'Invalid token'):
+      decode_access_token(token)
+
+  def test_decode_expired(self):
+    token = jwt.encode({ 'sub': str(self.user.id), 'type': 'access', 'exp': timegm(datetime.utcnow().utctimetuple())-60 }, self.app.config['SECRET_KEY'], algorithm="HS256")
+    with self.assertRaisesRegex(errors.Unauthorized, 'Token expired'):
+      decode_access_token(token)
+
+  def test_authenticate(self):
+    token = create_access_token(self.user)
+    with mock.patch.object(TokenAuthenticator, '_get_identity') as identity_mock:
+      with self.app.test_request_context('', headers={'Authorization': f"Bearer {token}"}):
+        TokenAuthenticator().authenticate()
+        self.assertEqual(g.authenticated_user, self.user)
+        self.assertEqual(g.access_token_claims['sub'], str(self.user.id))
+    identity_mock.assert_not_called()
+
+  def test_authenticate_disabled(self):
+    self.app.config['OCI_ACCESS_TOKEN_JWT'] = False
+    token = create_access_token(self.user)
+    with self.app.test_request_context('', headers={'Authorization': f"Bearer {token}"}):
+      with self.assertRaises(errors.Unauthorized):
+        TokenAuthenticator().authenticate()
+
+  def test_authenticate_user_inactive(self):
+    token = create_access_token(self.user)
+    self.user.is_active = False
+    db.session.commit()
+    with self.app.test_request_context('', headers={'Authorization': f"Bearer {token}"}):
+      with self.assertRaisesRegex(errors.Unauthorized, 'deactivated'):
+        TokenAuthenticator().authenticate()
+
+  def test_scope_admin(self):
+    token = create_access_token(self.admin_user)
+    with self.app.test_request_context('', headers={'Authorization': f"Bearer {token}"}):
+      TokenAuthenticator().with_scope(Scopes.admin).authenticate()
+      self.assertEqual(g.authenticated_user, self.admin_user)
+
+    token = create_access_token(self.user)
+    with self.app.test_request_context('', headers={'Authorization': f"Bearer {token}"}):
+      with self.assertRaises(errors.Forbidden):
+        TokenAuthenticator().with_scope(Scopes.admin).authenticate()
@@ -0,0 +1,134 @@
+from unittest import mock
+import time
+
+from Hinkskalle import db
+from ..route_base import RouteBase
+
+from flask_rebar import errors
+
+from Hinkskalle.util.auth.token import TokenAuthenticator
+from Hinkskalle.util.auth.throttle import auth_throttle, client_identities, client_address
+from Hinkskalle.models import Token
+
+class TestAuthThrottle(RouteBase):
+  def setUp(self):
+    super().setUp()
+    self.app.config['AUTH_FAILURE_CACHE_TTL'] = 300
+    self.app.config['AUTH_THROTTLE_BURST'] = 3
+    self.app.config['AUTH_THROTTLE_RATE'] = 6
+
+  def test_known_bad(self):
+    self.assertFalse(auth_throttle.is_known_bad('oink'))
+    auth_throttle.record_failure('oink')
+    self.assertTrue(auth_throttle.is_known_bad('oink'))
+    self.assertFalse(auth_throttle.is_known_bad('grunz'))
+
+    self.app.config['AUTH_FAILURE_CACHE_TTL'] = 0
+    self.assertFalse(auth_throttle.is_known_bad('oink'))
+
+  def test_bucket(self):
+    for _ in range(3):
+      self.assertIsNone(auth_throttle.is_throttled('ip:1.2.3.4'))
+      auth_throttle.record_failure(None, 'ip:1.2.3.4')
+    retry_after = auth_throttle.is_throttled('ip:1.2.3.4')
+    self.assertEqual(retry_after, 10)
+    self.assertIsNone(auth_throttle.is_throttled('ip:4.3.2.1'))
+    self.assertEqual(auth_throttle.is_throttled('ip:4.3.2.1', 'ip:1.2.3.4'), 10)
+
+    # refilled after a while
+    with mock.patch('Hinkskalle.util.auth.throttle.time.time', return_value=time.time()+10):
+      self.assertIsNone(auth_throttle.is_throttled('ip:1.2.3.4'))
+
+  def test_bucket_disabled(self):
+    self.app.config['AUTH_THROTTLE_BURST'] = 0
+    for _ in range(5):
+      auth_throttle.record_failure(None, 'ip:1.2.3.4')
+    self.assertIsNone(auth_throttle.is_throttled('ip:1.2.3.4'))
+
+  def test_identities(self):
+    self.assertListEqual(client_identities('Test.Hase'), ['user:test.hase'])
+    with self.app.test_request_context('', environ_base={'REMOTE_ADDR': '1.2.3.4'}):
+      self.assertListEqual(client_identities('Test.Hase'), ['ip:1.2.3.4', 'user:test.hase'])
+      self.assertListEqual(client_identities(), ['ip:1.2.3.4'])
+
+  def test_client_address(self):
+    headers = { 'X-Forwarded-For': '6.6.6.6, 1.2.3.4' }
+    with self.app.test_request_context('', headers=headers, environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+      # not trusted by default
+      self.assertEqual(client_address(), '10.0.0.1')
+      self.app.config['TRUSTED_PROXY_COUNT'] = 1
+      self.assertEqual(client_address(), '1.2.3.4')
+      self.assertListEqual(client_identities(), ['ip:1.2.3.4'])
+      self.app.config['TRUSTED_PROXY_COUNT'] = 2
+      self.assertEqual(client_address(), '6.6.6.6')
+      # fewer hops than configured
+      self.app.config['TRUSTED_PROXY_COUNT'] = 3
+      self.assertEqual(client_address(), '10.0.0.1')
+
+  def test_token_negative(self):
+    with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}):
+      with self.assertRaises(errors.Unauthorized):
+        TokenAuthenticator().authenticate()
+    self.assertTrue(auth_throttle.is_known_bad('schoko-banane'))
+
+    with mock.patch('Hinkskalle.models.User.Token.check_token') as check_mock:
+      with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}):
+        with self.assertRaises(errors.Unauthorized):
+          TokenAuthenticator().authenticate()
+    check_mock.assert_not_called()
+
+  def test_token_throttled(self):
+    for i in range(3):
+      with self.app.test_request_context('', headers={'Authorization': f'Bearer {i}-schoko-banane'}, environ_base={'REMOTE_ADDR': '1.2.3.4'}):
+        with self.assertRaises(errors.Unauthorized):
+          TokenAuthenticator().authenticate()
+    with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}, environ_base={'REMOTE_ADDR': '1.2.3.4'}):
+      with self.assertRaises(errors.TooManyRequests):
+        TokenAuthenticator().authenticate()
+    self.assertEqual(auth_throttle.stats()['throttled'], 1)
+
+  def test_valid_token_not_throttled(self):
+    token = Token(token='schoko-banane', user=self.user)
+    db.session.add(token)
+    db.session.commit()
+    for _ in range(5):
+      with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}):
+        TokenAuthenticator()._get_identity('schoko-banane')
+    self.assertEqual(auth_throttle.stats()['failures'], 0)
+
+  def test_valid_token_while_throttled(self):
+    token = Token(token='schoko-banane', user=self.user)
+    other = Token(token='noko-schabane', user=self.user)
+    db.session.add_all([ token, other ])
+    db.session.commit()
+    with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}, environ_base={'REMOTE_ADDR': '1.2.3.4'}):
+      TokenAuthenticator()._get_identity('schoko-banane')
+    for i in range(4):
+      auth_throttle.record_failure(None, 'ip:1.2.3.4')
+    self.assertIsNotNone(auth_throttle.is_throttled('ip:1.2.3.4'))
+    with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}, environ_base={'REMOTE_ADDR': '1.2.3.4'}):
+      # already verified, nothing to hash
+      self.assertEqual(TokenAuthenticator()._get_identity('schoko-banane').id, token.id)
+      # everything else waits
+      with mock.patch('Hinkskalle.models.User.Token.check_token') as check_mock:
+        with self.assertRaises(errors.TooManyRequests):
+          TokenAuthenticator()._get_identity('noko-schabane')
+      check_mock.assert_not_called()
+
+  def test_stats(self):
+    auth_throttle.record_failure('oink', 'ip:1.2.3.4')
+    auth_throttle.is_known_bad('oink')
+    stats = auth_throttle.stats()
+    self.assertDictEqual(stats, {
+      'failureCacheTTL': 300,
+      'burst': 3,
+      'rate': 6,
+      'failures': 1,
+      'negativeHits': 1,
+      'throttled': 0,
+    })
+
+    with self.fake_admin_auth():
+      ret = self.client.get('/v1/auth-throttle/status')
+    self.assertEqual(ret.status_code, 200)
+    self.assertEqual(ret.get_json()['data']['failures'], 1)
@@ -0,0 +1,142 @@
+from unittest import mock
+
+from Hinkskalle import db
+from ..route_base import RouteBase
+from .._util import _create_image, _fake_img_file, _create_group, _set_member
+
+from Hinkskalle.util.blob_cache import blob_cache
+from Hinkskalle.models import Image, Container, Collection, Entity, Group, GroupRoles, UploadStates
+
+class TestBlobCache(RouteBase):
+  def setUp(self):
+    super().setUp()
+    self.app.config['BLOB_CACHE_TTL'] = 300
+
+  def _blob(self, **kwargs):
+    image, container, collection, entity = _create_image(**kwargs)
+    self.file = _fake_img_file(image)
+    name = f"{image.entityName}/{image.collectionName}/{image.containerName}"
+    digest = image.hash.replace('sha256.', 'sha256:')
+    return image, name, digest
+
+  def _pull(self, name, digest, admin=False):
+    with (self.fake_admin_auth() if admin else self.fake_auth()):
+      ret = self.client.get(f"/v2/{name}/blobs/{digest}")
+    ret.close()
+    return ret
+
+  def test_cached(self):
+    image, name, digest = self._blob()
+    image_id = image.id
+    ret = self._pull(name, digest)
+    self.assertEqual(ret.status_code, 200)
+    blob = blob_cache.get(name, digest)
+    self.assertIsNotNone(blob)
+    self.assertEqual(blob.image_id, image_id)
+    self.assertEqual(blob.location, self.file.name)
+
+    # no lookups any more
+    with mock.patch('Hinkskalle.routes.oras._get_container', side_effect=Exception('oink')):
+      ret = self._pull(name, digest)
+      self.assertEqual(ret.status_code, 200)
+      self.assertEqual(ret.headers.get('Docker-Content-Digest'), digest)
+      # names are case insensitive
+      ret = self._pull(name.upper(), digest)
+      self.assertEqual(ret.status_code, 200)
+
+  def test_disabled(self):
+    self.app.config['BLOB_CACHE_TTL'] = 0
+    image, name, digest = self._blob()
+    ret = self._pull(name, digest)
+    self.assertEqual(ret.status_code, 200)
+    self.assertIsNone(blob_cache.get(name, digest))
+
+  def test_not_completed(self):
+    image, name, digest = self._blob()
+    image.uploadState = UploadStates.uploading
+    db.session.commit()
+    ret = self._pull(name, digest)
+    self.assertEqual(ret.status_code, 404)
+    self.assertIsNone(blob_cache.get(name, digest))
+
+  def test_invalidate_image_delete(self):
+    image, name, digest = self._blob()
+    self._pull(name, digest)
+    self.assertIsNotNone(blob_cache.get(name, digest))
+    db.session.delete(Image.query.get(image.id))
+    db.session.commit()
+    self.assertIsNone(blob_cache.get(name, digest))
+    ret = self._pull(name, digest)
+    self.assertEqual(ret.status_code, 404)
+
+  def test_invalidate_private(self):
+    image, name, digest = self._blob()
+    container_id, collection_id = image.container_id, image.container_ref.collection_id
+    self._pull(name, digest)
+    self.assertIsNotNone(blob_cache.get(name, digest))
+
+    container = Container.query.get(container_id)
+    container.private = True
+    db.session.commit()
+    self.assertIsNone(blob_cache.get(name, digest))
+    self.assertEqual(self._pull(name, digest).status_code, 403)
+
+    container = Container.query.get(container_id)
+    container.private = False
+    collection = Collection.query.get(collection_id)
+    collection.private = True
+    db.session.commit()
+    self.assertEqual(self._pull(name, digest, admin=True).status_code, 200)
+    # cached entry, still denied
+    self.assertTrue(blob_cache.get(name, digest).private)
+    self.assertEqual(self._pull(name, digest).status_code, 403)
+
+  def test_invalidate_rename(self):
+    image, name, digest = self._blob()
+    entity_id = image.container_ref.collection_ref.entity_id
+    self._pull(name, digest)
+    entity = Entity.query.get(entity_id)
+    entity.name = 'oink'
+    db.session.commit()
+    self.assertIsNone(blob_cache.get(name, digest))
+    self.assertEqual(self._pull(name, digest).status_code, 404)
+
+  def test_rollback_keeps_entry(self):
+    image, name, digest = self._blob()
+    self._pull(name, digest)
+    image = Image.query.get(image.id)
+    image.description = 'oink'
+    db.session.flush()
+    db.session.rollback()
+    self.assertIsNotNone(blob_cache.get(name, digest))
+
+  def test_private_owner(self):
+    image, container, collection, entity = _create_image()
+    container.owner = self.user
+    container.private = True
+    self.file = _fake_img_file(image)
+    name = f"{image.entityName}/{image.collectionName}/{image.containerName}"
+    digest = image.hash.replace('sha256.', 'sha256:')
+
+    self.assertEqual(self._pull(name, digest).status_code, 200)
+    blob = blob_cache.get(name, digest)
+    self.assertListEqual(blob.owners, [self.username])
+    with mock.patch.object(Container, 'query') as query_mock:
+      self.assertEqual(self._pull(name, digest).status_code, 200)
+    query_mock.get.assert_not_called()
+
+  def test_private_group(self):
+    group = _create_group('Testhasenstall')
+    image, container, collection, entity = _create_image()
+    entity.group = group
+    container.private = True
+    self.file = _fake_img_file(image)
+    name = f"{image.entityName}/{image.collectionName}/{image.containerName}"
+    digest = image.hash.replace('sha256.', 'sha256:')
+    group_id = group.id
+
+    self.assertEqual(self._pull(name, digest, admin=True).status_code, 200)
+    self.assertEqual(self._pull(name, digest).status_code, 403)
+    _set_member(self.user, Group.query.get(group_id), role=GroupRoles.readonly)
+    self.assertIsNotNone(blob_cache.get(name, digest))
+    self.assertEqual(self._pull(name, digest).status_code, 200)
@@ -0,0 +1,153 @@
+import os
+import socket
+import time
+import unittest
+from unittest import mock
+
+from ..model_base import ModelBase
+
+from Hinkskalle.util.cooperative import engine_options, setup_cooperative_db, gevent_wait_callback
+
+try:
+  import gevent
+except ImportError:
+  gevent = None
+
+try:
+  from psycopg2 import extensions
+except ImportError:
+  extensions = None
+
+class _FakeConnection():
+  """pretends to run a query until there is something to read on the socket"""
+  def __init__(self, sock):
+    self.sock = sock
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def poll(self):
+    self.sock.setblocking(False)
+    try:
+      return extensions.POLL_OK if self.sock.recv(1) else extensions.POLL_READ
+    except BlockingIOError:
+      return extensions.POLL_READ
+
+@unittest.skipIf(extensions is None, "needs psycopg2")
+class TestCooperative(ModelBase):
+  def tearDown(self):
+    extensions.set_wait_callback(None)
+    super().tearDown()
+
+  def _app(self, **config):
+    return mock.Mock(config=config)
+
+  def test_engine_options(self):
+    app = self._app(SQLALCHEMY_DATABASE_URI='postgresql+psycopg2://hase@hinkdb/hinkskalle', DB_POOL_SIZE=20, DB_MAX_OVERFLOW=5, DB_POOL_PRE_PING=True, DB_POOL_RECYCLE=3600)
+    self.assertDictEqual(engine_options(app), { 'pool_size': 20, 'max_overflow': 5, 'pool_pre_ping': True, 'pool_recycle': 3600 })
+
+  def test_engine_options_sqlite(self):
+    app = self._app(SQLALCHEMY_DATABASE_URI='sqlite://', DB_POOL_SIZE=20, DB_MAX_OVERFLOW=5, DB_POOL_PRE_PING=False, DB_POOL_RECYCLE=-1)
+    self.assertDictEqual(engine_options(app), { 'pool_pre_ping': False, 'pool_recycle': -1 })
+
+  def test_engine_options_no_uri(self):
+    for uri in [ None, '' ]:
+      app = self._app(SQLALCHEMY_DATABASE_URI=uri, DB_POOL_SIZE=20, DB_MAX_OVERFLOW=5)
+      self.assertDictEqual(engine_options(app), {})
+    self.assertDictEqual(engine_options(self._app(DB_POOL_SIZE=20)), {})
+    self.assertFalse(setup_cooperative_db(self._app(SQLALCHEMY_DATABASE_URI=None, DB_COOPERATIVE=True)))
+
+  def test_engine_options_explicit(self):
+    app = self._app(SQLALCHEMY_DATABASE_URI='postgresql://hinkdb/hinkskalle', DB_POOL_SIZE=20, SQLALCHEMY_ENGINE_OPTIONS={ 'pool_size': 1, 'echo': True })
+    self.assertDictEqual(engine_options(app), { 'pool_size': 1, 'echo': True })
+
+  def test_setup_sqlite(self):
+    self.assertFalse(setup_cooperative_db(self._app(SQLALCHEMY_DATABASE_URI='sqlite://', DB_COOPERATIVE=True)))
+    self.assertIsNone(extensions.get_wait_callback())
+
+  def test_setup_auto(self):
+    app = self._app(SQLALCHEMY_DATABASE_URI='postgresql://hinkdb/hinkskalle', DB_COOPERATIVE='auto')
+    with mock.patch('Hinkskalle.util.cooperative.gevent_patched', return_value=False):
+      self.assertFalse(setup_cooperative_db(app))
+    self.assertIsNone(extensions.get_wait_callback())
+    with mock.patch('Hinkskalle.util.cooperative.gevent_patched', return_value=True):
+      self.assertTrue(setup_cooperative_db(app))
+    self.assertIs(extensions.get_wait_callback(), gevent_wait_callback)
+
+  def test_setup_forced(self):
+    app = self._app(SQLALCHEMY_DATABASE_URI='postgresql://hinkdb/hinkskalle', DB_COOPERATIVE=True)
+    self.assertTrue(setup_cooperative_db(app))
+    self.assertIs(extensions.get_wait_callback(), gevent_wait_callback)
+    app.config['DB_COOPERATIVE'] = False
+    self.assertFalse(setup_cooperative_db(app))
+    self.assertIsNone(extensions.get_wait_callback())
+
+  def test_setup_strings(self):
+    app = self._app(SQLALCHEMY_DATABASE_URI='postgresql://hinkdb/hinkskalle')
+    for setting in [ 'false', 'False', '0', 'off', '' ]:
+      app.config['DB_COOPERATIVE'] = setting
+      self.assertFalse(setup_cooperative_db(app), setting)
+      self.assertIsNone(extensions.get_wait_callback())
+    for setting in [ 'true', 'True', '1', 'on' ]:
+      app.config['DB_COOPERATIVE'] = setting
+      self.assertTrue(setup_cooperative_db(app), setting)
+      self.assertIs(extensions.get_wait_callback(), gevent_wait_callback)
+    app.config['DB_COOPERATIVE'] = 'AUTO'
+    with mock.patch('Hinkskalle.util.cooperative.gevent_patched', return_value=False):
+      self.assertFalse(setup_cooperative_db(app))
+    app.config['DB_COOPERATIVE'] = 'oink'
+    with self.assertRaisesRegex(ValueError, 'DB_COOPERATIVE'):
+      setup_cooperative_db(app)
+
+  def test_engine_options_strings(self):
+    app = self._app(SQLALCHEMY_DATABASE_URI='sqlite://', DB_POOL_PRE_PING='false')
+    self.assertDictEqual(engine_options(app), { 'pool_pre_ping': False })
+
+  @unittest.skipIf(gevent is None, "needs gevent")
+  def test_wait_yields(self):
+    server, client = socket.socketpair()
+    conn = _FakeConnection(client)
+    progress = []
+
+    def query():
+      gevent_wait_callback(conn)
+      progress.append('query')
+
+    def requests():
+      test_client = self.app.test_client()
+      for _ in range(3):
+        ret = test_client.get('/version')
+        self.assertEqual(ret.status_code, 200)
+        progress.append('request')
+        gevent.sleep(0)
+      # database is done now
+      server.send(b'x')
+
+    gevent.joinall([gevent.spawn(query), gevent.spawn(requests)], raise_error=True, timeout=10)
+    self.assertListEqual(progress, ['request', 'request', 'request', 'query'])
+    server.close()
+    client.close()
+
+  # needs a real database: HINKSKALLE_TEST_POSTGRES_URI=postgresql+psycopg2://...
+  @unittest.skipIf(gevent is None, "needs gevent")
+  @unittest.skipUnless(os.environ.get('HINKSKALLE_TEST_POSTGRES_URI'), "no postgres (set HINKSKALLE_TEST_POSTGRES_URI)")
+  def test_postgres_sleep(self):
+    from sqlalchemy import create_engine, text
+    extensions.set_wait_callback(gevent_wait_callback)
+    engine = create_engine(os.environ['HINKSKALLE_TEST_POSTGRES_URI'], pool_size=5)
+    finished = {}
+
+    def run(name, stmt):
+      with engine.connect() as conn:
+        conn.execute(text(stmt))
+      finished[name] = time.perf_counter()
+
+    start = time.perf_counter()
+    jobs = [ gevent.spawn(run, 'sleep', 'SELECT pg_sleep(1)') ]
+    gevent.sleep(0.1)
+    jobs += [ gevent.spawn(run, f'quick{i}', 'SELECT 1') for i in range(3) ]
+    gevent.joinall(jobs, raise_error=True, timeout=10)
+    engine.dispose()
+    for i in range(3):
+      self.assertLess(finished[f'quick{i}'], finished['sleep'])
+      self.assertLess(finished[f'quick{i}'] - start, 0.9)
@@ -0,0 +1,104 @@
+from unittest import mock
+from datetime import datetime, timedelta
+
+from redis.exceptions import RedisError
+
+from Hinkskalle import db
+from ..route_base import RouteBase
+from .._util import _create_image, _fake_img_file
+
+from Hinkskalle.util.counters import download_counter
+from Hinkskalle.models import Image, Container, Manifest, Tag
+
+class TestDownloadCounter(RouteBase):
+  def setUp(self):
+    super().setUp()
+    self.app.config['DOWNLOAD_COUNT_BATCH'] = 100
+    self.app.config['DOWNLOAD_COUNT_FLUSH_INTERVAL'] = 60
+
+  def _ids(self):
+    image = _create_image()[0]
+    manifest = image.generate_manifest()
+    db.session.commit()
+    return image.id, image.container_id, manifest.id
+
+  def test_buffered(self):
+    image_id, container_id, manifest_id = self._ids()
+    with mock.patch('Hinkskalle.util.jobs.flush_download_counts') as job_mock:
+      for _ in range(3):
+        download_counter.count(image=Image.query.get(image_id), container=Container.query.get(container_id), manifest=Manifest.query.get(manifest_id))
+    # first count schedules a delayed flush
+    job_mock.schedule.assert_called_once_with(timedelta(seconds=60))
+    job_mock.queue.assert_not_called()
+
+    db.session.expire_all()
+    self.assertEqual(Image.query.get(image_id).downloadCount, 0)
+    self.assertEqual(download_counter.pending('image', image_id), 3)
+    self.assertEqual(download_counter.pending('container', container_id), 3)
+    self.assertEqual(download_counter.pending('manifest', manifest_id), 3)
+
+    self.assertEqual(download_counter.flush(), 9)
+    db.session.expire_all()
+    for model, obj_id in ((Image, image_id), (Container, container_id), (Manifest, manifest_id)):
+      obj = model.query.get(obj_id)
+      self.assertEqual(obj.downloadCount, 3)
+      self.assertAlmostEqual(obj.latestDownload, datetime.now(), delta=timedelta(seconds=2))
+    self.assertEqual(download_counter.pending('image', image_id), 0)
+    self.assertEqual(download_counter.flush(), 0)
+
+  def test_pull_no_db_write(self):
+    image = _create_image()[0]
+    Tag(name='latest', image_ref=image)
+    tmpf = _fake_img_file(image)
+    image_id = image.id
+    url = f"/v1/imagefile/{image.entityName}/{image.collectionName}/{image.containerName}:latest"
+    with mock.patch('Hinkskalle.util.jobs.flush_download_counts'), \
+      mock.patch.object(db.session, 'commit') as commit_mock:
+      ret = self.client.get(url)
+      self.assertEqual(ret.status_code, 200)
+      ret.close()
+    commit_mock.assert_not_called()
+    self.assertEqual(download_counter.pending('image', image_id), 1)
+
+  def test_flush_batch(self):
+    self.app.config['DOWNLOAD_COUNT_BATCH'] = 2
+    image_id, container_id, _ = self._ids()
+    with mock.patch('Hinkskalle.util.jobs.flush_download_counts') as job_mock:
+      download_counter.count(image=Image.query.get(image_id))
+      job_mock.queue.assert_not_called()
+      download_counter.count(image=Image.query.get(image_id))
+      job_mock.queue.assert_called_once()
+      # already queued
+      download_counter.count(image=Image.query.get(image_id))
+      job_mock.queue.assert_called_once()
+
+  def test_flush_interval(self):
+    self.app.config['DOWNLOAD_COUNT_FLUSH_INTERVAL'] = 0
+    image_id, container_id, _ = self._ids()
+    with mock.patch('Hinkskalle.util.jobs.flush_download_counts') as job_mock:
+      download_counter.count(image=Image.query.get(image_id), container=Container.query.get(container_id))
+    job_mock.schedule.assert_not_called()
+    job_mock.queue.assert_not_called()
+    db.session.expire_all()
+    self.assertEqual(Image.query.get(image_id).downloadCount, 1)
+    self.assertEqual(Container.query.get(container_id).downloadCount, 1)
+
+  def test_redis_failure(self):
+    image_id, _, _ = self._ids()
+    with mock.patch.object(download_counter.connection, 'pipeline', side_effect=RedisError('oink')):
+      download_counter.count(image=Image.query.get(image_id))
+    db.session.expire_all()
+    self.assertEqual(Image.query.get(image_id).downloadCount, 1)
+
+  def test_flush_failure(self):
+    image_id, _, _ = self._ids()
+    with mock.patch('Hinkskalle.util.jobs.flush_download_counts'):
+      download_counter.count(image=Image.query.get(image_id))
+    with mock.patch.object(download_counter, '_write', side_effect=Exception('oink')):
+      with self.assertRaisesRegex(Exception, 'oink'):
+        download_counter.flush()
+    # still there for the next run
+    self.assertEqual(download_counter.pending('image', image_id), 1)
+    self.assertEqual(download_counter.flush(), 1)
+    db.session.expire_all()
+    self.assertEqual(Image.query.get(image_id).downloadCount, 1)
@@ -3,14 +3,17 @@ from ..model_base import ModelBase
 from .._util import _create_user
 
 from ldap3 import MOCK_SYNC, OFFLINE_AD_2012_R2
+from ldap3.core.exceptions import LDAPCommunicationError
 from rq import Queue
 from fakeredis import FakeStrictRedis
 
 from Hinkskalle.models import Adm, AdmKeys, User, Entity
-from Hinkskalle.util.auth.ldap import LDAPUsers, LDAPService
+from Hinkskalle.util.auth.ldap import LDAPUsers, LDAPService, ConnectionPool
 from Hinkskalle.util.auth.exceptions import *
 
 import os
+import time
+from datetime import datetime, timedelta, timezone
 from unittest import mock
 
 class MockLDAP():
@@ -35,8 +38,10 @@ class MockLDAP():
     self.auth = LDAPUsers(svc=self.svc)
     self.auth.enabled = True
   
-  def create_user(self, name='test.hase', password='supersecret', is_admin=False):
+  def create_user(self, name='test.hase', password='supersecret', is_admin=False, modified=None):
     create_user = { 'cn': 'Oink Hase', 'uid': name, 'userPassword': password, 'mail': f"{name}@testha.se", 'sn': 'Oink', 'givenName': 'Grunz', 'objectClass': ['top', 'person'] }
+    if modified:
+      create_user['modifyTimestamp'] = modified
     # add_entry seems to mutate the dict (all values turn to lists)
     self.svc.connection.strategy.add_entry(f"cn={name},ou=test", create_user.copy())
     return create_user
@@ -238,6 +243,106 @@ class TestLdap(ModelBase):
     with self.assertRaises(InvalidPassword):
       check_user = auth.check_password(user.get('uid'), '')
 
+  def test_sync_unchanged(self):
+    auth = self.mock.auth
+    user = _create_user()
+    user.source = 'ldap'
+    db.session.add(Entity(name=user.username, owner=user))
+    db.session.commit()
+    updated = user.updatedAt
+
+    with mock.patch.object(db.session, 'commit') as commit_mock:
+      db_user = auth.sync_user({ 'attributes': { 'cn': f'{user.firstname} {user.lastname}', 'uid': user.username, 'mail': user.email.upper(), 'givenName': user.firstname, 'sn': user.lastname }})
+    commit_mock.assert_not_called()
+    self.assertEqual(db_user.id, user.id)
+    self.assertEqual(db_user.updatedAt, updated)
+
+  def test_sync_unchanged_no_entity(self):
+    auth = self.mock.auth
+    user = _create_user()
+    user.source = 'ldap'
+    db.session.commit()
+    updated = user.updatedAt
+
+    db_user = auth.sync_user({ 'attributes': { 'cn': f'{user.firstname} {user.lastname}', 'uid': user.username, 'mail': user.email, 'givenName': user.firstname, 'sn': user.lastname }})
+    self.assertEqual(db_user.updatedAt, updated)
+    entity = Entity.query.filter(Entity.name == user.username).one()
+    self.assertEqual(entity.owner, db_user)
+
+  def test_check_pooled(self):
+    auth = self.mock.auth
+    user = self.mock.create_user()
+    other_user = self.mock.create_user(name='oink.hase')
+
+    with mock.patch.object(auth.ldap, '_service_connection', wraps=auth.ldap._service_connection) as service_mock, \
+        mock.patch.object(auth.ldap, '_bind_connection', wraps=auth.ldap._bind_connection) as bind_mock:
+      auth.ldap.pool.factory = service_mock
+      auth.ldap.bind_pool.factory = bind_mock
+      auth.check_password(user.get('uid'), user.get('userPassword'))
+      with self.assertRaises(InvalidPassword):
+        auth.check_password(other_user.get('uid'), 'falsch')
+      auth.check_password(other_user.get('uid'), other_user.get('userPassword'))
+    service_mock.assert_called_once()
+    bind_mock.assert_called_once()
+
+  def test_pool_size(self):
+    created = []
+    def factory():
+      created.append(mock.MagicMock())
+      return created[-1]
+    pool = ConnectionPool(factory, size=2, timeout=0.01)
+    with pool.connection() as conn1:
+      with pool.connection() as conn2:
+        self.assertIsNot(conn1, conn2)
+        with self.assertRaisesRegex(Exception, 'no ldap connection available'):
+          with pool.connection():
+            pass
+    with pool.connection() as conn3:
+      self.assertIn(conn3, created)
+    self.assertEqual(len(created), 2)
+
+  def test_pool_discard_broken(self):
+    created = []
+    def factory():
+      created.append(mock.MagicMock())
+      return created[-1]
+    pool = ConnectionPool(factory, size=1)
+    with self.assertRaises(LDAPCommunicationError):
+      with pool.connection() as conn:
+        raise LDAPCommunicationError('socket gone')
+    conn.unbind.assert_called_once()
+    with pool.connection() as conn2:
+      self.assertIsNot(conn, conn2)
+    self.assertEqual(len(created), 2)
+
+  def test_dn_cache(self):
+    auth = self.mock.auth
+    user = self.mock.create_user()
+    auth.ldap.dn_cache_ttl = 60
+
+    with mock.patch.object(auth.ldap, 'search_user', wraps=auth.ldap.search_user) as search_mock:
+      auth.check_password(user.get('uid'), user.get('userPassword'))
+      auth.check_password(user.get('uid'), user.get('userPassword'))
+      search_mock.assert_called_once()
+
+      # still checks the password!
+      with self.assertRaises(InvalidPassword):
+        auth.check_password(user.get('uid'), 'falsch')
+
+      with mock.patch('Hinkskalle.util.auth.ldap.time.monotonic', return_value=time.monotonic()+61):
+        auth.check_password(user.get('uid'), user.get('userPassword'))
+      self.assertEqual(search_mock.call_count, 2)
+
+  def test_dn_cache_disabled(self):
+    auth = self.mock.auth
+    user = self.mock.create_user()
+    auth.ldap.dn_cache_ttl = 0
+
+    with mock.patch.object(auth.ldap, 'search_user', wraps=auth.ldap.search_user) as search_mock:
+      auth.check_password(user.get('uid'), user.get('userPassword'))
+      auth.check_password(user.get('uid'), user.get('userPassword'))
+    self.assertEqual(search_mock.call_count, 2)
+
   def test_db_sync(self):
     auth = self.mock.auth
     user = self.mock.create_user()
@@ -258,4 +363,212 @@ class TestLdap(ModelBase):
 
     db_user = User.query.filter(User.username==user['uid']).first()
     self.assertEqual(db_user.email, user['mail'])
-    self.assertEqual(db_user.source, 'ldap')
\ No newline at end of file
+    self.assertEqual(db_user.source, 'ldap')
+  def test_sync_users(self):
+    auth = self.mock.auth
+    existing = _create_user('exist.hase')
+    existing.source = 'ldap'
+    local = _create_user('local.hase')
+    db.session.commit()
+
+    result = auth.sync_users([
+      { 'attributes': { 'cn': 'Test Hase', 'uid': 'test.hase', 'mail': 'test@ha.se', 'givenName': 'Test', 'sn': 'Hase' }},
+      { 'attributes': { 'cn': 'Exist Hase', 'uid': existing.username, 'mail': existing.email, 'givenName': 'Neu', 'sn': existing.lastname }},
+      { 'attributes': { 'cn': 'Local Hase', 'uid': local.username, 'mail': local.email, 'givenName': local.firstname, 'sn': local.lastname }},
+    ])
+    self.assertListEqual(result['synced'], ['test.hase', 'exist.hase'])
+    self.assertListEqual(result['conflict'], ['Local Hase'])
+    self.assertListEqual(result['failed'], [])
+
+    db_user = User.query.filter(User.username == 'test.hase').one()
+    self.assertEqual(db_user.email, 'test@ha.se')
+    self.assertEqual(db_user.source, 'ldap')
+    self.assertIsNotNone(Entity.query.filter(Entity.name == 'test.hase').first())
+    self.assertIsNotNone(Entity.query.filter(Entity.name == 'exist.hase').first())
+    self.assertEqual(User.query.get(existing.id).firstname, 'Neu')
+
+  def test_sync_users_single_commit(self):
+    auth = self.mock.auth
+    entries = [ { 'attributes': { 'cn': f'Hase {i}', 'uid': f'test{i}.hase', 'mail': f'test{i}@ha.se', 'givenName': 'Test', 'sn': 'Hase' }} for i in range(5) ]
+    with mock.patch.object(db.session, 'commit', wraps=db.session.commit) as commit_mock:
+      result = auth.sync_users(entries)
+    commit_mock.assert_called_once()
+    self.assertEqual(len(result['synced']), 5)
+    self.assertEqual(Entity.query.count(), 5)
+
+  def test_sync_users_fallback(self):
+    auth = self.mock.auth
+    other = _create_user('other.hase')
+    other.source = 'ldap'
+    db.session.commit()
+
+    result = auth.sync_users([
+      { 'attributes': { 'cn': 'Test Hase', 'uid': 'test.hase', 'mail': 'test@ha.se', 'givenName': 'Test', 'sn': 'Hase' }},
+      # email already taken
+      { 'attributes': { 'cn': 'Dup Hase', 'uid': 'dup.hase', 'mail': other.email, 'givenName': 'Dup', 'sn': 'Hase' }},
+    ])
+    self.assertListEqual(result['synced'], ['test.hase'])
+    self.assertListEqual(result['failed'], ['Dup Hase'])
+    self.assertIsNotNone(User.query.filter(User.username == 'test.hase').first())
+
+  def test_iter_users(self):
+    for i in range(5):
+      self.mock.create_user(name=f'test{i}.hase')
+    self.mock.svc.connect()
+    users = list(self.mock.svc.iter_users(page_size=2))
+    self.assertEqual(len(users), 5)
+
+  def test_db_sync_batches(self):
+    for i in range(5):
+      self.mock.create_user(name=f'test{i}.hase')
+    queue = Queue(is_async=False, connection=FakeStrictRedis())
+    self.mock.auth.config = { 'PAGE_SIZE': 2, 'SYNC_BATCH': 2 }
+
+    with mock.patch('Hinkskalle.util.jobs.LDAPUsers', new=self._get_mock), \
+        mock.patch.object(self.mock.auth, 'sync_users', wraps=self.mock.auth.sync_users) as sync_mock:
+      from Hinkskalle.util.jobs import sync_ldap
+      job = queue.enqueue(sync_ldap)
+    self.assertTrue(job.is_finished)
+    self.assertEqual(job.result, 'synced 5')
+    self.assertEqual(sync_mock.call_count, 3)
+    self.assertEqual(User.query.filter(User.source == 'ldap').count(), 5)
+
+  def _run_sync(self):
+    queue = Queue(is_async=False, connection=FakeStrictRedis())
+    with mock.patch('Hinkskalle.util.jobs.LDAPUsers', new=self._get_mock):
+      from Hinkskalle.util.jobs import sync_ldap
+      job = queue.enqueue(sync_ldap)
+    self.assertTrue(job.is_finished)
+    return Adm.query.get(AdmKeys.ldap_sync_results).val
+
+  def test_db_sync_incremental(self):
+    self.mock.auth.config = { 'INCREMENTAL_SYNC': True }
+    self.mock.create_user(name='test1.hase', modified='20261001120000Z')
+    self.mock.create_user(name='test2.hase', modified='20261002120000Z')
+
+    result = self._run_sync()
+    self.assertEqual(result['mode'], 'full')
+    self.assertEqual(result['highWaterMark'], '20261002120000Z')
+    self.assertEqual(result['lastFullSync'], result['started'])
+    self.assertListEqual(sorted(result['synced']), ['test1.hase', 'test2.hase'])
+
+    self.mock.create_user(name='test3.hase', modified='20261003120000Z')
+    with mock.patch.object(self.mock.svc, 'iter_users', wraps=self.mock.svc.iter_users) as iter_mock:
+      result = self._run_sync()
+    iter_mock.assert_called_once_with(page_size=500, modified_since='20261002120000Z')
+    self.assertEqual(result['mode'], 'incremental')
+    self.assertEqual(result['highWaterMark'], '20261003120000Z')
+    # boundary entry is fetched again, that's ok
+    self.assertListEqual(sorted(result['synced']), ['test2.hase', 'test3.hase'])
+    self.assertNotIn('deactivated', result)
+
+  def test_db_sync_incremental_full_interval(self):
+    self.mock.auth.config = { 'INCREMENTAL_SYNC': True, 'FULL_SYNC_INTERVAL': 3600 }
+    self.mock.create_user(name='test1.hase', modified='20261001120000Z')
+    result = self._run_sync()
+    self.assertEqual(result['mode'], 'full')
+
+    adm = Adm.query.get(AdmKeys.ldap_sync_results)
+    adm.val = { **adm.val, 'lastFullSync': (datetime.now(tz=timezone.utc) - timedelta(hours=2)).isoformat() }
+    db.session.commit()
+    result = self._run_sync()
+    self.assertEqual(result['mode'], 'full')
+
+  def test_db_sync_incremental_deactivate(self):
+    self.mock.auth.config = { 'INCREMENTAL_SYNC': True }
+    gone = _create_user('gone.hase')
+    gone.source = 'ldap'
+    local = _create_user('local.hase')
+    db.session.commit()
+    self.mock.create_user(name='test1.hase', modified='20261001120000Z')
+
+    result = self._run_sync()
+    self.assertListEqual(result['deactivated'], ['gone.hase'])
+    self.assertFalse(User.query.filter(User.username == 'gone.hase').one().is_active)
+    self.assertTrue(User.query.filter(User.username == 'local.hase').one().is_active)
+    self.assertTrue(User.query.filter(User.username == 'test1.hase').one().is_active)
+
+  def test_db_sync_reactivate(self):
+    # every run a full one
+    self.mock.auth.config = { 'INCREMENTAL_SYNC': True, 'FULL_SYNC_INTERVAL': 0 }
+    self.mock.create_user(name='test1.hase', modified='20261001120000Z')
+    self._run_sync()
+    # temporarily out of sight (ou move, filter change)
+    self.mock.svc.connection.strategy.remove_entry('cn=test1.hase,ou=test')
+    self.mock.create_user(name='test2.hase', modified='20261001120000Z')
+    result = self._run_sync()
+    self.assertListEqual(result['deactivated'], ['test1.hase'])
+    self.assertFalse(User.query.filter(User.username == 'test1.hase').one().is_active)
+
+    self.mock.create_user(name='test1.hase', modified='20261002120000Z')
+    self._run_sync()
+    user = User.query.filter(User.username == 'test1.hase').one()
+    self.assertTrue(user.is_active)
+    self.assertFalse(user.ldap_deactivated)
+
+  def test_db_sync_keep_admin_deactivated(self):
+    self.mock.create_user(name='test1.hase')
+    self._run_sync()
+    user = User.query.filter(User.username == 'test1.hase').one()
+    user.is_active = False
+    db.session.commit()
+    self._run_sync()
+    self.assertFalse(User.query.filter(User.username == 'test1.hase').one().is_active)
+
+  def test_sync_user_reactivate(self):
+    auth = self.mock.auth
+    user = self.mock.create_user()
+    db_user = auth.check_password(user.get('uid'), user.get('userPassword'))
+    db_user.is_active = False
+    db_user.ldap_deactivated = True
+    db.session.commit()
+
+    db_user = auth.check_password(user.get('uid'), user.get('userPassword'))
+    self.assertTrue(db_user.is_active)
+    self.assertFalse(db_user.ldap_deactivated)
+
+    # deactivated by an admin: stays that way
+    db_user.is_active = False
+    db.session.commit()
+    db_user = auth.check_password(user.get('uid'), user.get('userPassword'))
+    self.assertFalse(db_user.is_active)
+
+  def test_db_sync_incremental_timestamp_formats(self):
+    self.mock.auth.config = { 'INCREMENTAL_SYNC': True }
+    # 12:00Z, later than 13:00Z as plain strings
+    self.mock.create_user(name='test1.hase', modified='20261001140000+0200')
+    self.mock.create_user(name='test2.hase', modified='20261001130000.5Z')
+    result = self._run_sync()
+    self.assertEqual(result['highWaterMark'], '20261001130000Z')
+
+  def test_db_sync_incremental_deactivate_unreadable(self):
+    self.mock.auth.config = { 'INCREMENTAL_SYNC': True }
+    gone = _create_user('gone.hase')
+    gone.source = 'ldap'
+    db.session.commit()
+    self.mock.create_user(name='test1.hase', modified='20261001120000Z')
+
+    with mock.patch.object(self.mock.auth, 'entry_username', side_effect=Exception('oink')):
+      result = self._run_sync()
+    self.assertListEqual(result['deactivated'], [])
+    self.assertTrue(User.query.filter(User.username == 'gone.hase').one().is_active)
+
+  def test_db_sync_incremental_no_timestamp(self):
+    self.mock.auth.config = { 'INCREMENTAL_SYNC': True }
+    self.mock.create_user(name='test1.hase')
+    result = self._run_sync()
+    self.assertIsNone(result['highWaterMark'])
+    # without timestamps we never go incremental
+    result = self._run_sync()
+    self.assertEqual(result['mode'], 'full')
+
+  def test_db_sync_not_incremental(self):
+    gone = _create_user('gone.hase')
+    gone.source = 'ldap'
+    db.session.commit()
+    self.mock.create_user(name='test1.hase', modified='20261001120000Z')
+    result = self._run_sync()
+    result = self._run_sync()
+    self.assertEqual(result['mode'], 'full')
+    self.assertNotIn('highWaterMark', result)
+    self.assertTrue(User.query.filter(User.username == 'gone.hase').one().is_active)
@@ -0,0 +1,107 @@
+from unittest import mock
+import os
+import sys
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from ..model_base import ModelBase
+
+from Hinkskalle.util import offload
+from Hinkskalle.util.offload import run_blocking
+
+try:
+  import gevent
+except ImportError:
+  gevent = None
+
+def _thread_ident() -> int:
+  return threading.get_ident()
+
+def _fail():
+  raise ValueError('oink')
+
+class TestOffload(ModelBase):
+  def setUp(self):
+    super().setUp()
+    self.app.config['OFFLOAD_THREADS'] = 2
+    offload._pool = None
+    offload._pool_size = 0
+
+  def tearDown(self):
+    if offload._pool is not None:
+      offload._pool.kill()
+      offload._pool = None
+    super().tearDown()
+
+  def _cooperative(self):
+    return mock.patch.multiple(offload,
+      _cooperative=mock.MagicMock(return_value=True),
+      _make_pool=mock.MagicMock(wraps=offload._make_pool),
+    )
+
+  def test_inline(self):
+    self.assertEqual(run_blocking(_thread_ident), threading.get_ident())
+    self.assertIsNone(offload._pool)
+
+  @unittest.skipIf(gevent is None, "needs gevent")
+  def test_offload(self):
+    with self._cooperative():
+      self.assertNotEqual(run_blocking(_thread_ident), threading.get_ident())
+      self.assertEqual(run_blocking(lambda a, b=0: a+b, 1, b=2), 3)
+      offload._make_pool.assert_called_once_with(2)
+
+  @unittest.skipIf(gevent is None, "needs gevent")
+  def test_offload_exception(self):
+    with self._cooperative():
+      with self.assertRaisesRegex(ValueError, 'oink'):
+        run_blocking(_fail)
+
+  def test_disabled(self):
+    self.app.config['OFFLOAD_THREADS'] = 0
+    with self._cooperative():
+      self.assertEqual(run_blocking(_thread_ident), threading.get_ident())
+      offload._make_pool.assert_not_called()
+
+  def test_no_app_context(self):
+    with self._cooperative(), mock.patch('Hinkskalle.util.offload.has_app_context', return_value=False):
+      self.assertEqual(run_blocking(_thread_ident), threading.get_ident())
+      offload._make_pool.assert_not_called()
+
+  @unittest.skipIf(gevent is None, "needs gevent")
+  def test_resize(self):
+    with self._cooperative():
+      run_blocking(_thread_ident)
+      first = offload._pool
+      self.app.config['OFFLOAD_THREADS'] = 3
+      run_blocking(_thread_ident)
+      self.assertIsNot(offload._pool, first)
+      self.assertEqual(offload._pool_size, 3)
+
+  @unittest.skipIf(gevent is None, "needs gevent")
+  def test_subprocess_patched(self):
+    # gunicorn's gevent worker patches everything, subprocess included.
+    # singularity calls have to work there while the pool is in use.
+    bindir = tempfile.mkdtemp()
+    with open(os.path.join(bindir, 'singularity'), 'w') as fh:
+      fh.write("#!/bin/sh\ncase \"$1\" in\n  sif) echo 'Bootstrap: oink' ;;\n  verify) echo '{\"Signatures\": 1}' ;;\nesac\n")
+    os.chmod(os.path.join(bindir, 'singularity'), 0o755)
+    with tempfile.NamedTemporaryFile() as img:
+      ret = subprocess.run([ sys.executable, '-c', f"""
+from gevent import monkey
+monkey.patch_all()
+import threading
+from Hinkskalle import create_app
+from Hinkskalle.models import Image, UploadStates
+from Hinkskalle.util.offload import run_blocking
+app = create_app()
+app.config['OFFLOAD_THREADS'] = 2
+with app.app_context():
+  assert run_blocking(threading.get_ident) != threading.get_ident()
+  image = Image(location='{img.name}', uploadState=UploadStates.completed, media_type=Image.singularity_media_type)
+  print(image.inspect().strip())
+  print(image.check_signature()['Passed'])
+"""], cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__)))), env={ **os.environ, 'PATH': f"{bindir}:{os.environ['PATH']}" }, capture_output=True, text=True)
+    self.assertEqual(ret.returncode, 0, ret.stderr)
+    self.assertListEqual(ret.stdout.split(), [ 'Bootstrap:', 'oink', 'True' ])
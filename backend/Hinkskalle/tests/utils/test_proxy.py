@@ -0,0 +1,69 @@
+from unittest import mock
+
+from redis.exceptions import RedisError
+
+from ..route_base import RouteBase
+
+from Hinkskalle.util.proxy import pull_through
+
+class TestPullThrough(RouteBase):
+  def setUp(self):
+    super().setUp()
+    self.app.config['PROXY_UPSTREAM'] = 'http://upstream.invalid'
+    self.app.config['PROXY_FETCH_TIMEOUT'] = 10
+
+  def test_handles(self):
+    self.app.config['PROXY_ENTITY'] = 'Proxy'
+    self.assertTrue(pull_through.handles('proxy'))
+    self.assertTrue(pull_through.handles('PROXY'))
+    self.assertFalse(pull_through.handles('oink'))
+    self.app.config['PROXY_UPSTREAM'] = None
+    self.assertFalse(pull_through.handles('proxy'))
+
+  def test_single_flight(self):
+    lookup = mock.Mock(return_value=None)
+    fetch = mock.Mock(return_value='oink')
+    self.assertEqual(pull_through.single_flight('test', lookup, fetch), 'oink')
+    lookup.assert_called_once()
+    fetch.assert_called_once()
+    self.assertFalse(pull_through.connection.exists(f"{pull_through.prefix}:fetch:test"))
+
+  def test_single_flight_found(self):
+    lookup = mock.Mock(return_value='oink')
+    fetch = mock.Mock()
+    self.assertEqual(pull_through.single_flight('test', lookup, fetch), 'oink')
+    fetch.assert_not_called()
+
+  def test_single_flight_failed(self):
+    fetch = mock.Mock(side_effect=Exception('oink'))
+    with self.assertRaisesRegex(Exception, 'oink'):
+      pull_through.single_flight('test', lambda: None, fetch)
+    # next try can fetch again
+    self.assertFalse(pull_through.connection.exists(f"{pull_through.prefix}:fetch:test"))
+
+  def test_single_flight_wait(self):
+    lock = f"{pull_through.prefix}:fetch:test"
+    pull_through.connection.set(lock, 1)
+    lookup = mock.Mock(return_value='oink')
+    fetch = mock.Mock()
+    # the other worker finishes while we wait
+    with mock.patch('Hinkskalle.util.proxy.time.sleep', side_effect=lambda _: pull_through.connection.delete(lock)) as sleep_mock:
+      self.assertEqual(pull_through.single_flight('test', lookup, fetch), 'oink')
+    sleep_mock.assert_called_once()
+    lookup.assert_called_once()
+    fetch.assert_not_called()
+
+  def test_single_flight_wait_timeout(self):
+    pull_through.connection.set(f"{pull_through.prefix}:fetch:test", 1)
+    lookup = mock.Mock(return_value=None)
+    fetch = mock.Mock()
+    with mock.patch('Hinkskalle.util.proxy.time') as time_mock:
+      time_mock.time.side_effect = [ 0, 5, 20 ]
+      self.assertIsNone(pull_through.single_flight('test', lookup, fetch))
+    fetch.assert_not_called()
+
+  def test_single_flight_redis_failure(self):
+    fetch = mock.Mock(return_value='oink')
+    with mock.patch.object(pull_through.connection, 'set', side_effect=RedisError('oink')):
+      self.assertEqual(pull_through.single_flight('test', lambda: None, fetch), 'oink')
+    fetch.assert_called_once()
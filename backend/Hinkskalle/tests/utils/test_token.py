@@ -88,6 +88,21 @@ class TestTokenAuth(RouteBase):
 
     self.assertEqual(identity.user.username, test_user.username)
 
+  def test_get_identity_legacy_hash(self):
+    from passlib.hash import sha512_crypt
+    test_user = _create_user()
+    token = Token(token=sha512_crypt.hash('schoko-banane', rounds=1000))
+    token.key_uid = 'schoko-banane'[:12]
+    test_user.tokens.append(token)
+    db.session.commit()
+
+    token_auth = TokenAuthenticator()
+    identity = token_auth._get_identity('schoko-banane')
+    self.assertEqual(identity.id, token.id)
+    # read only requests don't commit, the upgrade has to stick anyway
+    db.session.rollback()
+    self.assertEqual(Token.query.get(token.id).token, Token.hash_token('schoko-banane'))
+
   def test_get_identity_invalid(self):
     test_user = _create_user()
     test_user.tokens.append(Token(token='noko-schabane'))
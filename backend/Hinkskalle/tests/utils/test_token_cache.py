@@ -0,0 +1,179 @@
+from unittest import mock
+from datetime import datetime, timedelta
+
+from Hinkskalle import db
+from ..route_base import RouteBase
+from .._util import _create_user
+
+from flask_rebar import errors
+
+from Hinkskalle.util.auth.token import TokenAuthenticator
+from Hinkskalle.util.auth.cache import token_cache
+from Hinkskalle.models import Token
+
+class TestTokenCache(RouteBase):
+  def setUp(self):
+    super().setUp()
+    self.app.config['TOKEN_CACHE_TTL'] = 300
+    self.app.config['TOKEN_CACHE_SIZE'] = 10000
+    for key in token_cache.connection.scan_iter(f"{token_cache.prefix}:*"):
+      token_cache.connection.delete(key)
+
+  def tearDown(self):
+    self.app.config['TOKEN_CACHE_TTL'] = 300
+    super().tearDown()
+
+  def test_cache_hit(self):
+    test_user = _create_user()
+    test_user.tokens.append(Token(token='schoko-banane'))
+    db.session.commit()
+
+    token_auth = TokenAuthenticator()
+    with mock.patch.object(Token, 'check_token', autospec=True, side_effect=lambda self, t: True) as check_mock:
+      identity = token_auth._get_identity('schoko-banane')
+      self.assertEqual(identity.user.username, test_user.username)
+      identity = token_auth._get_identity('schoko-banane')
+      self.assertEqual(identity.user.username, test_user.username)
+    check_mock.assert_called_once()
+
+    stats = token_cache.stats()
+    self.assertEqual(stats['hits'], 1)
+    self.assertEqual(stats['misses'], 1)
+    self.assertEqual(stats['size'], 1)
+
+  def test_cache_no_plain_token(self):
+    test_user = _create_user()
+    test_user.tokens.append(Token(token='schoko-banane'))
+    db.session.commit()
+
+    TokenAuthenticator()._get_identity('schoko-banane')
+    for key in token_cache.connection.scan_iter(f"{token_cache.prefix}:*"):
+      self.assertNotIn(b'schoko-banane', key)
+
+  def test_cache_disabled(self):
+    self.app.config['TOKEN_CACHE_TTL'] = 0
+    test_user = _create_user()
+    test_user.tokens.append(Token(token='schoko-banane'))
+    db.session.commit()
+
+    token_auth = TokenAuthenticator()
+    with mock.patch.object(Token, 'check_token', autospec=True, side_effect=lambda self, t: True) as check_mock:
+      token_auth._get_identity('schoko-banane')
+      token_auth._get_identity('schoko-banane')
+    self.assertEqual(check_mock.call_count, 2)
+
+  def test_cache_invalid_not_cached(self):
+    test_user = _create_user()
+    test_user.tokens.append(Token(token='schoko-banane'))
+    db.session.commit()
+
+    token_auth = TokenAuthenticator()
+    with self.assertRaises(errors.Unauthorized):
+      token_auth._get_identity('schoko-banane-falsch')
+    self.assertEqual(token_cache.stats()['size'], 0)
+
+  def test_invalidate_token_deleted(self):
+    test_user = _create_user()
+    token = Token(token='schoko-banane')
+    test_user.tokens.append(token)
+    db.session.commit()
+
+    token_auth = TokenAuthenticator()
+    token_auth._get_identity('schoko-banane')
+    self.assertIsNotNone(token_cache.get('schoko-banane'))
+
+    db.session.delete(token)
+    db.session.commit()
+    self.assertEqual(token_cache.stats()['size'], 0)
+    self.assertIsNone(token_cache.get('schoko-banane'))
+    with self.assertRaises(errors.Unauthorized):
+      token_auth._get_identity('schoko-banane')
+
+  def test_invalidate_token_deleted_flag(self):
+    test_user = _create_user()
+    token = Token(token='schoko-banane')
+    test_user.tokens.append(token)
+    db.session.commit()
+
+    token_auth = TokenAuthenticator()
+    token_auth._get_identity('schoko-banane')
+    token.deleted = True
+    db.session.commit()
+    self.assertEqual(token_cache.stats()['size'], 0)
+    with self.assertRaises(errors.Unauthorized):
+      token_auth._get_identity('schoko-banane')
+
+  def test_invalidate_user_deactivated(self):
+    test_user = _create_user()
+    test_user.tokens.append(Token(token='schoko-banane'))
+    db.session.commit()
+
+    token_auth = TokenAuthenticator()
+    token_auth._get_identity('schoko-banane')
+    self.assertEqual(token_cache.stats()['size'], 1)
+
+    test_user.is_active = False
+    db.session.commit()
+    self.assertEqual(token_cache.stats()['size'], 0)
+    with self.assertRaises(errors.Unauthorized):
+      token_auth._get_identity('schoko-banane')
+
+  def test_refresh_keeps_entry(self):
+    test_user = _create_user()
+    token = Token(token='schoko-banane', source='auto')
+    token.refresh()
+    test_user.tokens.append(token)
+    db.session.commit()
+
+    token_auth = TokenAuthenticator()
+    token_auth._get_identity('schoko-banane')
+    token.refresh()
+    db.session.commit()
+    self.assertEqual(token_cache.stats()['size'], 1)
+
+    token.expiresAt = datetime.now() - timedelta(minutes=1)
+    db.session.commit()
+    self.assertEqual(token_cache.stats()['size'], 0)
+
+  def test_expired(self):
+    test_user = _create_user()
+    token = Token(token='schoko-banane', expiresAt=datetime.now() + timedelta(seconds=5))
+    test_user.tokens.append(token)
+    db.session.commit()
+
+    token_auth = TokenAuthenticator()
+    token_auth._get_identity('schoko-banane')
+    ttl = token_cache.connection.ttl(token_cache._key(token_cache._digest('schoko-banane')))
+    self.assertLessEqual(ttl, 5)
+
+    # expiry is checked on cache hits too
+    with mock.patch('Hinkskalle.util.auth.token.datetime') as dt_mock:
+      dt_mock.datetime.now.return_value = datetime.now() + timedelta(seconds=10)
+      with self.assertRaises(errors.Unauthorized):
+        token_auth._get_identity('schoko-banane')
+
+  def test_regenerated_token(self):
+    test_user = _create_user()
+    token = Token(token='schoko-banane')
+    test_user.tokens.append(token)
+    db.session.commit()
+
+    TokenAuthenticator()._get_identity('schoko-banane')
+    # bypass events, simulate id re-use/changed hash
+    Token.query.filter(Token.id==token.id).update({ '_token': Token(token='schoko-banane-neu').token })
+    db.session.commit()
+    self.assertIsNone(token_cache.get('schoko-banane'))
+
+  def test_size_bound(self):
+    self.app.config['TOKEN_CACHE_SIZE'] = 2
+    test_user = _create_user()
+    for i in range(4):
+      test_user.tokens.append(Token(token=f"{i}-schoko-banane"))
+    db.session.commit()
+
+    token_auth = TokenAuthenticator()
+    for i in range(4):
+      token_auth._get_identity(f"{i}-schoko-banane")
+    self.assertEqual(token_cache.stats()['size'], 2)
+    self.assertIsNone(token_cache.get('0-schoko-banane'))
+    self.assertIsNotNone(token_cache.get('3-schoko-banane'))
@@ -0,0 +1,125 @@
+from unittest import mock
+from datetime import datetime, timedelta
+
+from Hinkskalle import db
+from ..route_base import RouteBase
+from .._util import _create_user
+
+from flask_rebar import errors
+
+from Hinkskalle.util.auth.token import TokenAuthenticator
+from Hinkskalle.util.auth.refresh import token_refresher
+from Hinkskalle.models import Token
+
+class TestTokenRefresh(RouteBase):
+  def setUp(self):
+    super().setUp()
+    self.app.config['TOKEN_REFRESH_THRESHOLD'] = 43200
+    self.app.config['TOKEN_REFRESH_BATCH'] = 100
+    self.app.config['TOKEN_REFRESH_FLUSH_INTERVAL'] = 60
+    for key in token_refresher.connection.scan_iter(f"{token_refresher.prefix}:*"):
+      token_refresher.connection.delete(key)
+
+  def _create_token(self, expiresAt: datetime, token_text='schoko-banane') -> Token:
+    user = _create_user()
+    token = Token(token=token_text, source='auto', expiresAt=expiresAt)
+    user.tokens.append(token)
+    db.session.commit()
+    return token
+
+  def test_no_refresh_above_threshold(self):
+    expiration = datetime.now() + timedelta(hours=20)
+    token = self._create_token(expiration)
+    with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}):
+      TokenAuthenticator().authenticate()
+    self.assertIsNone(token_refresher.pending_expiration(token))
+    self.assertEqual(token_refresher.flush(), 0)
+    self.assertEqual(Token.query.get(token.id).expiresAt, expiration)
+
+  def test_refresh_buffered(self):
+    expiration = datetime.now() + timedelta(hours=1)
+    token = self._create_token(expiration)
+    with mock.patch('Hinkskalle.util.jobs.flush_token_refreshes') as job_mock:
+      for _ in range(3):
+        with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}):
+          TokenAuthenticator().authenticate()
+    # first refresh schedules a delayed flush
+    job_mock.schedule.assert_called_once_with(timedelta(seconds=60))
+    job_mock.queue.assert_not_called()
+
+    # nothing written yet
+    db.session.expire_all()
+    self.assertEqual(Token.query.get(token.id).expiresAt, expiration)
+    pending = token_refresher.pending_expiration(token)
+    self.assertLess(abs(pending - (datetime.now()+Token.defaultExpiration)), timedelta(minutes=1)) # type: ignore
+
+    self.assertEqual(token_refresher.flush(), 1)
+    db.session.expire_all()
+    self.assertLess(abs(Token.query.get(token.id).expiresAt - (datetime.now()+Token.defaultExpiration)), timedelta(minutes=1))
+    self.assertIsNone(token_refresher.pending_expiration(token))
+
+  def test_flush_batch(self):
+    self.app.config['TOKEN_REFRESH_BATCH'] = 2
+    user = _create_user()
+    for i in range(2):
+      user.tokens.append(Token(token=f"{i}-schoko-banane", source='auto', expiresAt=datetime.now() + timedelta(hours=1)))
+    db.session.commit()
+
+    with mock.patch('Hinkskalle.util.jobs.flush_token_refreshes.queue') as queue_mock:
+      with self.app.test_request_context('', headers={'Authorization': 'Bearer 0-schoko-banane'}):
+        TokenAuthenticator().authenticate()
+      queue_mock.assert_not_called()
+      with self.app.test_request_context('', headers={'Authorization': 'Bearer 1-schoko-banane'}):
+        TokenAuthenticator().authenticate()
+      queue_mock.assert_called_once()
+
+  def test_flush_interval(self):
+    self.app.config['TOKEN_REFRESH_FLUSH_INTERVAL'] = 0
+    self._create_token(datetime.now() + timedelta(hours=1))
+    with mock.patch('Hinkskalle.util.jobs.flush_token_refreshes') as job_mock:
+      with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}):
+        TokenAuthenticator().authenticate()
+    job_mock.schedule.assert_not_called()
+    job_mock.queue.assert_called_once()
+
+  def test_flush_interval_pending(self):
+    token = self._create_token(datetime.now() + timedelta(hours=1))
+    with mock.patch('Hinkskalle.util.jobs.flush_token_refreshes') as job_mock:
+      with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}):
+        TokenAuthenticator().authenticate()
+      job_mock.schedule.assert_called_once()
+      # flushed, the next one in the buffer schedules again
+      token_refresher.flush()
+      db.session.expire_all()
+      Token.query.get(token.id).expiresAt = datetime.now() + timedelta(hours=1)
+      db.session.commit()
+      with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}):
+        TokenAuthenticator().authenticate()
+    self.assertEqual(job_mock.schedule.call_count, 2)
+
+  def test_pending_extends_expired(self):
+    token = self._create_token(datetime.now() + timedelta(seconds=2))
+    with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}):
+      TokenAuthenticator().authenticate()
+
+    with mock.patch('Hinkskalle.util.auth.token.datetime') as dt_mock:
+      dt_mock.datetime.now.return_value = datetime.now() + timedelta(minutes=5)
+      identity = TokenAuthenticator()._get_identity('schoko-banane')
+    self.assertEqual(identity.id, token.id)
+
+  def test_expired_not_refreshed(self):
+    self._create_token(datetime.now() - timedelta(minutes=1))
+    with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}):
+      with self.assertRaises(errors.Unauthorized):
+        TokenAuthenticator().authenticate()
+
+  def test_flush_deleted(self):
+    token = self._create_token(datetime.now() + timedelta(hours=1))
+    with self.app.test_request_context('', headers={'Authorization': 'Bearer schoko-banane'}):
+      TokenAuthenticator().authenticate()
+    token.deleted = True
+    expiration = token.expiresAt
+    db.session.commit()
+    token_refresher.flush()
+    db.session.expire_all()
+    self.assertEqual(Token.query.get(token.id).expiresAt, expiration)
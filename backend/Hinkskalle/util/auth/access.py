@@ -0,0 +1,84 @@
+import typing
+from functools import wraps
+from itertools import chain
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# access checks walk container -> collection -> entity -> group and look
+# up the group membership on every step. Listings run this for every row
+# (canEdit, search, stars). Within a request we load the memberships of a
+# user only once and remember the decisions per object.
+class AccessContext():
+  def __init__(self, user):
+    self.user_id = user.id
+    self._roles: typing.Optional[typing.Dict[int, typing.Any]] = None
+    self.decisions: typing.Dict[typing.Tuple[str, typing.Any, str], bool] = {}
+
+  @property
+  def roles(self) -> typing.Dict[int, typing.Any]:
+    if self._roles is None:
+      from Hinkskalle.models.User import UserGroup
+      self._roles = { ug.group_id: ug.role for ug in UserGroup.query.filter(UserGroup.user_id == self.user_id) }
+    return self._roles
+
+def _contexts() -> typing.Optional[typing.Dict[int, AccessContext]]:
+  if not has_request_context():
+    return None
+  # tests (and cli commands) can push several requests within one app
+  # context, g would survive them.
+  current = request._get_current_object() # type: ignore
+  stored = g.get('_access_contexts')
+  if stored is None or stored[0] is not current:
+    stored = (current, {})
+    g._access_contexts = stored
+  return stored[1]
+
+def get_access_context(user) -> typing.Optional[AccessContext]:
+  if user is None or user.id is None:
+    return None
+  contexts = _contexts()
+  if contexts is None:
+    return None
+  if user.id not in contexts:
+    contexts[user.id] = AccessContext(user)
+  return contexts[user.id]
+
+def reset_access_context() -> None:
+  if has_request_context():
+    g.pop('_access_contexts', None)
+
+def group_role(group, user):
+  """role of user in group, None if not a member"""
+  ctx = get_access_context(user)
+  if ctx is None:
+    ug = group.get_member(user)
+    return ug.role if ug else None
+  return ctx.roles.get(group.id)
+
+def memoize_access(kind: str):
+  def decorator(f):
+    @wraps(f)
+    def wrapper(self, user):
+      ctx = get_access_context(user)
+      if ctx is None or self.id is None:
+        return f(self, user)
+      key = (self.__class__.__name__, self.id, kind)
+      if key not in ctx.decisions:
+        ctx.decisions[key] = f(self, user)
+      return ctx.decisions[key]
+    return wrapper
+  return decorator
+
+# anything that can change a decision resets the whole context, it gets
+# rebuilt on the next check.
+_RELEVANT = ('User', 'UserGroup', 'Group', 'Entity', 'Collection', 'Container', 'Image')
+
+def _after_flush(session, flush_context):
+  for obj in chain(session.new, session.dirty, session.deleted):
+    if obj.__class__.__name__ in _RELEVANT:
+      reset_access_context()
+      return
+
+event.listen(Session, 'after_flush', _after_flush)
@@ -0,0 +1,48 @@
+import typing
+from calendar import timegm
+from datetime import datetime
+
+import jwt
+from flask import current_app
+from flask_rebar import errors
+
+# short-lived, self-contained access tokens for the OCI bearer flow. They
+# carry everything needed for authentication, so there is no token lookup
+# and no hash check. The DB tokens handed out at login serve as refresh
+# credentials to get a new one.
+_TYPE = 'access'
+
+def enabled() -> bool:
+  return bool(current_app.config.get('OCI_ACCESS_TOKEN_JWT', False))
+
+def expiration() -> int:
+  return int(current_app.config.get('OCI_ACCESS_TOKEN_EXPIRATION', 300))
+
+def is_access_token(token: str) -> bool:
+  # our DB tokens are url-safe base64 without dots
+  return token.count('.') == 2
+
+def create_access_token(user) -> str:
+  now = timegm(datetime.utcnow().utctimetuple())
+  return jwt.encode({
+    'sub': str(user.id),
+    'username': user.username,
+    'adm': bool(user.is_admin),
+    'type': _TYPE,
+    'iat': now,
+    'exp': now + expiration(),
+  }, current_app.config['SECRET_KEY'], algorithm="HS256")
+
+def decode_access_token(token: str) -> typing.Dict[str, typing.Any]:
+  try:
+    decoded = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"], options={ 'require': ['exp', 'sub'] })
+  except jwt.ExpiredSignatureError as err:
+    current_app.logger.debug(f"access token: {err}")
+    raise errors.Unauthorized('Token expired')
+  except jwt.InvalidTokenError as err:
+    current_app.logger.debug(f"access token: {err}")
+    raise errors.Unauthorized('Invalid token')
+  if decoded.get('type') != _TYPE:
+    current_app.logger.debug(f"access token type mismatch: {decoded.get('type')}")
+    raise errors.Unauthorized('Invalid token')
+  return decoded
@@ -0,0 +1,141 @@
+import hmac
+import hashlib
+import json
+import time
+from datetime import datetime
+
+from flask import current_app, has_app_context
+from redis.exceptions import RedisError
+
+# tokens verified once (sha512_crypt, expensive!) are remembered in redis
+# for a short while. We never store the bearer string itself, only a keyed
+# digest (HMAC with SECRET_KEY), so a redis dump does not leak tokens.
+class TokenCache():
+  prefix = 'hinkskalle:token_cache'
+
+  @property
+  def ttl(self) -> int:
+    return int(current_app.config.get('TOKEN_CACHE_TTL', 0))
+
+  @property
+  def size(self) -> int:
+    return int(current_app.config.get('TOKEN_CACHE_SIZE', 0))
+
+  @property
+  def enabled(self) -> bool:
+    return self.ttl > 0
+
+  @property
+  def connection(self):
+    from Hinkskalle.util.jobs import rq
+    return rq.connection
+
+  def _digest(self, token: str) -> str:
+    return hmac.new(current_app.config['SECRET_KEY'].encode('utf8'), token.encode('utf8'), hashlib.sha256).hexdigest()
+
+  @staticmethod
+  def _hash_fingerprint(stored_hash: str) -> str:
+    return hashlib.sha256(stored_hash.encode('utf8')).hexdigest()
+
+  def _key(self, digest: str) -> str:
+    return f"{self.prefix}:entry:{digest}"
+
+  def get(self, token: str):
+    """returns the Token for an already verified bearer string or None"""
+    from Hinkskalle.models.User import Token
+    if not self.enabled or not token:
+      return None
+    try:
+      cached = self.connection.get(self._key(self._digest(token)))
+      if cached is None:
+        self.connection.incr(f"{self.prefix}:misses")
+        return None
+      data = json.loads(cached)
+      db_token = Token.query.get(data['id'])
+      # make sure that the row still holds the very hash we verified
+      # against (ids could be recycled, token could be re-generated)
+      if not db_token or db_token.deleted or not db_token.token or self._hash_fingerprint(db_token.token) != data['hash']:
+        self.connection.delete(self._key(self._digest(token)))
+        self.connection.incr(f"{self.prefix}:misses")
+        return None
+      self.connection.incr(f"{self.prefix}:hits")
+      return db_token
+    except RedisError as err:
+      current_app.logger.debug(f"token cache get failed: {err}")
+      return None
+
+  def set(self, token: str, db_token) -> None:
+    if not self.enabled or not token or not db_token.token:
+      return
+    ttl = self.ttl
+    if db_token.expiresAt:
+      ttl = min(ttl, int((db_token.expiresAt - datetime.now()).total_seconds()))
+    if ttl <= 0:
+      return
+    digest = self._digest(token)
+    key = self._key(digest)
+    try:
+      pipe = self.connection.pipeline()
+      pipe.set(key, json.dumps({
+        'id': db_token.id,
+        'user_id': db_token.user_id,
+        'hash': self._hash_fingerprint(db_token.token),
+      }), ex=ttl)
+      pipe.sadd(f"{self.prefix}:token:{db_token.id}", key)
+      pipe.expire(f"{self.prefix}:token:{db_token.id}", self.ttl)
+      pipe.sadd(f"{self.prefix}:user:{db_token.user_id}", key)
+      pipe.expire(f"{self.prefix}:user:{db_token.user_id}", self.ttl)
+      pipe.zadd(f"{self.prefix}:index", { key: time.time() })
+      pipe.execute()
+      self._trim()
+    except RedisError as err:
+      current_app.logger.debug(f"token cache set failed: {err}")
+
+  def _trim(self) -> None:
+    index = f"{self.prefix}:index"
+    # drop index entries whose keys already expired on their own
+    self.connection.zremrangebyscore(index, '-inf', time.time() - self.ttl)
+    if self.size <= 0:
+      return
+    excess = self.connection.zcard(index) - self.size
+    if excess > 0:
+      evicted = [ key for key, _ in self.connection.zpopmin(index, excess) ]
+      self.connection.delete(*evicted)
+
+  def _drop(self, index_key: str) -> None:
+    keys = self.connection.smembers(index_key)
+    pipe = self.connection.pipeline()
+    if keys:
+      pipe.delete(*keys)
+      pipe.zrem(f"{self.prefix}:index", *keys)
+    pipe.delete(index_key)
+    pipe.execute()
+
+  def invalidate_token(self, token_id: int) -> None:
+    if not has_app_context() or not self.enabled:
+      return
+    try:
+      self._drop(f"{self.prefix}:token:{token_id}")
+    except RedisError as err:
+      current_app.logger.warning(f"token cache invalidation for token {token_id} failed: {err}")
+
+  def invalidate_user(self, user_id: int) -> None:
+    if not has_app_context() or not self.enabled:
+      return
+    try:
+      self._drop(f"{self.prefix}:user:{user_id}")
+    except RedisError as err:
+      current_app.logger.warning(f"token cache invalidation for user {user_id} failed: {err}")
+
+  def stats(self) -> dict:
+    conn = self.connection
+    return {
+      'enabled': self.enabled,
+      'ttl': self.ttl,
+      'maxSize': self.size,
+      'size': conn.zcard(f"{self.prefix}:index"),
+      'hits': int(conn.get(f"{self.prefix}:hits") or 0),
+      'misses': int(conn.get(f"{self.prefix}:misses") or 0),
+    }
+
+token_cache = TokenCache()
@@ -5,12 +5,20 @@ from sqlalchemy.orm.exc import NoResultFound  # type: ignore
 
 from ldap3 import Server, Connection, ObjectDef, Reader, SUBTREE, SYNC, SCHEMA
 from ldap3.utils.conv import escape_filter_chars
-from ldap3.core.exceptions import LDAPBindError, LDAPInvalidCredentialsResult, LDAPPasswordIsMandatoryError, LDAPNoSuchObjectResult
+from ldap3.protocol.formatters.formatters import format_time
+from ldap3.core.exceptions import LDAPBindError, LDAPInvalidCredentialsResult, LDAPPasswordIsMandatoryError, LDAPNoSuchObjectResult, LDAPCommunicationError
 
 from slugify import slugify
 
 from flask import g, current_app
 
+from contextlib import contextmanager
+import queue
+import threading
+import time
+import typing
+from datetime import datetime, timezone
+
 # mock ldap returns scalar, real ldap (slapd) a list
 # make sure we can deal with both
 def _get_attr(attr):
@@ -19,8 +27,78 @@ def _get_attr(attr):
   else:
     return attr
 
+def _get_timestamp(attr) -> typing.Optional[str]:
+  """modifyTimestamp as generalized time string in UTC (YYYYmmddHHMMSSZ),
+  whether ldap3 could parse it or not. Servers may send fractions or
+  offsets, normalized strings can be compared as they are."""
+  if not attr:
+    return None
+  value = _get_attr(attr)
+  if not value:
+    return None
+  if not isinstance(value, datetime):
+    value = format_time(value if isinstance(value, bytes) else str(value).encode('utf8'))
+    if not isinstance(value, datetime):
+      return None
+  return value.astimezone(timezone.utc).strftime('%Y%m%d%H%M%SZ')
+
+class ConnectionPool:
+  """keeps up to `size` open connections around. Uses the threading/queue
+  primitives, which are greenlet-aware once gevent has monkey patched them."""
+  def __init__(self, factory: typing.Callable[[], Connection], size: int=4, timeout: float=10):
+    self.factory = factory
+    self.size = size
+    self.timeout = timeout
+    self._idle: queue.LifoQueue = queue.LifoQueue()
+    self._created = 0
+    self._lock = threading.Lock()
+
+  def _checkout(self) -> Connection:
+    try:
+      return self._idle.get_nowait()
+    except queue.Empty:
+      pass
+    with self._lock:
+      create = self._created < self.size
+      if create:
+        self._created += 1
+    if create:
+      try:
+        return self.factory()
+      except:
+        with self._lock:
+          self._created -= 1
+        raise
+    try:
+      return self._idle.get(timeout=self.timeout)
+    except queue.Empty:
+      raise Exception(f"no ldap connection available after {self.timeout}s")
+
+  def _discard(self, conn: Connection) -> None:
+    with self._lock:
+      self._created -= 1
+    try:
+      conn.unbind()
+    except Exception:
+      pass
+
+  @contextmanager
+  def connection(self):
+    conn = self._checkout()
+    try:
+      yield conn
+    except LDAPCommunicationError:
+      # broken socket, don't hand it out again
+      self._discard(conn)
+      raise
+    except:
+      self._idle.put(conn)
+      raise
+    else:
+      self._idle.put(conn)
+
 class LDAPService:
-  def __init__(self, host, base_dn, filter, all_users_filter, port=389, bind_dn=None, bind_password=None, get_info=SCHEMA, client_strategy=SYNC):
+  def __init__(self, host, base_dn, filter, all_users_filter, port=389, bind_dn=None, bind_password=None, get_info=SCHEMA, client_strategy=SYNC, pool_size=4, dn_cache_ttl=60):
     self.host = host
     self.port = int(port) if port else None
     self.bind_dn = bind_dn
@@ -28,10 +106,31 @@ class LDAPService:
     self.base_dn = base_dn
     self.filter = filter
     self.all_users_filter = all_users_filter
+    self.client_strategy = client_strategy
 
     self.server = Server(host=self.host, port=self.port, get_info=get_info) # type: ignore
     self.connection = Connection(self.server, self.bind_dn, self.bind_password, raise_exceptions=True, client_strategy=client_strategy) # type: ignore
 
+    # service connections (bound as bind_dn) for searches and separate
+    # ones for checking user credentials, so that a failed user bind
+    # never leaves a service connection in a weird state.
+    self.pool = ConnectionPool(self._service_connection, size=pool_size)
+    self.bind_pool = ConnectionPool(self._bind_connection, size=pool_size)
+
+    self.dn_cache_ttl = dn_cache_ttl
+    self._dn_cache: typing.Dict[str, typing.Tuple[float, dict]] = {}
+    self._dn_cache_lock = threading.Lock()
+
+  def _service_connection(self) -> Connection:
+    conn = Connection(self.server, self.bind_dn, self.bind_password, raise_exceptions=True, client_strategy=self.client_strategy) # type: ignore
+    conn.bind()
+    return conn
+
+  def _bind_connection(self) -> Connection:
+    conn = Connection(self.server, raise_exceptions=True, client_strategy=self.client_strategy) # type: ignore
+    conn.open()
+    return conn
+
   def connect(self):
     self.connection.rebind(user=self.bind_dn, password=self.bind_password)
 
@@ -39,19 +138,54 @@ class LDAPService:
     self.connection.unbind()
 
   def search_user(self, username: str):
-    try:
-      self.connection.search(
+    with self.pool.connection() as conn:
+      try:
+        conn.search(
+          search_base=self.base_dn,
+          search_filter=self.filter.format(escape_filter_chars(username)),
+          search_scope=SUBTREE,
+          attributes='*')
+      except LDAPNoSuchObjectResult:
+        raise UserNotFound()
+      if conn.response is None:
+        raise Exception("No response received.")
+      elif len(conn.response) == 0:
+        raise UserNotFound()
+      return conn.response[0]
+
+  def get_user(self, username: str):
+    """search_user, but remembers results for dn_cache_ttl seconds"""
+    now = time.monotonic()
+    with self._dn_cache_lock:
+      cached = self._dn_cache.get(username)
+    if cached and cached[0] > now:
+      return cached[1]
+    entry = self.search_user(username)
+    if self.dn_cache_ttl > 0:
+      with self._dn_cache_lock:
+        self._dn_cache = { k: v for k, v in self._dn_cache.items() if v[0] > now }
+        self._dn_cache[username] = (now + self.dn_cache_ttl, entry)
+    return entry
+
+  def check_bind(self, dn: str, password: str) -> None:
+    with self.bind_pool.connection() as conn:
+      conn.rebind(user=dn, password=password)
+
+  def iter_users(self, page_size: int=500, modified_since: typing.Optional[str]=None):
+    """like list_users, but fetches the entries in pages. With
+    modified_since (generalized time) only entries changed after that."""
+    search_filter = self.all_users_filter
+    if modified_since:
+      search_filter = f"(&{search_filter}(modifyTimestamp>={escape_filter_chars(modified_since)}))"
+    for entry in self.connection.extend.standard.paged_search(
         search_base=self.base_dn,
-        search_filter=self.filter.format(escape_filter_chars(username)),
+        search_filter=search_filter,
         search_scope=SUBTREE,
-        attributes='*')
-    except LDAPNoSuchObjectResult:
-      raise UserNotFound()
-    if self.connection.response is None:
-      raise Exception("No response received.")
-    elif len(self.connection.response) == 0:
-      raise UserNotFound()
-    return self.connection.response[0]
+        attributes=['*', 'modifyTimestamp'],
+        paged_size=page_size,
+        generator=True):
+      if entry.get('type') == 'searchResEntry':
+        yield entry
 
   def list_users(self):
     self.connection.search(
@@ -96,6 +230,8 @@ class LDAPUsers(PasswordCheckerBase):
         base_dn=self.config.get('BASE_DN'),
         filter=self.config.get('FILTERS', {}).get('user', self.default_filter),
         all_users_filter=self.config.get('FILTERS', {}).get('all_users', self.default_all_users_filter),
+        pool_size=int(self.config.get('POOL_SIZE', 4)),
+        dn_cache_ttl=int(self.config.get('DN_CACHE_TTL', 60)),
       )
     else:
       self.ldap = svc
@@ -108,6 +244,111 @@ class LDAPUsers(PasswordCheckerBase):
     self.username_attr = self.attrmap.get('username')
     self.attrmap.pop('username')
 
+  def entry_username(self, entry) -> str:
+    return self._user_values(entry.get('attributes'))[0]
+
+  def deactivate_missing(self, seen: typing.Set[str]) -> typing.List[str]:
+    """deactivate ldap users that were not seen in a full sync"""
+    from Hinkskalle.models.User import User
+    from Hinkskalle import db
+
+    active = { row.username for row in db.session.query(User.username).filter(User.source == 'ldap', User.is_active == True) }
+    missing = sorted(active - seen)
+    for user in User.query.filter(User.username.in_(missing)) if missing else []:
+      user.is_active = False
+      user.ldap_deactivated = True
+    db.session.commit()
+    return missing
+
+  @staticmethod
+  def _reactivate(user) -> bool:
+    """undo deactivate_missing for users that show up again"""
+    if not user.ldap_deactivated:
+      return False
+    current_app.logger.info(f"reactivating {user.username}, back in ldap")
+    user.is_active = True
+    user.ldap_deactivated = False
+    return True
+
+  def _user_values(self, attrs) -> typing.Tuple[str, typing.Dict[str, typing.Any]]:
+    username = slugify(_get_attr(attrs.get(self.username_attr)), separator='.')
+    return username, { k: _get_attr(attrs.get(v)) for (k, v) in self.attrmap.items() }
+
+  @staticmethod
+  def _changed(user, values: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    # email gets lowercased on assignment
+    return { k: v for (k, v) in values.items() if getattr(user, k) != (v.lower() if k == 'email' and v else v) }
+
+  def sync_users(self, entries: typing.List[dict]) -> typing.Dict[str, typing.List[str]]:
+    """sync a batch of ldap entries with a single lookup for users and
+    entities and one commit. Returns synced usernames, conflicting and
+    failed cns."""
+    from Hinkskalle.models.User import User
+    from Hinkskalle.models.Entity import Entity
+    from Hinkskalle import db
+
+    result: typing.Dict[str, typing.List[str]] = { 'synced': [], 'conflict': [], 'failed': [] }
+    prepared = []
+    for entry in entries:
+      attrs = entry.get('attributes')
+      cn = _get_attr(attrs.get('cn'))
+      try:
+        username, values = self._user_values(attrs)
+      except Exception as exc:
+        current_app.logger.warning(f"sync {cn}: {exc}")
+        result['failed'].append(cn)
+        continue
+      prepared.append((entry, cn, username, values))
+
+    usernames = [ p[2] for p in prepared ]
+    users = { u.username: u for u in User.query.filter(User.username.in_(usernames)) }
+    entities = { e.name for e in Entity.query.filter(Entity.name.in_(usernames)) }
+
+    for entry, cn, username, values in prepared:
+      user = users.get(username)
+      if user is not None and user.source != 'ldap':
+        result['conflict'].append(cn)
+        continue
+      try:
+        if user is None:
+          user = User(username=username, is_admin=False, is_active=True, source='ldap', **values)
+          db.session.add(user)
+          users[username] = user
+        else:
+          for (k, v) in self._changed(user, values).items():
+            setattr(user, k, v)
+          self._reactivate(user)
+        if username not in entities:
+          db.session.add(Entity(name=username, owner=user))
+          entities.add(username)
+      except Exception as exc:
+        current_app.logger.warning(f"sync {cn}: {exc}")
+        result['failed'].append(cn)
+        continue
+      result['synced'].append(username)
+
+    try:
+      db.session.commit()
+    except Exception as exc:
+      # somebody in here is broken (e.g. duplicate email), go
+      # through them one by one to find out who.
+      db.session.rollback()
+      current_app.logger.warning(f"batch sync failed ({exc}), falling back to single sync")
+      result['synced'] = []
+      for entry, cn, username, values in prepared:
+        if cn in result['conflict']:
+          continue
+        try:
+          result['synced'].append(self.sync_user(entry).username)
+        except UserConflict:
+          db.session.rollback()
+          result['conflict'].append(cn)
+        except Exception as exc:
+          db.session.rollback()
+          current_app.logger.warning(f"sync {cn}: {exc}")
+          result['failed'].append(cn)
+    return result
+
   def sync_user(self, entry):
     from Hinkskalle.models.User import User
     from Hinkskalle.models.Entity import Entity
@@ -125,13 +366,19 @@ class LDAPUsers(PasswordCheckerBase):
       user.is_admin = False
       user.is_active = True
 
-    user.username = slugify(_get_attr(attrs.get(self.username_attr)), separator='.')
-    for (k, v) in self.attrmap.items():
-      setattr(user, k, _get_attr(attrs.get(v)))
-    user.source = 'ldap'
+    username, values = self._user_values(attrs)
+    # nothing changed since the last login, save the writes
+    if user.id is None or user.username != username or self._changed(user, values) or user.ldap_deactivated:
+      user.username = username
+      for (k, v) in values.items():
+        setattr(user, k, v)
+      user.source = 'ldap'
+      self._reactivate(user)
 
-    db.session.add(user)
-    db.session.commit()
+      db.session.add(user)
+      db.session.commit()
+
+    # also for unchanged users, their entity might be gone
     try:
       Entity.query.filter(Entity.name==user.username).one()
     except NoResultFound:
@@ -142,13 +389,11 @@ class LDAPUsers(PasswordCheckerBase):
     return user
 
   def check_password(self, username: str, password: str):
-    self.ldap.connect()
-    ldap_user = self.ldap.search_user(username)
+    ldap_user = self.ldap.get_user(username)
     try:
-      self.ldap.connection.rebind(user=ldap_user.get('dn'), password=password)
+      self.ldap.check_bind(ldap_user.get('dn'), password)
     except (LDAPInvalidCredentialsResult, LDAPPasswordIsMandatoryError):
       raise InvalidPassword()
-    self.ldap.close()
 
     db_user = self.sync_user(ldap_user)
     return db_user
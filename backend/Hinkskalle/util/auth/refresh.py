@@ -0,0 +1,117 @@
+import time
+import typing
+from datetime import datetime, timedelta
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+# auto tokens get their expiration extended on use. Instead of writing the
+# token row on every request we only extend once the remaining lifetime
+# drops below TOKEN_REFRESH_THRESHOLD, buffer the new expiration in redis
+# and write all pending refreshes in one go (see jobs.flush_token_refreshes)
+class TokenRefresher():
+  prefix = 'hinkskalle:token_refresh'
+
+  @property
+  def threshold(self) -> timedelta:
+    return timedelta(seconds=int(current_app.config.get('TOKEN_REFRESH_THRESHOLD', 0)))
+
+  @property
+  def batch_size(self) -> int:
+    return int(current_app.config.get('TOKEN_REFRESH_BATCH', 1))
+
+  @property
+  def flush_interval(self) -> int:
+    return int(current_app.config.get('TOKEN_REFRESH_FLUSH_INTERVAL', 0))
+
+  @property
+  def connection(self):
+    from Hinkskalle.util.jobs import rq
+    return rq.connection
+
+  def needs_refresh(self, token) -> bool:
+    if token.expiresAt is None:
+      return False
+    return token.expiresAt - datetime.now() < self.threshold
+
+  def refresh(self, token) -> None:
+    if not self.needs_refresh(token):
+      return
+    pending = self.pending_expiration(token)
+    if pending and pending - datetime.now() >= self.threshold:
+      return
+
+    new_expiration = datetime.now() + token.defaultExpiration
+    try:
+      pipe = self.connection.pipeline()
+      pipe.hset(f"{self.prefix}:pending", token.id, new_expiration.timestamp())
+      pipe.setnx(f"{self.prefix}:since", time.time())
+      pipe.hlen(f"{self.prefix}:pending")
+      pipe.get(f"{self.prefix}:since")
+      _, first, count, since = pipe.execute()
+    except RedisError as err:
+      # no buffer available, fall back to writing directly
+      current_app.logger.debug(f"token refresh buffer failed: {err}")
+      from Hinkskalle import db
+      token.refresh()
+      db.session.commit()
+      return
+
+    # busy tokens stay pending and don't come by here again, so the first
+    # one in the buffer makes sure it gets written after the interval.
+    if first and self.flush_interval > 0:
+      self._schedule_flush(delay=self.flush_interval)
+    if count >= self.batch_size or (since and time.time() - float(since) >= self.flush_interval):
+      self._schedule_flush()
+
+  def _schedule_flush(self, delay: typing.Optional[int]=None) -> None:
+    from Hinkskalle.util.jobs import flush_token_refreshes
+    try:
+      if delay:
+        flush_token_refreshes.schedule(timedelta(seconds=delay))
+      # only one immediate flush at a time
+      elif self.connection.set(f"{self.prefix}:scheduled", 1, nx=True, ex=max(self.flush_interval, 10)):
+        flush_token_refreshes.queue()
+    except RedisError as err:
+      current_app.logger.debug(f"scheduling token refresh flush failed: {err}")
+
+  def pending_expiration(self, token) -> typing.Optional[datetime]:
+    try:
+      pending = self.connection.hget(f"{self.prefix}:pending", token.id)
+    except RedisError as err:
+      current_app.logger.debug(f"token refresh lookup failed: {err}")
+      return None
+    return datetime.fromtimestamp(float(pending)) if pending else None
+
+  def flush(self) -> int:
+    from Hinkskalle import db
+    from Hinkskalle.models.User import Token
+    from sqlalchemy import bindparam
+
+    pipe = self.connection.pipeline()
+    pipe.hgetall(f"{self.prefix}:pending")
+    pipe.delete(f"{self.prefix}:pending", f"{self.prefix}:since", f"{self.prefix}:scheduled")
+    pending, _ = pipe.execute()
+    if not pending:
+      return 0
+
+    table = Token.__table__
+    # core update: skips orm events, nothing to invalidate here
+    stmt = table.update().where(
+      table.c.id == bindparam('_id')
+    ).where(
+      table.c.deleted == False
+    ).values(expiresAt=bindparam('_expires'))
+    try:
+      db.session.execute(stmt, [
+        { '_id': int(token_id), '_expires': datetime.fromtimestamp(float(expires)) } for token_id, expires in pending.items()
+      ])
+      db.session.commit()
+    except Exception:
+      db.session.rollback()
+      # put them back for the next try
+      self.connection.hset(f"{self.prefix}:pending", mapping=pending)
+      raise
+    return len(pending)
+
+token_refresher = TokenRefresher()
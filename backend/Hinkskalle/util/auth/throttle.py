@@ -0,0 +1,124 @@
+import hmac
+import hashlib
+import math
+import time
+import typing
+
+from flask import current_app, request, has_request_context
+from redis.exceptions import RedisError
+
+# failed logins cost a full hash verification (sha512_crypt for passwords,
+# legacy tokens). Remember credentials that just failed and let every
+# identity (username, client address) fail only so often. A client address
+# out of failures gets a 429 right away, before anything is verified. A
+# username only turns further failures into 429s, valid credentials for it
+# are still accepted, so nobody can lock out somebody else.
+class AuthThrottle():
+  prefix = 'hinkskalle:auth_throttle'
+
+  @property
+  def failure_ttl(self) -> int:
+    return int(current_app.config.get('AUTH_FAILURE_CACHE_TTL', 0))
+
+  @property
+  def burst(self) -> int:
+    return int(current_app.config.get('AUTH_THROTTLE_BURST', 0))
+
+  @property
+  def rate(self) -> float:
+    """failures per minute an identity gets back"""
+    return float(current_app.config.get('AUTH_THROTTLE_RATE', 0))
+
+  @property
+  def throttle_enabled(self) -> bool:
+    return self.burst > 0 and self.rate > 0
+
+  @property
+  def connection(self):
+    from Hinkskalle.util.jobs import rq
+    return rq.connection
+
+  def _digest(self, credential: str) -> str:
+    return hmac.new(current_app.config['SECRET_KEY'].encode('utf8'), credential.encode('utf8'), hashlib.sha256).hexdigest()
+
+  def _count(self, counter: str) -> None:
+    self.connection.hincrby(f"{self.prefix}:stats", counter, 1)
+
+  def _tokens(self, identity: str, now: float) -> float:
+    stored = self.connection.get(f"{self.prefix}:bucket:{identity}")
+    if stored is None:
+      return float(self.burst)
+    tokens, updated = [ float(v) for v in (stored.decode('utf8') if isinstance(stored, bytes) else stored).split(':') ]
+    return min(float(self.burst), tokens + (now - updated) * self.rate / 60)
+
+  def is_throttled(self, *identities: str) -> typing.Optional[int]:
+    """returns seconds until the next attempt is allowed, None if ok"""
+    if not self.throttle_enabled:
+      return None
+    now = time.time()
+    try:
+      for identity in identities:
+        tokens = self._tokens(identity, now)
+        if tokens < 1:
+          self._count('throttled')
+          return math.ceil((1 - tokens) * 60 / self.rate)
+    except RedisError as err:
+      current_app.logger.debug(f"auth throttle check failed: {err}")
+    return None
+
+  def is_known_bad(self, credential: str) -> bool:
+    if self.failure_ttl <= 0 or not credential:
+      return False
+    try:
+      if self.connection.exists(f"{self.prefix}:failed:{self._digest(credential)}"):
+        self._count('negative_hits')
+        return True
+    except RedisError as err:
+      current_app.logger.debug(f"auth failure cache check failed: {err}")
+    return False
+
+  def record_failure(self, credential: typing.Optional[str], *identities: str) -> None:
+    now = time.time()
+    try:
+      self._count('failures')
+      if credential and self.failure_ttl > 0:
+        self.connection.set(f"{self.prefix}:failed:{self._digest(credential)}", 1, ex=self.failure_ttl)
+      if not self.throttle_enabled:
+        return
+      for identity in identities:
+        tokens = self._tokens(identity, now) - 1
+        # gone once it would be full again
+        self.connection.set(f"{self.prefix}:bucket:{identity}", f"{tokens}:{now}", ex=math.ceil((self.burst - tokens) * 60 / self.rate) + 1)
+    except RedisError as err:
+      current_app.logger.debug(f"auth failure record failed: {err}")
+
+  def stats(self) -> dict:
+    counters = { (k.decode('utf8') if isinstance(k, bytes) else k): int(v) for k, v in self.connection.hgetall(f"{self.prefix}:stats").items() }
+    return {
+      'failureCacheTTL': self.failure_ttl,
+      'burst': self.burst,
+      'rate': self.rate,
+      'failures': counters.get('failures', 0),
+      'negativeHits': counters.get('negative_hits', 0),
+      'throttled': counters.get('throttled', 0),
+    }
+
+auth_throttle = AuthThrottle()
+
+def client_address() -> typing.Optional[str]:
+  """remote address, or the one the TRUSTED_PROXY_COUNT reverse proxies
+  in front of us saw (same as werkzeug's ProxyFix x_for)"""
+  trusted = int(current_app.config.get('TRUSTED_PROXY_COUNT', 0))
+  if trusted > 0:
+    forwarded = [ addr.strip() for addr in request.headers.get('X-Forwarded-For', '').split(',') if addr.strip() ]
+    if len(forwarded) >= trusted:
+      return forwarded[-trusted]
+  return request.remote_addr
+
+def client_identities(username: typing.Optional[str]=None) -> typing.List[str]:
+  identities = []
+  if has_request_context() and client_address():
+    identities.append(f"ip:{client_address()}")
+  if username:
+    identities.append(f"user:{username.lower()}")
+  return identities
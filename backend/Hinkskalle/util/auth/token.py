@@ -31,7 +31,9 @@ class ScopedTokenAuthenticator(Authenticator):
         raise err
     
     if self.scope == Scopes.admin:
-      if not g.authenticated_user.is_admin:
+      claims = g.get('access_token_claims')
+      is_admin = claims.get('adm', False) if claims else g.authenticated_user.is_admin
+      if not is_admin:
         raise errors.Forbidden('Admin privileges required.')
     
 class TokenAuthenticator(Authenticator):
@@ -44,29 +46,82 @@ class TokenAuthenticator(Authenticator):
   
   def authenticate(self) -> None:
     g.authenticated_user = None
-    token = self._get_identity(self._get_token())
+    g.access_token_claims = None
+    token_str = self._get_token()
+    from . import access_token
+    if access_token.enabled() and access_token.is_access_token(token_str):
+      self._authenticate_access_token(token_str)
+      return
+
+    token = self._get_identity(token_str)
     if token.source == 'auto':
-      token.refresh()
-      from Hinkskalle import db
-      db.session.commit()
+      from .refresh import token_refresher
+      token_refresher.refresh(token)
 
     g.authenticated_user = token.user
 
+  def _authenticate_access_token(self, token: str) -> None:
+    from Hinkskalle.models.User import User
+    from .access_token import decode_access_token
+    # signature and expiration are all we need to check, no token lookup.
+    claims = decode_access_token(token)
+    # handlers still need the user object, but it comes by primary key
+    user = User.query.get(int(claims['sub']))
+    if not user:
+      current_app.logger.debug(f"access token user {claims['sub']} not found")
+      raise errors.Unauthorized('Invalid token')
+    if not user.is_active:
+      current_app.logger.debug(f'{user.username} deactivated')
+      raise errors.Unauthorized('Account deactivated')
+    g.access_token_claims = claims
+    g.authenticated_user = user
+
+  def _failed(self, token: str) -> None:
+    from .throttle import auth_throttle, client_identities
+    identities = client_identities()
+    retry_after = auth_throttle.is_throttled(*identities)
+    auth_throttle.record_failure(token, *identities)
+    if retry_after:
+      raise errors.TooManyRequests(f'Too many failed attempts, retry in {retry_after}s', additional_data={ 'retryAfter': retry_after })
+    raise errors.Unauthorized('Invalid token')
+
   def _get_identity(self, token: str):
+    from Hinkskalle import db
     from Hinkskalle.models.User import Token
-    token_uid = token[:12]
-    db_token = Token.query.filter(Token.key_uid == token_uid, Token.deleted == False).first()
-    if not db_token:
-      current_app.logger.debug('Token not in db')
-      raise errors.Unauthorized('Invalid token')
-    if not db_token.check_token(token):
-      raise errors.Unauthorized('Invalid token')
+    from .cache import token_cache
+    db_token = token_cache.get(token)
+    verified = db_token is not None
+    if not verified:
+      from .throttle import auth_throttle, client_identities
+      retry_after = auth_throttle.is_throttled(*client_identities())
+      if retry_after:
+        raise errors.TooManyRequests(f'Too many failed attempts, retry in {retry_after}s', additional_data={ 'retryAfter': retry_after })
+      db_token = None
+      if not auth_throttle.is_known_bad(token):
+        token_uid = token[:12]
+        db_token = Token.query.filter(Token.key_uid == token_uid, Token.deleted == False).first()
+        if not db_token:
+          current_app.logger.debug('Token not in db')
+        elif not db_token.check_token(token):
+          db_token = None
+        elif db.session.is_modified(db_token):
+          # legacy hash upgraded. Authentication runs before the handler,
+          # nothing else is pending yet.
+          db.session.commit()
+      if not db_token:
+        self._failed(token)
     if not db_token.user.is_active:
       current_app.logger.debug(f'{db_token.user.username} deactivated')
       raise errors.Unauthorized('Account deactivated')
     if db_token.expiresAt and db_token.expiresAt < datetime.datetime.now():
-      current_app.logger.debug(f'token expired at {db_token.expiresAt}')
-      raise errors.Unauthorized('Token expired')
+      # refresh might not have been written to the db yet
+      from .refresh import token_refresher
+      pending = token_refresher.pending_expiration(db_token) if db_token.source == 'auto' else None
+      if not pending or pending < datetime.datetime.now():
+        current_app.logger.debug(f'token expired at {db_token.expiresAt}')
+        raise errors.Unauthorized('Token expired')
+    if not verified:
+      token_cache.set(token, db_token)
     return db_token
 
   def _get_token(self) -> str:
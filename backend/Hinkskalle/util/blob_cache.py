@@ -0,0 +1,195 @@
+import json
+import typing
+from itertools import chain
+
+from flask import current_app, has_app_context
+from redis.exceptions import RedisError
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+# every blob GET/HEAD resolves repository name and digest to an image file:
+# entity, collection and container lookups (case-insensitive), the
+# collection for the privacy check and the image itself. Layers are pulled
+# over and over by the same name, so we remember the result in redis,
+# together with what we need for the access decision.
+class CachedResolution():
+  fields: typing.Tuple[str, ...] = ()
+
+  def __init__(self, data: dict):
+    self.container_id: int = data['container_id']
+    self.private: bool = data['private']
+    self.owners: typing.List[str] = data['owners']
+    self.default_entity: bool = data['default_entity']
+    for field in self.fields:
+      setattr(self, field, data[field])
+
+  @staticmethod
+  def access_info(container) -> dict:
+    collection = container.collection_ref
+    entity = collection.entity_ref
+    return {
+      'container_id': container.id,
+      'private': bool(container.private or collection.private),
+      'owners': [ o for o in (container.createdBy, collection.createdBy, entity.createdBy) if o is not None ],
+      'default_entity': entity.name == 'default',
+    }
+
+  def to_json(self) -> str:
+    return json.dumps(self.__dict__)
+
+  def check_access(self, user) -> bool:
+    """same as Container.check_access, skipping the database where possible"""
+    if not self.private:
+      return True
+    if user is None:
+      return False
+    if user.is_admin or user.username in self.owners or self.default_entity:
+      return True
+    # group membership, ask the database
+    from Hinkskalle.models import Container
+    container = Container.query.get(self.container_id)
+    return container is not None and container.check_access(user)
+
+class BlobLocation(CachedResolution):
+  fields = ('image_id', 'hash', 'location', 'size')
+
+  @classmethod
+  def from_image(cls, image) -> 'BlobLocation':
+    return cls({
+      'image_id': image.id,
+      'hash': image.hash,
+      'location': image.location,
+      'size': image.size,
+      **cls.access_info(image.container_ref),
+    })
+
+class ResolutionCache():
+  """entries per (repository name, reference), indexed by container, collection and entity for invalidation"""
+  prefix = 'hinkskalle:resolution_cache'
+  ttl_setting = ''
+  entry_class = CachedResolution
+
+  @property
+  def ttl(self) -> int:
+    return int(current_app.config.get(self.ttl_setting, 0))
+
+  @property
+  def enabled(self) -> bool:
+    return self.ttl > 0
+
+  @property
+  def connection(self):
+    from Hinkskalle.util.jobs import rq
+    return rq.connection
+
+  def _key(self, name: str, reference: str) -> str:
+    return f"{self.prefix}:entry:{name.lower()}:{reference}"
+
+  def get(self, name: str, reference: str):
+    if not self.enabled:
+      return None
+    try:
+      cached = self.connection.get(self._key(name, reference))
+    except RedisError as err:
+      current_app.logger.debug(f"{self.prefix} get failed: {err}")
+      return None
+    if cached is None:
+      return None
+    return self.entry_class(json.loads(cached))
+
+  def _store(self, name: str, reference: str, entry: CachedResolution, container) -> None:
+    if not self.enabled:
+      return
+    key = self._key(name, reference)
+    try:
+      pipe = self.connection.pipeline()
+      pipe.set(key, entry.to_json(), ex=self.ttl)
+      for index_key in (
+        f"{self.prefix}:container:{container.id}",
+        f"{self.prefix}:collection:{container.collection_id}",
+        f"{self.prefix}:entity:{container.collection_ref.entity_id}",
+      ):
+        pipe.sadd(index_key, key)
+        pipe.expire(index_key, self.ttl)
+      pipe.execute()
+    except RedisError as err:
+      current_app.logger.debug(f"{self.prefix} set failed: {err}")
+
+  def _drop(self, index_keys: typing.List[str]) -> None:
+    pipe = self.connection.pipeline()
+    for index_key in index_keys:
+      pipe.smembers(index_key)
+    keys = set(chain.from_iterable(pipe.execute()))
+    pipe = self.connection.pipeline()
+    if keys:
+      pipe.delete(*keys)
+    pipe.delete(*index_keys)
+    pipe.execute()
+
+  def invalidate(self, containers=(), collections=(), entities=()) -> None:
+    if not has_app_context() or not self.enabled:
+      return
+    index_keys = [ f"{self.prefix}:container:{id}" for id in containers ] + \
+      [ f"{self.prefix}:collection:{id}" for id in collections ] + \
+      [ f"{self.prefix}:entity:{id}" for id in entities ]
+    if not index_keys:
+      return
+    try:
+      self._drop(index_keys)
+    except RedisError as err:
+      current_app.logger.warning(f"{self.prefix} invalidation failed: {err}")
+
+class BlobCache(ResolutionCache):
+  prefix = 'hinkskalle:blob_cache'
+  ttl_setting = 'BLOB_CACHE_TTL'
+  entry_class = BlobLocation
+
+  def set(self, name: str, digest: str, image) -> BlobLocation:
+    blob = BlobLocation.from_image(image)
+    self._store(name, digest, blob, image.container_ref)
+    return blob
+
+blob_cache = BlobCache()
+
+# all caches are dropped together when their containers change
+_caches: typing.List[ResolutionCache] = [ blob_cache ]
+
+def register_cache(cache: ResolutionCache) -> ResolutionCache:
+  _caches.append(cache)
+  return cache
+
+def invalidate_container(container_id: int) -> None:
+  for cache in _caches:
+    cache.invalidate(containers=[container_id])
+
+# collect changed objects on flush, drop their entries once the change is
+# committed (dropping earlier could let another worker cache the old state
+# again before we commit).
+_CONTAINER_SCOPED = ('Image', 'Tag', 'Manifest')
+
+def _after_flush(session, flush_context):
+  changed = session.info.setdefault('resolution_cache_changed', { 'containers': set(), 'collections': set(), 'entities': set() })
+  for obj in chain(session.new, session.dirty, session.deleted):
+    kind = obj.__class__.__name__
+    if kind in _CONTAINER_SCOPED:
+      # moving to another container leaves entries behind in the old one
+      changed['containers'].update(id for id in chain([obj.container_id], inspect(obj).attrs.container_id.history.deleted) if id is not None)
+    elif kind == 'Container' and obj.id is not None:
+      changed['containers'].add(obj.id)
+    elif kind == 'Collection' and obj.id is not None:
+      changed['collections'].add(obj.id)
+    elif kind == 'Entity' and obj.id is not None:
+      changed['entities'].add(obj.id)
+
+def _after_commit(session):
+  changed = session.info.pop('resolution_cache_changed', None)
+  if changed:
+    for cache in _caches:
+      cache.invalidate(**changed)
+
+def _after_rollback(session, previous_transaction):
+  session.info.pop('resolution_cache_changed', None)
+
+event.listen(Session, 'after_flush', _after_flush)
+event.listen(Session, 'after_commit', _after_commit)
+event.listen(Session, 'after_soft_rollback', _after_rollback)
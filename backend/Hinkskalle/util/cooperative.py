@@ -0,0 +1,80 @@
+import typing
+
+# gevent can only switch greenlets when we do I/O through its (patched)
+# sockets. psycopg2 talks to postgres in C, a running query blocks the
+# whole worker. psycopg2 can hand the waiting back to python with a wait
+# callback (same as psycogreen does), then other requests get to run while
+# the database works.
+
+def gevent_patched() -> bool:
+  try:
+    from gevent import monkey
+  except ImportError:
+    return False
+  return monkey.is_module_patched('socket')
+
+def gevent_wait_callback(conn, timeout=None) -> None:
+  """psycopg2 wait callback, yields to the gevent hub while waiting for the server"""
+  from psycopg2 import extensions, OperationalError
+  from gevent.socket import wait_read, wait_write
+  while True:
+    state = conn.poll()
+    if state == extensions.POLL_OK:
+      break
+    elif state == extensions.POLL_READ:
+      wait_read(conn.fileno(), timeout=timeout)
+    elif state == extensions.POLL_WRITE:
+      wait_write(conn.fileno(), timeout=timeout)
+    else:
+      raise OperationalError(f"Bad result from poll: {state}")
+
+def _as_bool(key: str, value: typing.Any) -> bool:
+  """config values from json are booleans, from the environment strings"""
+  if not isinstance(value, str):
+    return bool(value)
+  if value.strip().lower() in ('1', 'true', 'yes', 'on'):
+    return True
+  if value.strip().lower() in ('', '0', 'false', 'no', 'off'):
+    return False
+  raise ValueError(f"{key}: expected true or false, got {value}")
+
+def setup_cooperative_db(app) -> bool:
+  """install the wait callback if DB_COOPERATIVE says so, returns whether it is active"""
+  setting = app.config.get('DB_COOPERATIVE', 'auto')
+  if not _database_uri(app).startswith('postgresql'):
+    return False
+  auto = isinstance(setting, str) and setting.strip().lower() == 'auto'
+  if auto:
+    enable = gevent_patched()
+  else:
+    enable = _as_bool('DB_COOPERATIVE', setting)
+
+  try:
+    from psycopg2 import extensions
+  except ImportError:
+    if enable and not auto:
+      raise
+    return False
+  if enable:
+    extensions.set_wait_callback(gevent_wait_callback)
+  elif extensions.get_wait_callback() is gevent_wait_callback:
+    extensions.set_wait_callback(None)
+  return enable
+
+def _database_uri(app) -> str:
+  # flask-sqlalchemy falls back to in-memory sqlite without one
+  return app.config.get('SQLALCHEMY_DATABASE_URI') or 'sqlite://'
+
+def engine_options(app) -> typing.Dict[str, typing.Any]:
+  options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+  # sqlite uses its own (static/singleton) pools without overflow
+  if not _database_uri(app).startswith('sqlite'):
+    if app.config.get('DB_POOL_SIZE') is not None:
+      options.setdefault('pool_size', int(app.config['DB_POOL_SIZE']))
+    if app.config.get('DB_MAX_OVERFLOW') is not None:
+      options.setdefault('max_overflow', int(app.config['DB_MAX_OVERFLOW']))
+  if app.config.get('DB_POOL_PRE_PING') is not None:
+    options.setdefault('pool_pre_ping', _as_bool('DB_POOL_PRE_PING', app.config['DB_POOL_PRE_PING']))
+  if app.config.get('DB_POOL_RECYCLE') is not None:
+    options.setdefault('pool_recycle', int(app.config['DB_POOL_RECYCLE']))
+  return options
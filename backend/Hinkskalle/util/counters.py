@@ -0,0 +1,128 @@
+import time
+import typing
+from datetime import datetime, timedelta
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+# every pull used to increment downloadCount on image, container and
+# manifest and commit right away. Cluster jobs pulling the same image all
+# wait for the same rows. Collect the increments in redis instead and add
+# them up in one statement per table (see jobs.flush_download_counts)
+class DownloadCounter():
+  prefix = 'hinkskalle:download_count'
+  kinds = ('image', 'container', 'manifest')
+
+  @property
+  def batch_size(self) -> int:
+    return int(current_app.config.get('DOWNLOAD_COUNT_BATCH', 1))
+
+  @property
+  def flush_interval(self) -> int:
+    return int(current_app.config.get('DOWNLOAD_COUNT_FLUSH_INTERVAL', 0))
+
+  @property
+  def connection(self):
+    from Hinkskalle.util.jobs import rq
+    return rq.connection
+
+  def count(self, image=None, container=None, manifest=None) -> None:
+    self.count_ids(**{ kind: obj.id for kind, obj in (('image', image), ('container', container), ('manifest', manifest)) if obj is not None })
+
+  def count_ids(self, **counted: int) -> None:
+    """same as count, for callers that only know the ids"""
+    if not counted:
+      return
+    now = time.time()
+    if self.flush_interval <= 0:
+      self._write({ kind: { obj_id: (1, now) } for kind, obj_id in counted.items() })
+      return
+    try:
+      pipe = self.connection.pipeline()
+      for kind, obj_id in counted.items():
+        pipe.hincrby(f"{self.prefix}:{kind}", obj_id, 1)
+        pipe.hset(f"{self.prefix}:{kind}_latest", obj_id, now)
+      pipe.incr(f"{self.prefix}:pending")
+      pipe.setnx(f"{self.prefix}:since", now)
+      *_, pending, first = pipe.execute()
+    except RedisError as err:
+      # no buffer available, fall back to writing directly
+      current_app.logger.debug(f"download count buffer failed: {err}")
+      self._write({ kind: { obj_id: (1, now) } for kind, obj_id in counted.items() })
+      return
+
+    if first:
+      self._schedule_flush(delay=self.flush_interval)
+    if pending >= self.batch_size:
+      self._schedule_flush()
+
+  def _schedule_flush(self, delay: typing.Optional[int]=None) -> None:
+    from Hinkskalle.util.jobs import flush_download_counts
+    try:
+      if delay:
+        flush_download_counts.schedule(timedelta(seconds=delay))
+      # only one immediate flush at a time
+      elif self.connection.set(f"{self.prefix}:scheduled", 1, nx=True, ex=max(self.flush_interval, 10)):
+        flush_download_counts.queue()
+    except RedisError as err:
+      current_app.logger.debug(f"scheduling download count flush failed: {err}")
+
+  def pending(self, kind: str, obj_id: int) -> int:
+    try:
+      return int(self.connection.hget(f"{self.prefix}:{kind}", obj_id) or 0)
+    except RedisError as err:
+      current_app.logger.debug(f"download count lookup failed: {err}")
+      return 0
+
+  def flush(self) -> int:
+    pipe = self.connection.pipeline()
+    for kind in self.kinds:
+      pipe.hgetall(f"{self.prefix}:{kind}")
+      pipe.hgetall(f"{self.prefix}:{kind}_latest")
+    pipe.delete(f"{self.prefix}:pending", f"{self.prefix}:since", f"{self.prefix}:scheduled", *[ f"{self.prefix}:{kind}{postfix}" for kind in self.kinds for postfix in ('', '_latest') ])
+    raw = pipe.execute()
+    counts: typing.Dict[str, typing.Dict[int, typing.Tuple[int, float]]] = {}
+    for idx, kind in enumerate(self.kinds):
+      increments, latest = raw[idx*2], raw[idx*2+1]
+      if increments:
+        counts[kind] = { int(obj_id): (int(n), float(latest.get(obj_id, time.time()))) for obj_id, n in increments.items() }
+    if not counts:
+      return 0
+    try:
+      self._write(counts)
+    except Exception:
+      # put them back for the next try
+      pipe = self.connection.pipeline()
+      for kind, entries in counts.items():
+        for obj_id, (n, latest) in entries.items():
+          pipe.hincrby(f"{self.prefix}:{kind}", obj_id, n)
+          pipe.hset(f"{self.prefix}:{kind}_latest", obj_id, latest)
+      pipe.execute()
+      raise
+    return sum(n for entries in counts.values() for n, _ in entries.values())
+
+  def _write(self, counts: typing.Dict[str, typing.Dict[int, typing.Tuple[int, float]]]) -> None:
+    from Hinkskalle import db
+    from Hinkskalle.models import Image, Container, Manifest
+    from sqlalchemy import bindparam, func
+
+    models = { 'image': Image, 'container': Container, 'manifest': Manifest }
+    try:
+      for kind, entries in counts.items():
+        table = models[kind].__table__
+        # core update: n pulls are one statement per table
+        stmt = table.update().where(
+          table.c.id == bindparam('_id')
+        ).values(
+          downloadCount=func.coalesce(table.c.downloadCount, 0) + bindparam('_count'),
+          latestDownload=bindparam('_latest'),
+        )
+        db.session.execute(stmt, [
+          { '_id': obj_id, '_count': n, '_latest': datetime.fromtimestamp(latest) } for obj_id, (n, latest) in entries.items()
+        ])
+      db.session.commit()
+    except Exception:
+      db.session.rollback()
+      raise
+
+download_counter = DownloadCounter()
@@ -15,7 +15,7 @@ from Hinkskalle.models.Adm import Adm, AdmKeys
 from Hinkskalle.models.Entity import Entity
 from Hinkskalle.models.Image import Image, UploadStates
 from Hinkskalle.models.User import User
-from .auth.ldap import LDAPUsers, _get_attr
+from .auth.ldap import LDAPUsers, _get_attr, _get_timestamp
 from .auth.exceptions import UserConflict
 import os
 import os.path
@@ -181,25 +181,60 @@ def sync_ldap() -> typing.Optional[str]:
 
   job.meta['progress']='fetch'
   job.save_meta()
+  page_size = int(svc.config.get('PAGE_SIZE', 500))
+  batch_size = int(svc.config.get('SYNC_BATCH', 500))
+
+  # incremental: only fetch entries modified since the last run (high
+  # water mark from the previous result). Every FULL_SYNC_INTERVAL we
+  # read everything to catch deleted entries.
+  incremental = bool(svc.config.get('INCREMENTAL_SYNC', False))
+  previous = Adm.query.get(AdmKeys.ldap_sync_results)
+  state = previous.val if previous and previous.val.get('success') else {}
+  modified_since = state.get('highWaterMark')
+  last_full = state.get('lastFullSync')
+  full = not incremental or not modified_since or not last_full or \
+    (datetime.now(tz=timezone.utc) - datetime.fromisoformat(last_full)).total_seconds() >= int(svc.config.get('FULL_SYNC_INTERVAL', 86400))
+  result['mode'] = 'full' if full else 'incremental'
+  high_water_mark = _get_timestamp(modified_since)
+  seen: typing.Set[str] = set()
+  # deactivating on an incomplete list would lock out users we just
+  # could not read
+  seen_complete = True
+
+  def _sync_batch(batch: typing.List[dict]):
+    batch_result = svc.sync_users(batch)
+    for k in ('synced', 'conflict', 'failed'):
+      result[k].extend(batch_result[k])
+    job.meta['progress']=f"{len(result['synced'])+len(result['conflict'])+len(result['failed'])} done"
+    job.save_meta()
+
   try:
-    ldap_users = svc.ldap.list_users()
+    batch: typing.List[dict] = []
+    for ldap_user in svc.ldap.iter_users(page_size=page_size, modified_since=None if full else modified_since):
+      modified = _get_timestamp(ldap_user.get('attributes', {}).get('modifyTimestamp'))
+      if modified and (not high_water_mark or modified > high_water_mark):
+        high_water_mark = modified
+      if full:
+        try:
+          seen.add(svc.entry_username(ldap_user))
+        except Exception as err:
+          current_app.logger.warning(f"no username for {ldap_user.get('dn')}: {err}")
+          seen_complete = False
+      batch.append(ldap_user)
+      if len(batch) >= batch_size:
+        _sync_batch(batch)
+        batch = []
+    if batch:
+      _sync_batch(batch)
 
-    count=0
-    for ldap_user in ldap_users:
-      count = count + 1
-      job.meta['progress']=f"{count} of {len(ldap_users)}"
-      job.save_meta()
-      cn = _get_attr(ldap_user.get('attributes').get('cn'))
-      try:
-        db_user = svc.sync_user(ldap_user)
-        result['synced'].append(db_user.username)
-      except UserConflict:
-        db.session.rollback()
-        result['conflict'].append(cn)
-      except Exception as exc:
-        db.session.rollback()
-        current_app.logger.warn(f"sync {cn}: {exc}")
-        result['failed'].append(cn)
+    if incremental:
+      result['highWaterMark'] = high_water_mark
+      result['lastFullSync'] = result['started'] if full else last_full
+      if full and seen_complete:
+        result['deactivated'] = svc.deactivate_missing(seen)
+      elif full:
+        current_app.logger.warning(f"skipping deactivation, not all entries could be read")
+        result['deactivated'] = []
 
     _finish_job(job, result, AdmKeys.ldap_sync_results)
   except Exception as exc:
@@ -210,9 +245,69 @@ def sync_ldap() -> typing.Optional[str]:
   current_app.logger.debug(result)
   return f"synced {len(result['synced'])}"
 
+@rq.job
+def expire_tokens() -> typing.Optional[str]:
+  from Hinkskalle.models.User import Token
+  from .auth.refresh import token_refresher
+  current_app.logger.debug(f"starting token expiration...")
+  job: typing.Optional[Job] = get_current_job()
+  if not job:
+    return
+  result = {
+    'job': job.id,
+    'started': datetime.now(tz=timezone.utc).isoformat(),
+    'deleted': 0,
+  }
+  job.meta['progress']='starting'
+  job.save_meta()
+  try:
+    # buffered extensions first, otherwise we'd reap tokens still in use
+    token_refresher.flush()
+    batch_size = current_app.config.get('TOKEN_PURGE_BATCH', 1000)
+    # only expired logins: revoked manual tokens stay around for the record
+    to_delete = db.session.query(Token.id).filter(
+      Token.source == 'auto',
+      Token.expiresAt < datetime.now(),
+    )
+    while True:
+      ids = [ row.id for row in to_delete.limit(batch_size) ]
+      if not ids:
+        break
+      # bulk delete, no need to go through the orm: stale cache entries
+      # don't find their row anymore.
+      Token.query.filter(Token.id.in_(ids)).delete(synchronize_session=False)
+      db.session.commit()
+      result['deleted'] += len(ids)
+      job.meta['progress']=f"{result['deleted']}"
+      job.save_meta()
+    _finish_job(job, result, AdmKeys.expire_tokens)
+  except Exception as exc:
+    db.session.rollback()
+    current_app.logger.error(exc)
+    _fail_job(job, result, AdmKeys.expire_tokens, exc)
+    raise exc
+  current_app.logger.debug(f"token expiration finished.")
+  current_app.logger.debug(result)
+  return f"deleted {result['deleted']}"
+
+@rq.job
+def flush_token_refreshes() -> typing.Optional[str]:
+  from .auth.refresh import token_refresher
+  count = token_refresher.flush()
+  current_app.logger.debug(f"flushed {count} token refreshes")
+  return f"flushed {count}"
+
+@rq.job
+def flush_download_counts() -> typing.Optional[str]:
+  from .counters import download_counter
+  count = download_counter.flush()
+  current_app.logger.debug(f"flushed {count} downloads")
+  return f"flushed {count}"
+
 
 adm_map = {
   AdmKeys.ldap_sync_results.name: sync_ldap,
   AdmKeys.expire_images.name: expire_images,
   AdmKeys.check_quotas.name: update_quotas,
+  AdmKeys.expire_tokens.name: expire_tokens,
 }
\ No newline at end of file
@@ -0,0 +1,29 @@
+from .blob_cache import CachedResolution, ResolutionCache, register_cache
+
+# tag and digest fetches of manifests: container and tag lookups, staleness
+# check (one image query per singularity layer) and parsing the content
+# for its media type, for a small json body. Cache the rendered response.
+class ManifestResponse(CachedResolution):
+  fields = ('manifest_id', 'hash', 'content', 'media_type')
+
+  @classmethod
+  def from_manifest(cls, manifest) -> 'ManifestResponse':
+    return cls({
+      'manifest_id': manifest.id,
+      'hash': manifest.hash,
+      'content': manifest.content,
+      'media_type': manifest.content_json.get('mediaType', 'application/vnd.oci.image.manifest.v1+json'),
+      **cls.access_info(manifest.container_ref),
+    })
+
+class ManifestCache(ResolutionCache):
+  prefix = 'hinkskalle:manifest_cache'
+  ttl_setting = 'MANIFEST_CACHE_TTL'
+  entry_class = ManifestResponse
+
+  def set(self, name: str, reference: str, manifest) -> ManifestResponse:
+    entry = ManifestResponse.from_manifest(manifest)
+    self._store(name, reference, entry, manifest.container_ref)
+    return entry
+
+manifest_cache = register_cache(ManifestCache())
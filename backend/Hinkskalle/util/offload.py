@@ -0,0 +1,51 @@
+import typing
+import threading
+
+from flask import current_app, has_app_context
+
+from .cooperative import gevent_patched
+
+# gunicorn runs us with gevent workers. Everything CPU or disk bound
+# (password hashes, checksumming uploads, moving images around) blocks the
+# hub and with it every other request on the worker. Hand these to native
+# threads instead. Only the callables go to the pool, they must not need
+# the app or request context. Subprocesses stay out: patched subprocess
+# yields by itself and does not work in pool threads.
+#
+# Without gevent the request thread has to wait anyways, so we just call
+# the function directly.
+
+_lock = threading.Lock()
+_pool = None
+_pool_size = 0
+
+def _cooperative() -> bool:
+  return gevent_patched()
+
+def pool_size() -> int:
+  if not has_app_context():
+    return 0
+  return int(current_app.config.get('OFFLOAD_THREADS', 0))
+
+def _make_pool(size: int):
+  # only used under gevent, see run_blocking
+  from gevent.threadpool import ThreadPool
+  return ThreadPool(size)
+
+def _get_pool(size: int):
+  global _pool, _pool_size
+  with _lock:
+    if _pool is None or _pool_size != size:
+      if _pool is not None:
+        _pool.kill()
+      _pool = _make_pool(size)
+      _pool_size = size
+    return _pool
+
+def run_blocking(fn: typing.Callable, *args, **kwargs):
+  """call fn in the offload pool (when running under gevent), wait for the result"""
+  size = pool_size()
+  if size <= 0 or not _cooperative():
+    return fn(*args, **kwargs)
+  # only the calling greenlet waits
+  return _get_pool(size).apply(fn, args, kwargs)
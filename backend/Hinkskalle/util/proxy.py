@@ -0,0 +1,180 @@
+import hashlib
+import time
+import typing
+
+import requests
+from flask import current_app
+from redis.exceptions import RedisError
+from werkzeug.http import parse_www_authenticate_header
+
+class UpstreamError(Exception):
+  pass
+
+class Upstream():
+  """minimal registry client: bearer token challenge, manifests, blobs and
+  library image files"""
+  manifest_types = [
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+  ]
+  chunk_size = 1024*1024
+
+  def __init__(self):
+    self.session = requests.Session()
+    # per scope, valid until
+    self._tokens: typing.Dict[str, typing.Tuple[str, float]] = {}
+
+  @property
+  def url(self) -> str:
+    return current_app.config['PROXY_UPSTREAM'].rstrip('/')
+
+  @property
+  def timeout(self) -> int:
+    return int(current_app.config.get('PROXY_TIMEOUT', 60))
+
+  def _auth(self) -> typing.Optional[typing.Tuple[str, str]]:
+    if current_app.config.get('PROXY_USERNAME'):
+      return (current_app.config['PROXY_USERNAME'], current_app.config.get('PROXY_PASSWORD') or '')
+    return None
+
+  def _token(self, challenge: str) -> typing.Optional[str]:
+    params = parse_www_authenticate_header(challenge)
+    if params.type != 'bearer' or not params.get('realm'):
+      return None
+    scope = params.get('scope', '')
+    cached = self._tokens.get(scope)
+    if cached and cached[1] > time.time():
+      return cached[0]
+    try:
+      resp = self.session.get(params['realm'], params={ k: v for k, v in params.items() if k in ('service', 'scope') }, auth=self._auth(), timeout=self.timeout)
+    except requests.RequestException as err:
+      raise UpstreamError(f"token request failed: {err}")
+    if resp.status_code != 200:
+      raise UpstreamError(f"token request failed with {resp.status_code}")
+    data = resp.json()
+    token = data.get('token') or data.get('access_token')
+    # refresh a bit early
+    self._tokens[scope] = (token, time.time() + max(int(data.get('expires_in', 60)) - 10, 0))
+    return token
+
+  def get(self, path: str, headers: typing.Optional[dict]=None, stream: bool=False) -> typing.Optional[requests.Response]:
+    """None if upstream does not know path"""
+    headers = headers or {}
+    try:
+      resp = self.session.get(self.url+path, headers=headers, stream=stream, timeout=self.timeout)
+      if resp.status_code == 401 and resp.headers.get('WWW-Authenticate'):
+        token = self._token(resp.headers['WWW-Authenticate'])
+        if token:
+          resp.close()
+          resp = self.session.get(self.url+path, headers={ **headers, 'Authorization': f"Bearer {token}" }, stream=stream, timeout=self.timeout)
+    except requests.RequestException as err:
+      raise UpstreamError(f"{path}: {err}")
+    if resp.status_code == 404:
+      resp.close()
+      return None
+    if resp.status_code != 200:
+      resp.close()
+      raise UpstreamError(f"{path}: upstream returned {resp.status_code}")
+    return resp
+
+  def manifest(self, name: str, reference: str) -> typing.Optional[bytes]:
+    resp = self.get(f"/v2/{name}/manifests/{reference}", headers={ 'Accept': ', '.join(self.manifest_types) })
+    if resp is None:
+      return None
+    content = resp.content
+    if reference.startswith('sha256:') and hashlib.sha256(content).hexdigest() != reference.replace('sha256:', ''):
+      raise UpstreamError(f"manifest {name}@{reference}: digest mismatch")
+    return content
+
+  def download(self, path: str, target: str) -> typing.Optional[str]:
+    """stream to target, returns sha256 hex digest"""
+    resp = self.get(path, stream=True)
+    if resp is None:
+      return None
+    m = hashlib.sha256()
+    try:
+      with open(target, 'wb') as fh:
+        for chunk in resp.iter_content(chunk_size=self.chunk_size):
+          m.update(chunk)
+          fh.write(chunk)
+    except requests.RequestException as err:
+      raise UpstreamError(f"{path}: {err}")
+    finally:
+      resp.close()
+    return m.hexdigest()
+
+  def blob(self, name: str, digest: str, target: str) -> bool:
+    hexdigest = self.download(f"/v2/{name}/blobs/{digest}", target)
+    if hexdigest is None:
+      return False
+    if hexdigest != digest.replace('sha256:', ''):
+      raise UpstreamError(f"blob {name}@{digest}: digest mismatch")
+    return True
+
+  def imagefile(self, name: str, tag: str, target: str, arch: typing.Optional[str]=None) -> typing.Optional[str]:
+    return self.download(f"/v1/imagefile/{name}:{tag}" + (f"?arch={arch}" if arch else ''), target)
+
+# pull-through mode: repositories under PROXY_ENTITY that we do not have
+# yet are fetched from PROXY_UPSTREAM and stored like regular uploads.
+# Clients tend to pull the same layers in parallel (cluster jobs starting
+# at the same time), only one worker fetches, the others wait for it.
+class PullThrough():
+  prefix = 'hinkskalle:proxy'
+
+  def __init__(self):
+    self.upstream = Upstream()
+
+  @property
+  def enabled(self) -> bool:
+    return bool(current_app.config.get('PROXY_UPSTREAM'))
+
+  @property
+  def entity(self) -> str:
+    return current_app.config.get('PROXY_ENTITY', 'proxy').lower()
+
+  @property
+  def fetch_timeout(self) -> int:
+    return int(current_app.config.get('PROXY_FETCH_TIMEOUT', 3600))
+
+  @property
+  def connection(self):
+    from Hinkskalle.util.jobs import rq
+    return rq.connection
+
+  def handles(self, entity: str) -> bool:
+    return self.enabled and entity.lower() == self.entity
+
+  def single_flight(self, key: str, lookup: typing.Callable, fetch: typing.Callable):
+    """fetch() only if lookup() finds nothing and nobody else is fetching
+    key right now, otherwise wait for them and lookup() again"""
+    lock = f"{self.prefix}:fetch:{key}"
+    try:
+      acquired = self.connection.set(lock, 1, nx=True, ex=self.fetch_timeout)
+    except RedisError as err:
+      current_app.logger.debug(f"proxy fetch lock failed: {err}")
+      return lookup() or fetch()
+
+    if acquired:
+      try:
+        # could have finished just before we got the lock
+        return lookup() or fetch()
+      finally:
+        try:
+          self.connection.delete(lock)
+        except RedisError as err:
+          current_app.logger.warning(f"proxy fetch lock release failed: {err}")
+
+    current_app.logger.debug(f"waiting for fetch of {key}...")
+    deadline = time.time() + self.fetch_timeout
+    while time.time() < deadline:
+      try:
+        if not self.connection.exists(lock):
+          break
+      except RedisError:
+        break
+      time.sleep(0.2)
+    return lookup()
+
+pull_through = PullThrough()
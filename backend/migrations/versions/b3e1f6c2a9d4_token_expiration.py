@@ -0,0 +1,26 @@
+"""token expiration
+
+Revision ID: b3e1f6c2a9d4
+Revises: 405171f14e02
+Create Date: 2026-10-18 10:12:31.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e1f6c2a9d4'
+down_revision = '405171f14e02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    if conn.engine.name == 'postgresql':
+      conn.execute(sa.text("alter type admkeys add value if not exists 'expire_tokens'"))
+
+
+def downgrade():
+    pass
@@ -0,0 +1,4 @@
+from Hinkskalle import create_app
+app=create_app(transfer=True)
+if __name__ == '__main__':
+    app.run()
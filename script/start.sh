@@ -9,6 +9,8 @@ sed -e "s^%VUE_APP_BACKEND_URL%^$HINKSKALLE_BACKEND_URL^" \
     frontend/dist/index.html.subs > frontend/dist/index.html
 
 SESSION=hink
+# wsgi:app (everything) or wsgi_transfer:app (only up-/downloads)
+WSGI_APP=${HINKSKALLE_WSGI_APP:-wsgi:app}
 cd backend
 flask db upgrade
 gunicorn -u hinkskalle \
@@ -19,4 +21,4 @@ gunicorn -u hinkskalle \
   --timeout 3600 \
   --worker-class gevent \
   --bind 0.0.0.0:5000 \
-  wsgi:app
+  $WSGI_APP